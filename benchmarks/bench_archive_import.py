@@ -0,0 +1,123 @@
+"""
+Compare importing an archive tweet.js the old way, reading the whole zip
+member and decoding it in one go, with archive.import_from_fp(),
+which parses one array item at a time and inserts in batches.
+
+    python benchmarks/bench_archive_import.py [num_tweets]
+
+num_tweets defaults to 100,000, which is around 110MB of tweet.js.
+"""
+
+import io
+import json
+import pathlib
+import sys
+import tempfile
+import time
+import tracemalloc
+import zipfile
+
+import sqlite_utils
+from twitter_to_sqlite import archive, utils
+
+TWEET = {
+    "retweeted": False,
+    "source": '<a href="https://mobile.twitter.com" rel="nofollow">Twitter Web App</a>',
+    "entities": {
+        "hashtags": [],
+        "symbols": [],
+        "user_mentions": [
+            {
+                "name": "Simon Willison",
+                "screen_name": "simonw",
+                "indices": ["0", "7"],
+                "id_str": "12497",
+                "id": "12497",
+            }
+        ],
+        "urls": [],
+    },
+    "display_text_range": ["0", "140"],
+    "favorite_count": "3",
+    "in_reply_to_status_id_str": "1234567890123456789",
+    "in_reply_to_user_id": "12497",
+    "truncated": False,
+    "retweet_count": "0",
+    "in_reply_to_status_id": "1234567890123456789",
+    "created_at": "Sat Mar 21 18:02:33 +0000 2020",
+    "favorited": False,
+    "full_text": "@simonw " + "An archived tweet with some text in it. " * 3,
+    "lang": "en",
+    "in_reply_to_screen_name": "simonw",
+    "in_reply_to_user_id_str": "12497",
+}
+
+
+def write_archive(path, num_tweets):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as zf:
+        with zf.open("data/tweet.js", "w") as fp:
+            fp = io.TextIOWrapper(fp, "utf8")
+            fp.write("window.YTD.tweet.part0 = [ ")
+            for i in range(num_tweets):
+                tweet = dict(TWEET, id=str(i), id_str=str(i))
+                if i:
+                    fp.write(", ")
+                json.dump({"tweet": tweet}, fp, indent=2)
+            fp.write(" ]")
+            fp.flush()
+
+
+def import_whole(db, path):
+    for filename, content in utils.read_archive_js(path):
+        old_import_from_file(db, filename, content)
+
+
+def import_streaming(db, path):
+    for filename, fp in utils.open_archive_js(path):
+        with fp:
+            archive.import_from_fp(db, filename, fp)
+
+
+def extract_json(contents):
+    # window.YTD.account_creation_ip.part0 = [ ... data ...]
+    contents = contents.strip()
+    if contents.startswith(b"window."):
+        contents = contents.split(b" = ", 1)[1]
+    return utils.json_loads(contents)
+
+
+def old_import_from_file(db, filename, content):
+    "import_from_file() as it was before iter_json_array()"
+    transformer, pk = archive.transformers[filename[: -len(".js")]]
+    for table, rows in transformer(extract_json(content)).items():
+        db["archive_{}".format(table)].insert_all(rows, pk=pk, replace=True)
+
+
+def measure(fn, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        fn(*args)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+if __name__ == "__main__":
+    num_tweets = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = str(pathlib.Path(tmpdir) / "archive.zip")
+        write_archive(path, num_tweets)
+        size = zipfile.ZipFile(path).getinfo("data/tweet.js").file_size
+        print("{:,} tweets, tweet.js is {:,.1f}MB".format(num_tweets, size / 1e6))
+        for name, fn in (("whole file", import_whole), ("streaming", import_streaming)):
+            db = sqlite_utils.Database(str(pathlib.Path(tmpdir) / (name + ".db")))
+            elapsed, peak = measure(fn, db, path)
+            assert num_tweets == db["archive_tweet"].count
+            print(
+                "{:<10}  {:.2f}s  peak {:,.1f}MB".format(
+                    name, elapsed, peak / 1024 / 1024
+                )
+            )
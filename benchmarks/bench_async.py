@@ -0,0 +1,80 @@
+"""
+Compare fetching tweets with statuses/lookup from a local mock API using
+the synchronous utils.fetch_status_batches() and the asyncio version in
+async_utils, which has several batches in flight at once. Needs aiohttp.
+
+    python benchmarks/bench_async.py
+"""
+
+import time
+
+import requests
+from twitter_to_sqlite import async_utils, utils
+
+from mock_api import MockApi
+
+AUTH = {
+    "api_key": "key",
+    "api_secret_key": "secret",
+    "access_token": "token",
+    "access_token_secret": "token_secret",
+}
+
+
+class LocalSession(requests.Session):
+    def __init__(self, api):
+        super().__init__()
+        self.api = api
+
+    def get(self, url, **kwargs):
+        url = url.replace("https://api.twitter.com", self.api.base)
+        return super().get(url, **kwargs)
+
+
+def local_async_session(api, concurrency):
+    class LocalAsyncSession(async_utils.AsyncSession):
+        async def get(self, url, params=None, max_retries=5):
+            url = url.replace("https://api.twitter.com", api.base)
+            return await super().get(url, params, max_retries)
+
+    return LocalAsyncSession(AUTH, concurrency=concurrency)
+
+
+def run_sync(api, tweet_ids):
+    start = time.perf_counter()
+    count = 0
+    for tweets in utils.fetch_status_batches(LocalSession(api), tweet_ids):
+        count += len(tweets)
+    assert count == len(tweet_ids)
+    return time.perf_counter() - start
+
+
+def run_async(api, tweet_ids, concurrency):
+    async def main():
+        count = 0
+        async with local_async_session(api, concurrency) as session:
+            async for tweets in async_utils.fetch_status_batches(session, tweet_ids):
+                count += len(tweets)
+        assert count == len(tweet_ids)
+
+    start = time.perf_counter()
+    async_utils.run(main())
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    tweet_ids = list(range(1, 2001))
+    for latency in (0.02, 0.1, 0.25):
+        with MockApi(latency=latency) as api:
+            sync = run_sync(api, tweet_ids)
+            results = [
+                "sync {:.2f}s".format(sync),
+            ]
+            for concurrency in (1, 4, 8):
+                elapsed = run_async(api, tweet_ids, concurrency)
+                results.append(
+                    "async x{} {:.2f}s ({:.1f}x)".format(
+                        concurrency, elapsed, sync / elapsed
+                    )
+                )
+        print("latency {:>4.0f}ms  {}".format(latency * 1000, "  ".join(results)))
@@ -0,0 +1,48 @@
+"""
+Compare index-based utils.expand_entities() with repeated str.replace() on
+tweets with many URL entities.
+
+    python benchmarks/bench_expand_entities.py
+"""
+
+import timeit
+
+from twitter_to_sqlite import utils
+
+
+def entity_heavy_tweet(num_urls, padding=200):
+    text = "x" * padding
+    urls = []
+    for i in range(num_urls):
+        url = "https://t.co/{:06d}".format(i)
+        start = len(text) + 1
+        text += " " + url
+        urls.append(
+            {
+                "url": url,
+                "expanded_url": "https://example.com/a/long/path/{}".format(i),
+                "indices": [start, start + len(url)],
+            }
+        )
+    return text, {"urls": urls, "hashtags": [], "user_mentions": []}
+
+
+if __name__ == "__main__":
+    for num_urls in (2, 10, 50, 200):
+        text, entities = entity_heavy_tweet(num_urls)
+        assert utils.expand_entities(
+            text, entities
+        ) == utils._expand_entities_by_replace(text, entities)
+        for name, fn in (
+            ("replace", utils._expand_entities_by_replace),
+            ("indices", utils.expand_entities),
+        ):
+            number = 2000
+            seconds = min(
+                timeit.repeat(lambda: fn(text, entities), number=number, repeat=5)
+            )
+            print(
+                "{:>4} urls  {:<8} {:>8.2f}us per tweet".format(
+                    num_urls, name, seconds * 1e6 / number
+                )
+            )
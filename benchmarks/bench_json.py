@@ -0,0 +1,37 @@
+"""
+Compare the json module with utils.json_loads() (orjson, if installed) for
+decoding the test fixtures.
+
+    python benchmarks/bench_json.py
+"""
+
+import json
+import pathlib
+import timeit
+
+from twitter_to_sqlite import archive, utils
+
+tests = pathlib.Path(__file__).parent.parent / "tests"
+fixtures = {"tweets.json": (tests / "tweets.json").read_bytes()}
+for path in sorted((tests / "zip_contents").glob("*.js")):
+    contents = path.read_bytes().strip()
+    fixtures[path.name] = contents.split(b" = ", 1)[1]
+# A larger document, similar to a tweet.js archive file
+fixtures["tweets.json x 1000"] = json.dumps(
+    json.loads(fixtures["tweets.json"]) * 1000
+).encode("utf8")
+
+
+if __name__ == "__main__":
+    print("orjson installed: {}".format(utils.orjson is not None))
+    for name, data in fixtures.items():
+        number = max(1, 2000000 // len(data))
+        timings = []
+        for fn in (json.loads, utils.json_loads):
+            seconds = min(timeit.repeat(lambda: fn(data), number=number, repeat=5))
+            timings.append(seconds * 1e6 / number)
+        print(
+            "{:<24} json {:>10.1f}us  json_loads {:>10.1f}us  ({:.1f}x)".format(
+                name, timings[0], timings[1], timings[0] / timings[1]
+            )
+        )
@@ -0,0 +1,45 @@
+"""
+Compare utils.parse_datetime() with dateutil for Twitter created_at strings.
+
+    python benchmarks/bench_parse_datetime.py
+"""
+
+import json
+import pathlib
+import timeit
+
+from dateutil import parser
+from twitter_to_sqlite import utils
+
+tweets = json.load(open(pathlib.Path(__file__).parent.parent / "tests" / "tweets.json"))
+# Distinct values, so the memo only helps with genuinely repeated strings
+values = [
+    "Wed Oct 10 20:{:02d}:{:02d} +0000 2018".format(i // 60, i % 60)
+    for i in range(3600)
+]
+user_values = [tweet["user"]["created_at"] for tweet in tweets] * 1200
+
+
+def run_dateutil(values):
+    for value in values:
+        parser.parse(value)
+
+
+def run_parse_datetime(values):
+    utils.parse_datetime.cache_clear()
+    for value in values:
+        utils.parse_datetime(value)
+
+
+if __name__ == "__main__":
+    for label, data in (("distinct", values), ("repeated", user_values)):
+        for name, fn in (
+            ("dateutil", run_dateutil),
+            ("parse_datetime", run_parse_datetime),
+        ):
+            seconds = min(timeit.repeat(lambda: fn(data), number=1, repeat=5))
+            print(
+                "{:<9} {:<15} {:>8.1f}ms  ({:.2f}us per value)".format(
+                    label, name, seconds * 1000, seconds * 1e6 / len(data)
+                )
+            )
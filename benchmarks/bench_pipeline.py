@@ -0,0 +1,48 @@
+"""
+Measure fetching a timeline from a local mock API and saving it to SQLite,
+one page after another versus with utils.pipeline() overlapping the two.
+
+    python benchmarks/bench_pipeline.py
+"""
+
+import pathlib
+import tempfile
+import time
+
+import requests
+import sqlite_utils
+from twitter_to_sqlite import utils
+
+from mock_api import MockApi
+
+
+def run(api, pipelined):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = sqlite_utils.Database(str(pathlib.Path(tmpdir) / "bench.db"))
+        utils.ensure_tables(db)
+        pages = utils.fetch_timeline_pages(
+            requests.Session(), api.url, db, sleep=0, since_type="user", since_key="1"
+        )
+        if pipelined:
+            pages = utils.pipeline(pages)
+        start = time.perf_counter()
+        for tweets, checkpoint in pages:
+            utils.save_tweets(db, tweets)
+            utils.save_checkpoint(db, checkpoint)
+        elapsed = time.perf_counter() - start
+        assert api.num_tweets == db["tweets"].count
+        return elapsed
+
+
+if __name__ == "__main__":
+    for latency in (0.02, 0.1, 0.25):
+        with MockApi(num_tweets=4000, latency=latency) as api:
+            # Warm up the mock API's cache of response bodies
+            run(api, pipelined=False)
+            sequential = run(api, pipelined=False)
+            pipelined = run(api, pipelined=True)
+        print(
+            "latency {:>4.0f}ms  sequential {:.2f}s  pipelined {:.2f}s  ({:.2f}x)".format(
+                latency * 1000, sequential, pipelined, sequential / pipelined
+            )
+        )
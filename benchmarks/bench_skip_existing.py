@@ -0,0 +1,70 @@
+"""
+Compare the old statuses-lookup --skip-existing, which loaded every tweet ID
+into a Python set, with utils.missing_tweet_ids(), which filters the
+candidate IDs using a temporary table and an anti-join.
+
+    python benchmarks/bench_skip_existing.py [num_tweets]
+
+num_tweets defaults to 10,000,000. Building the database takes a while.
+"""
+
+import pathlib
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import sqlite_utils
+from twitter_to_sqlite import utils
+
+
+def set_filter(db, identifiers):
+    existing_ids = set(
+        r[0] for r in db.conn.execute("select id from tweets").fetchall()
+    )
+    return [i for i in identifiers if int(i) not in existing_ids]
+
+
+def measure(fn, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = fn(*args)
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+if __name__ == "__main__":
+    num_tweets = int(sys.argv[1]) if len(sys.argv) > 1 else 10000000
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = sqlite_utils.Database(str(pathlib.Path(tmpdir) / "bench.db"))
+        utils.ensure_tables(db)
+        with db.conn:
+            # Every other ID, so half of the candidates below are missing
+            db.conn.executemany(
+                "insert into tweets (id) values (?)",
+                ((id,) for id in range(0, 2 * num_tweets, 2)),
+            )
+        random.seed(0)
+        for num_candidates in (1000, 100000):
+            identifiers = [
+                str(random.randrange(2 * num_tweets)) for _ in range(num_candidates)
+            ]
+            old, old_time, old_peak = measure(set_filter, db, identifiers)
+            new, new_time, new_peak = measure(utils.missing_tweet_ids, db, identifiers)
+            assert [int(i) for i in old] == new
+            print(
+                "{:,} tweets, {:,} candidates  set {:.2f}s {:,.1f}MB  "
+                "anti-join {:.2f}s {:,.1f}MB".format(
+                    num_tweets,
+                    num_candidates,
+                    old_time,
+                    old_peak / 1024 / 1024,
+                    new_time,
+                    new_peak / 1024 / 1024,
+                )
+            )
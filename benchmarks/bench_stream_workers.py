@@ -0,0 +1,116 @@
+"""
+Replay a recorded statuses/filter stream into SQLite, decoding and
+transforming tweets in this process (what track does by default) and with
+utils.save_streamed_lines() using worker processes (track --processes).
+
+    python benchmarks/bench_stream_workers.py [--recording stream.jsonl]
+        [--rate LINES_PER_SECOND] [--processes 1 2 4]
+
+Without --recording, a stream of --tweets tweets is made from the test
+fixtures. --rate 0 replays as fast as possible. Adding processes only helps
+when there are spare cores; the share of the work that moves to the workers
+is printed first, giving the most that any number of cores could gain.
+"""
+
+import argparse
+import json
+import os
+import pathlib
+import tempfile
+import time
+
+import sqlite_utils
+from twitter_to_sqlite import utils
+
+tests = pathlib.Path(__file__).parent.parent / "tests"
+
+
+def make_recording(num_tweets):
+    templates = json.loads((tests / "tweets.json").read_text())
+    lines = []
+    for i in range(num_tweets):
+        tweet = json.loads(json.dumps(templates[i % len(templates)]))
+        offset = (i // len(templates) + 1) * 10**12
+        tweet["id"] += offset
+        for key in ("quoted_status", "retweeted_status"):
+            if tweet.get(key):
+                tweet[key]["id"] += offset
+        lines.append(json.dumps(tweet).encode("utf8"))
+        if i % 100 == 0:
+            # Keep-alive newlines, as in a real stream
+            lines.append(b"")
+    return lines
+
+
+def replay(lines, rate):
+    start = time.perf_counter()
+    for i, line in enumerate(lines):
+        if rate:
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        yield line
+
+
+def run(lines, rate, processes):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = sqlite_utils.Database(str(pathlib.Path(tmpdir) / "bench.db"))
+        writer = utils.GroupCommitWriter(db, batch_size=500, max_delay=0.5)
+        start = time.perf_counter()
+        if processes > 1:
+            utils.save_streamed_lines(writer, replay(lines, rate), processes)
+        else:
+            tweets = utils.decode_stream_lines(replay(lines, rate))
+            utils.save_streamed_tweets(writer, tweets)
+        elapsed = time.perf_counter() - start
+        return elapsed, writer.stats()
+
+
+def parse_share(lines, batch_size=500):
+    """
+    Fraction of the single process time spent in parse_stream_lines(), the
+    part that worker processes take off the writer
+    """
+    with tempfile.TemporaryDirectory() as tmpdir:
+        db = sqlite_utils.Database(str(pathlib.Path(tmpdir) / "bench.db"))
+        writer = utils.GroupCommitWriter(db, batch_size=batch_size)
+        parse = save = 0
+        for group in utils.chunks(lines, batch_size):
+            start = time.perf_counter()
+            result = utils.parse_stream_lines((time.monotonic(), group))
+            parse += time.perf_counter() - start
+            start = time.perf_counter()
+            writer.add_collected(*result)
+            save += time.perf_counter() - start
+        return parse / (parse + save)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--recording", help="JSONL file of raw stream lines")
+    parser.add_argument("--tweets", type=int, default=20000)
+    parser.add_argument("--rate", type=float, default=0)
+    parser.add_argument("--processes", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+    if args.recording:
+        lines = pathlib.Path(args.recording).read_bytes().splitlines()
+    else:
+        lines = make_recording(args.tweets)
+    print("{} cores, {:,} lines".format(os.cpu_count(), len(lines)))
+    share = parse_share(lines)
+    print(
+        "decoding and transforming is {:.0%} of the work, so with spare cores "
+        "--processes can be at most {:.1f}x faster".format(share, 1 / (1 - share))
+    )
+    for processes in args.processes:
+        elapsed, stats = run(lines, args.rate, processes)
+        print(
+            "processes {}  {:,.0f} tweets/s  batches {:,}  "
+            "commit latency p50 {:.0f}ms p99 {:.0f}ms".format(
+                processes,
+                stats["tweets"] / elapsed,
+                stats["batches"],
+                stats["latency_p50"] * 1000,
+                stats["latency_p99"] * 1000,
+            )
+        )
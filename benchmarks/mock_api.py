@@ -0,0 +1,96 @@
+"""
+A local stand-in for the Twitter v1.1 timeline API, used by the benchmarks.
+
+Serves pages of synthetic tweets, honouring count and max_id, and batches
+of tweets from statuses/lookup.json, after an artificial delay that
+simulates network latency. Responses are gzipped if the client asks.
+"""
+
+import copy
+import gzip
+import http.server
+import json
+import pathlib
+import socketserver
+import threading
+import time
+import urllib.parse
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    "http.server.ThreadingHTTPServer, which needs Python 3.7"
+
+    daemon_threads = True
+
+
+TEMPLATE = json.load(
+    open(pathlib.Path(__file__).parent.parent / "tests" / "tweets.json")
+)[1]
+
+
+def make_tweet(id):
+    tweet = copy.deepcopy(TEMPLATE)
+    tweet["id"] = id
+    tweet["id_str"] = str(id)
+    tweet["user"] = dict(tweet["user"], id=id % 500, id_str=str(id % 500))
+    return tweet
+
+
+class MockApi:
+    def __init__(self, num_tweets=2000, latency=0.05):
+        self.num_tweets = num_tweets
+        self.latency = latency
+        self.requests = 0
+        self.bodies = {}
+        api = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                api.requests += 1
+                url = urllib.parse.urlparse(self.path)
+                params = dict(urllib.parse.parse_qsl(url.query))
+                if url.path.endswith("/statuses/lookup.json"):
+                    body = api.lookup_body(params)
+                else:
+                    body = api.body(params)
+                time.sleep(api.latency)
+                self.send_response(200)
+                if "gzip" in self.headers.get("accept-encoding", ""):
+                    body = gzip.compress(body, compresslevel=1)
+                    self.send_header("content-encoding", "gzip")
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base = "http://127.0.0.1:{}".format(self.server.server_address[1])
+        self.url = self.base + "/1.1/statuses/user_timeline.json"
+
+    def body(self, params):
+        key = (params.get("count"), params.get("max_id"))
+        if key not in self.bodies:
+            self.bodies[key] = json.dumps(self.page(params)).encode("utf8")
+        return self.bodies[key]
+
+    def lookup_body(self, params):
+        ids = params["id"].split(",")
+        return json.dumps([make_tweet(int(id)) for id in ids]).encode("utf8")
+
+    def page(self, params):
+        count = int(params.get("count", 200))
+        max_id = int(params.get("max_id", self.num_tweets))
+        ids = range(max_id, max(max_id - count, 0), -1)
+        return [make_tweet(id) for id in ids]
+
+    def __enter__(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *args):
+        self.server.shutdown()
@@ -36,6 +36,11 @@ setup(
         "requests-oauthlib~=1.2.0",
         "python-dateutil",
     ],
-    extras_require={"test": ["pytest"]},
+    extras_require={
+        "test": ["pytest"],
+        "orjson": ["orjson"],
+        "async": ["aiohttp"],
+        "zstd": ["zstandard"],
+    },
     tests_require=["twitter-to-sqlite[test]"],
 )
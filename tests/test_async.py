@@ -0,0 +1,238 @@
+import gzip
+import http.server
+import asyncio
+import json
+import pathlib
+import threading
+import time
+import urllib.parse
+
+import pytest
+import sqlite_utils
+from click.testing import CliRunner
+from twitter_to_sqlite import async_utils, cli, utils
+
+from .utils import ThreadingHTTPServer
+
+pytest.importorskip("aiohttp")
+
+AUTH = {
+    "api_key": "key",
+    "api_secret_key": "secret",
+    "access_token": "token",
+    "access_token_secret": "token_secret",
+}
+
+PROFILE = json.load(open(pathlib.Path(__file__).parent / "tweets.json"))[0]["user"]
+
+
+class LocalApi:
+    "Serves a fake users/lookup, statuses/lookup and followers/ids API"
+
+    def __init__(self):
+        self.requests = []
+        self.connections = set()
+        self.missing_users = set()
+        # How many responses should use up the budget for two more seconds
+        self.rate_limited = 0
+        api = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                url = urllib.parse.urlparse(self.path)
+                params = dict(urllib.parse.parse_qsl(url.query))
+                api.requests.append((url.path, params, dict(self.headers)))
+                api.connections.add(self.client_address)
+                body = json.dumps(api.respond(url.path, params)).encode("utf8")
+                self.send_response(200)
+                if "gzip" in self.headers.get("accept-encoding", ""):
+                    body = gzip.compress(body)
+                    self.send_header("content-encoding", "gzip")
+                self.send_header("content-type", "application/json")
+                if api.rate_limited:
+                    api.rate_limited -= 1
+                    self.send_header("x-rate-limit-limit", "10")
+                    self.send_header("x-rate-limit-remaining", "0")
+                    self.send_header("x-rate-limit-reset", str(int(time.time()) + 2))
+                self.send_header("content-length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.base = "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def respond(self, path, params):
+        if path == "/1.1/users/lookup.json":
+            users = [
+                dict(PROFILE, id=int(id), screen_name="user{}".format(id))
+                for id in params["user_id"].split(",")
+                if int(id) not in self.missing_users
+            ]
+            return users or {"errors": [{"code": 17, "message": "No user matches."}]}
+        if path == "/1.1/statuses/lookup.json":
+            return [{"id": int(id)} for id in params["id"].split(",")]
+        if path == "/1.1/followers/ids.json":
+            cursor = int(params["cursor"])
+            next_cursor = 0 if cursor == 2 else (2 if cursor == -1 else cursor + 1)
+            return {"ids": [cursor], "next_cursor": next_cursor}
+
+    def session_class(self):
+        api = self
+
+        class LocalAsyncSession(async_utils.AsyncSession):
+            async def get(self, url, params=None, max_retries=5):
+                url = url.replace("https://api.twitter.com", api.base)
+                return await super().get(url, params, max_retries)
+
+        return LocalAsyncSession
+
+
+@pytest.fixture
+def api():
+    api = LocalApi()
+    thread = threading.Thread(target=api.server.serve_forever, daemon=True)
+    thread.start()
+    yield api
+    api.server.shutdown()
+
+
+async def collect(session_class, fetch, *args, **kwargs):
+    async with session_class(AUTH, concurrency=3) as session:
+        return [item async for item in fetch(session, *args, **kwargs)]
+
+
+def test_fetch_user_batches(api):
+    batches = async_utils.run(
+        collect(
+            api.session_class(),
+            async_utils.fetch_user_batches,
+            list(range(1, 201)),
+            use_ids=True,
+        )
+    )
+    # Batches come back in order, even though they were fetched concurrently
+    assert [70, 70, 60] == [len(batch) for batch in batches]
+    assert list(range(1, 201)) == [u["id"] for batch in batches for u in batch]
+    path, params, headers = api.requests[0]
+    assert headers["Authorization"].startswith('OAuth oauth_nonce="')
+    assert 'oauth_consumer_key="key"' in headers["Authorization"]
+    assert "gzip" in headers["Accept-Encoding"]
+
+
+def test_fetch_status_batches_reuses_connections(api):
+    batches = async_utils.run(
+        collect(api.session_class(), async_utils.fetch_status_batches, range(1, 1001))
+    )
+    assert 1000 == sum(len(batch) for batch in batches)
+    assert 10 == len(api.requests)
+    # Kept alive, so no more connections than requests in flight at once
+    assert len(api.connections) <= 3
+
+
+def test_cursor_paginate(api):
+    pages = async_utils.run(
+        collect(
+            api.session_class(),
+            async_utils.cursor_paginate,
+            "https://api.twitter.com/1.1/followers/ids.json",
+            {"screen_name": "simonw"},
+            "ids",
+            5000,
+        )
+    )
+    assert [[-1], [2]] == pages
+
+
+def test_cli_statuses_lookup_async(api, tmpdir, monkeypatch):
+    monkeypatch.setattr(async_utils, "AsyncSession", api.session_class())
+    monkeypatch.setattr(utils, "save_tweets", lambda db, tweets: saved.extend(tweets))
+    saved = []
+    auth = str(tmpdir / "auth.json")
+    open(auth, "w").write(json.dumps(AUTH))
+    result = CliRunner().invoke(
+        cli.cli,
+        ["statuses-lookup", str(tmpdir / "twitter.db"), "-a", auth, "--async"]
+        + [str(id) for id in range(1, 251)],
+    )
+    assert 0 == result.exit_code, result.output
+    assert list(range(1, 251)) == [tweet["id"] for tweet in saved]
+
+
+def test_cli_hydrate_users_async_tombstones_missing_users(api, tmpdir, monkeypatch):
+    session_class = api.session_class()
+    concurrencies = []
+
+    class RecordingAsyncSession(session_class):
+        def __init__(self, auth, concurrency=4):
+            concurrencies.append(concurrency)
+            super().__init__(auth, concurrency=concurrency)
+
+    monkeypatch.setattr(async_utils, "AsyncSession", RecordingAsyncSession)
+    # 3-72 are all missing, so that batch gets a "No user matches" error
+    api.missing_users = set(range(3, 73)) | {80}
+    auth = str(tmpdir / "auth.json")
+    open(auth, "w").write(json.dumps(AUTH))
+    db_path = str(tmpdir / "twitter.db")
+    db = sqlite_utils.Database(db_path)
+    utils.ensure_tables(db)
+    db["following"].insert_all(
+        {"followed_id": 1, "follower_id": id} for id in range(2, 100)
+    )
+    args = ["hydrate-users", db_path, "-a", auth, "--silent", "--async"]
+    result = CliRunner().invoke(cli.cli, args + ["--concurrency", "2"])
+    assert 0 == result.exit_code, result.output
+    assert [2] == concurrencies
+    assert sorted(api.missing_users) == [
+        r["id"] for r in db["user_tombstones"].rows_where(order_by="id")
+    ]
+    assert 28 == db["users"].count
+    api.requests = []
+    result = CliRunner().invoke(cli.cli, args)
+    assert 0 == result.exit_code, result.output
+    assert [] == api.requests
+
+
+def test_get_waits_for_rate_limit_without_blocking(api, monkeypatch):
+    def blocking_sleep(seconds):
+        raise AssertionError("time.sleep() called from async code")
+
+    monkeypatch.setattr(utils.time, "sleep", blocking_sleep)
+    url = "https://api.twitter.com/1.1/statuses/lookup.json"
+    # The first response pushes the reset back while the others are waiting
+    api.rate_limited = 1
+    ticks = []
+
+    async def ticker(done):
+        while not done.is_set():
+            ticks.append(time.time())
+            await asyncio.sleep(0.05)
+
+    async def main():
+        async with api.session_class()(AUTH, concurrency=3) as session:
+            session.limiter.margin = 0
+            # One call left in this window, which resets in a second
+            session.limiter.budgets["/1.1/statuses/lookup.json"] = {
+                "limit": 10,
+                "remaining": 1,
+                "reset": int(time.time()) + 1,
+            }
+            done = asyncio.Event()
+            ticking = asyncio.ensure_future(ticker(done))
+            responses = await asyncio.gather(
+                *(session.get(url, params={"id": str(id)}) for id in range(3))
+            )
+            done.set()
+            await ticking
+            return responses
+
+    started = time.time()
+    responses = async_utils.run(main())
+    assert [200, 200, 200] == [r.status_code for r in responses]
+    # The others waited for a reset while the event loop kept running
+    assert 3 == len(api.requests)
+    assert len(ticks) >= 0.5 * (time.time() - started) / 0.05
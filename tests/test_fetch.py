@@ -0,0 +1,948 @@
+import datetime
+import json
+import pathlib
+import threading
+import time
+import tracemalloc
+import urllib.parse
+
+import click
+import pytest
+import sqlite_utils
+from click.testing import CliRunner
+from twitter_to_sqlite import cli, utils
+
+
+class FakeResponse:
+    def __init__(self, body, status_code=200, headers=None):
+        self.content = json.dumps(body).encode("utf8")
+        self.status_code = status_code
+        self.headers = headers or {}
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class FakeSession:
+    "Returns canned responses in order, recording the requests made"
+
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def get(self, url, params=None):
+        self.requests.append((url, dict(params or {})))
+        response = self.responses.pop(0)
+        if not isinstance(response, FakeResponse):
+            response = FakeResponse(response)
+        return response
+
+
+def make_tweets(ids):
+    return [{"id": id, "full_text": "Tweet {}".format(id)} for id in ids]
+
+
+@pytest.fixture
+def db():
+    db = sqlite_utils.Database(memory=True)
+    utils.ensure_tables(db)
+    return db
+
+
+def test_fetch_timeline_pages_checkpoints(db):
+    session = FakeSession([make_tweets([5, 4]), make_tweets([3]), []])
+    pages = utils.fetch_timeline_pages(
+        session, "timeline", db, sleep=0, since_type="user", since_key="simonw"
+    )
+    assert [
+        ([5, 4], {"type": 1, "key": "simonw", "since_id": 5, "min_id": 4}),
+        ([3], {"type": 1, "key": "simonw", "since_id": 5, "min_id": 3}),
+    ] == [([t["id"] for t in tweets], checkpoint) for tweets, checkpoint in pages]
+    assert [None, 3, 2] == [params.get("max_id") for _, params in session.requests]
+    # Nothing is written to the database by the generator itself
+    assert [] == list(db["since_ids"].rows)
+
+
+def test_fetch_timeline_saves_since_id(db):
+    session = FakeSession([make_tweets([5, 4]), []])
+    tweets = list(
+        utils.fetch_timeline(
+            session, "timeline", db, sleep=0, since_type="user", since_key="simonw"
+        )
+    )
+    assert [5, 4] == [t["id"] for t in tweets]
+    assert [{"type": 1, "key": "simonw", "since_id": 5, "min_id": 4}] == list(
+        db["since_ids"].rows
+    )
+
+
+def save_range(db, since_id, min_id):
+    utils.save_checkpoint(
+        db, {"type": 1, "key": "simonw", "since_id": since_id, "min_id": min_id}
+    )
+
+
+def fetch_pages(db, session, **kwargs):
+    pages = utils.fetch_timeline_pages(
+        session, "timeline", db, since_type="user", since_key="simonw", **kwargs
+    )
+    return [([t["id"] for t in tweets], checkpoint) for tweets, checkpoint in pages]
+
+
+def test_fetch_timeline_pages_backfill_resumes_from_min_id(db):
+    save_range(db, 50, 40)
+    session = FakeSession([make_tweets([39, 38]), make_tweets([37]), []])
+    assert [
+        ([39, 38], {"type": 1, "key": "simonw", "since_id": 50, "min_id": 38}),
+        ([37], {"type": 1, "key": "simonw", "since_id": 50, "min_id": 37}),
+    ] == fetch_pages(db, session, backfill=True)
+    assert [39, 37, 36] == [params["max_id"] for _, params in session.requests]
+
+
+def test_fetch_timeline_pages_stops_at_saved_tweets(db):
+    save_range(db, 50, 10)
+    session = FakeSession([make_tweets([60, 55]), make_tweets([52, 50, 49])])
+    assert [
+        # Not recorded until joined up with the saved range
+        ([60, 55], None),
+        ([52, 50, 49], {"type": 1, "key": "simonw", "since_id": 60, "min_id": 10}),
+    ] == fetch_pages(db, session)
+    # Stopped without fetching the already saved tweets
+    assert 2 == len(session.requests)
+
+
+def test_fetch_timeline_pages_saved_range_out_of_reach(db):
+    save_range(db, 50, 10)
+    session = FakeSession([make_tweets([60, 55]), []])
+    assert [
+        ([60, 55], None),
+        ([], {"type": 1, "key": "simonw", "since_id": 60, "min_id": 55}),
+    ] == fetch_pages(db, session)
+
+
+def test_fetch_timeline_pages_since_keeps_min_id(db):
+    save_range(db, 50, 10)
+    session = FakeSession([make_tweets([60, 55]), []])
+    assert [
+        ([60, 55], None),
+        ([], {"type": 1, "key": "simonw", "since_id": 60, "min_id": 10}),
+    ] == fetch_pages(db, session, since=True)
+    assert 50 == session.requests[0][1]["since_id"]
+
+
+def test_fetch_timeline_since_interrupted_keeps_saved_range(db):
+    save_range(db, 10, 1)
+    # Tweets 5-8 are never fetched, because the run fails on the second page
+    session = FakeSession(
+        [make_tweets([20, 15]), FakeResponse({"errors": [{"code": 130}]})]
+    )
+    with pytest.raises(Exception):
+        for tweet in utils.fetch_timeline(
+            session,
+            "timeline",
+            db,
+            sleep=0,
+            since=True,
+            since_type="user",
+            since_key="simonw",
+        ):
+            pass
+    assert [{"type": 1, "key": "simonw", "since_id": 10, "min_id": 1}] == list(
+        db["since_ids"].rows
+    )
+    # So a plain refresh goes back to fill in the gap
+    session = FakeSession([make_tweets([20, 15]), make_tweets([8, 5])])
+    tweets = utils.fetch_timeline(
+        session, "timeline", db, sleep=0, since_type="user", since_key="simonw"
+    )
+    assert [20, 15, 8, 5] == [tweet["id"] for tweet in tweets]
+    assert [{"type": 1, "key": "simonw", "since_id": 20, "min_id": 1}] == list(
+        db["since_ids"].rows
+    )
+
+
+def test_fetch_timeline_since_id_without_saved_range(db):
+    session = FakeSession([make_tweets([60, 55]), []])
+    assert [
+        ([60, 55], None),
+        ([], {"type": 1, "key": "simonw", "since_id": 60, "min_id": 55}),
+    ] == fetch_pages(db, session, since_id="50")
+    assert "50" == session.requests[0][1]["since_id"]
+
+
+def test_fetch_user_timeline_since_id_on_empty_db(db):
+    session = FakeSession([make_tweets([60]), []])
+    tweets = list(utils.fetch_user_timeline(session, db, screen_name="x", since_id=50))
+    assert [60] == [t["id"] for t in tweets]
+    assert [{"type": 1, "key": "x", "since_id": 60, "min_id": 60}] == list(
+        db["since_ids"].rows
+    )
+
+
+@pytest.mark.parametrize(
+    "since_id,expected",
+    [
+        # Overlaps the saved range, so the two are joined up
+        ("30", {"type": 1, "key": "simonw", "since_id": 60, "min_id": 10}),
+        # Newer than the saved range: 31-54 were never fetched
+        ("54", {"type": 1, "key": "simonw", "since_id": 30, "min_id": 10}),
+    ],
+)
+def test_fetch_timeline_since_id_merges_only_overlapping_range(db, since_id, expected):
+    save_range(db, 30, 10)
+    session = FakeSession([make_tweets([60, 55]), []])
+    list(
+        utils.fetch_timeline(
+            session,
+            "timeline",
+            db,
+            sleep=0,
+            since_id=since_id,
+            since_type="user",
+            since_key="simonw",
+        )
+    )
+    assert [expected] == list(db["since_ids"].rows)
+
+
+def test_fetch_timeline_pages_since_and_backfill():
+    with pytest.raises(click.ClickException):
+        utils.timeline_args(None, since=True, backfill=True)
+
+
+def test_pipeline_fetches_on_another_thread():
+    threads = []
+
+    def pages():
+        for i in range(10):
+            threads.append(threading.current_thread())
+            yield i
+
+    assert list(range(10)) == list(utils.pipeline(pages(), queue_size=2))
+    assert {threading.current_thread()}.isdisjoint(threads)
+
+
+def test_pipeline_reraises_fetch_errors():
+    def pages():
+        yield 1
+        raise ValueError("Bad page")
+
+    results = []
+    with pytest.raises(ValueError):
+        for page in utils.pipeline(pages()):
+            results.append(page)
+    assert [1] == results
+
+
+def test_pipeline_stops_fetching_when_consumer_stops():
+    fetched = []
+
+    def pages():
+        for i in range(100):
+            fetched.append(i)
+            yield i
+
+    for page in utils.pipeline(pages(), queue_size=2):
+        break
+    # Only the pages that fitted in the queue were fetched
+    assert len(fetched) < 10
+
+
+def test_cli_user_timeline(tmpdir, monkeypatch):
+    tweets = json.load(open(pathlib.Path(__file__).parent / "tweets.json"))
+    profile = dict(tweets[0]["user"])
+    session = FakeSession([profile, tweets, []])
+    monkeypatch.setattr(utils, "session_for_auth", lambda auth: session)
+    monkeypatch.setattr(utils.time, "sleep", lambda seconds: None)
+    auth = str(tmpdir / "auth.json")
+    open(auth, "w").write("{}")
+    db_path = str(tmpdir / "twitter.db")
+    result = CliRunner().invoke(
+        cli.cli, ["user-timeline", db_path, "simonw", "-a", auth]
+    )
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    assert 5 == db["tweets"].count
+    assert [
+        {
+            "type": 1,
+            "key": "simonw",
+            "since_id": 1169246717864136700,
+            "min_id": 1168529001599533000,
+        }
+    ] == list(db["since_ids"].rows)
+
+
+def rate_limit_headers(remaining, reset, limit=900):
+    return {
+        "x-rate-limit-limit": str(limit),
+        "x-rate-limit-remaining": str(remaining),
+        "x-rate-limit-reset": str(reset),
+    }
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    "Fake time.time() and time.sleep(), recording the sleeps"
+
+    class Clock:
+        now = 1000.0
+        sleeps = []
+
+        def time(self):
+            return self.now
+
+        def sleep(self, seconds):
+            self.sleeps.append(seconds)
+            self.now += seconds
+
+    clock = Clock()
+    monkeypatch.setattr(utils.time, "time", clock.time)
+    monkeypatch.setattr(utils.time, "sleep", clock.sleep)
+    return clock
+
+
+def test_api_get_only_sleeps_when_budget_is_exhausted(clock):
+    session = FakeSession(
+        [
+            FakeResponse([], headers=rate_limit_headers(1, 1100)),
+            FakeResponse([], headers=rate_limit_headers(0, 1100)),
+            FakeResponse([], headers=rate_limit_headers(899, 1900)),
+        ]
+    )
+    url = "https://api.twitter.com/1.1/users/lookup.json"
+    utils.api_get(session, url)
+    utils.api_get(session, url)
+    assert [] == clock.sleeps
+    assert {"limit": 900, "remaining": 0, "reset": 1100} == utils.rate_limiter(
+        session
+    ).budget("/1.1/users/lookup.json")
+    # Next call waits until the window resets, plus the margin
+    utils.api_get(session, url)
+    assert [101] == clock.sleeps
+
+
+def test_rate_limiter_try_acquire_does_not_wait(clock):
+    limiter = utils.RateLimiter()
+    limiter.update("/1.1/users/lookup.json", rate_limit_headers(1, 1100))
+    assert limiter.try_acquire("/1.1/users/lookup.json")
+    assert not limiter.try_acquire("/1.1/users/lookup.json")
+    assert 101 == limiter.wait_time("/1.1/users/lookup.json")
+    clock.now = 1101
+    assert limiter.try_acquire("/1.1/users/lookup.json")
+    assert [] == clock.sleeps
+
+
+def test_api_get_budgets_are_per_endpoint(clock):
+    session = FakeSession(
+        [
+            FakeResponse([], headers=rate_limit_headers(0, 1100)),
+            FakeResponse([], headers=rate_limit_headers(10, 1100)),
+        ]
+    )
+    utils.api_get(session, "https://api.twitter.com/1.1/followers/list.json")
+    utils.api_get(session, "https://api.twitter.com/1.1/users/lookup.json")
+    assert [] == clock.sleeps
+
+
+def test_api_get_retries_429(clock):
+    session = FakeSession(
+        [
+            FakeResponse({}, status_code=429, headers=rate_limit_headers(0, 1050)),
+            FakeResponse({"ok": True}),
+        ]
+    )
+    response = utils.api_get(session, "https://api.twitter.com/1.1/lists/list.json")
+    assert {"ok": True} == response.json()
+    assert [51] == clock.sleeps
+    assert 2 == len(session.requests)
+
+
+def test_fetch_timeline_pages_waits_for_reset_on_error_88(db, clock):
+    session = FakeSession(
+        [
+            FakeResponse(
+                {"errors": [{"code": 88, "message": "Rate limit exceeded"}]},
+                headers=rate_limit_headers(0, 1200),
+            ),
+            make_tweets([2, 1]),
+            [],
+        ]
+    )
+    pages = utils.fetch_timeline_pages(
+        session,
+        "https://api.twitter.com/1.1/statuses/user_timeline.json",
+        db,
+        since_type="user",
+        since_key="simonw",
+    )
+    assert [[2, 1]] == [[t["id"] for t in tweets] for tweets, _ in pages]
+    assert [201] == clock.sleeps
+
+
+def make_pool(*responses):
+    sessions = {str(i): FakeSession(r) for i, r in enumerate(responses)}
+    pool = utils.SessionPool(
+        [(name, {"name": name}) for name in sessions],
+        session_factory=lambda auth: sessions[auth["name"]],
+    )
+    return pool, sessions
+
+
+def test_session_pool_uses_credential_with_most_budget(clock):
+    url = "https://api.twitter.com/1.1/users/lookup.json"
+    pool, sessions = make_pool(
+        [FakeResponse([], headers=rate_limit_headers(1, 1100))],
+        [FakeResponse([], headers=rate_limit_headers(10, 1100))] * 3,
+    )
+    for i in range(4):
+        utils.api_get(pool, url)
+    # First call goes to "0", then "1" as its budget is unknown, then the
+    # calls follow whichever has the most remaining
+    assert 1 == len(sessions["0"].requests)
+    assert 3 == len(sessions["1"].requests)
+    assert [] == clock.sleeps
+
+
+def test_session_pool_parks_rate_limited_credentials(clock):
+    url = "https://api.twitter.com/1.1/users/lookup.json"
+    pool, sessions = make_pool(
+        [FakeResponse({}, status_code=429, headers=rate_limit_headers(0, 1900))],
+        [FakeResponse({"ok": True}, headers=rate_limit_headers(5, 1100))] * 2,
+    )
+    assert {"ok": True} == utils.api_get(pool, url).json()
+    assert {"ok": True} == utils.api_get(pool, url).json()
+    assert 1 == len(sessions["0"].requests)
+    assert [] == clock.sleeps
+    assert [
+        {"name": "0", "requests": 1, "rate_limited": 1, "revoked": False},
+        {"name": "1", "requests": 2, "rate_limited": 0, "revoked": False},
+    ] == pool.stats()
+
+
+def test_session_pool_waits_when_all_credentials_are_parked(clock):
+    url = "https://api.twitter.com/1.1/users/lookup.json"
+    pool, sessions = make_pool(
+        [FakeResponse([], headers=rate_limit_headers(0, 1300))],
+        [
+            FakeResponse([], headers=rate_limit_headers(0, 1100)),
+            FakeResponse({"ok": True}),
+        ],
+    )
+    utils.api_get(pool, url)
+    utils.api_get(pool, url)
+    assert {"ok": True} == utils.api_get(pool, url).json()
+    # Waited for the earliest reset, which was credential "1"
+    assert [101] == clock.sleeps
+
+
+def test_session_pool_drops_revoked_credentials(clock):
+    url = "https://api.twitter.com/1.1/users/lookup.json"
+    pool, sessions = make_pool(
+        [FakeResponse({"errors": [{"code": 89}]}, status_code=401)],
+        [FakeResponse({"ok": True})] * 2,
+    )
+    assert {"ok": True} == utils.api_get(pool, url).json()
+    assert {"ok": True} == utils.api_get(pool, url).json()
+    assert 1 == len(sessions["0"].requests)
+    assert pool.stats()[0]["revoked"]
+
+
+def test_session_pool_keeps_credentials_on_protected_401(clock):
+    url = "https://api.twitter.com/1.1/statuses/user_timeline.json"
+    protected = {
+        "request": "/1.1/statuses/user_timeline.json",
+        "error": "Not authorized.",
+    }
+    pool, sessions = make_pool(
+        [FakeResponse(protected, status_code=401), FakeResponse({"ok": True})],
+        [FakeResponse({"ok": True})],
+    )
+    assert 401 == utils.api_get(pool, url).status_code
+    assert {"ok": True} == utils.api_get(pool, url).json()
+    assert [False, False] == [c["revoked"] for c in pool.stats()]
+
+
+def test_fetch_timeline_pages_error_88_parks_pooled_credential(db, clock):
+    url = "https://api.twitter.com/1.1/statuses/user_timeline.json"
+    pool, sessions = make_pool(
+        [
+            FakeResponse(
+                {"errors": [{"code": 88, "message": "Rate limit exceeded"}]},
+                headers=rate_limit_headers(3, 1200),
+            )
+        ],
+        [FakeResponse(make_tweets([2, 1])), FakeResponse([])],
+    )
+    pages = utils.fetch_timeline_pages(
+        pool, url, db, since_type="user", since_key="simonw"
+    )
+    assert [[2, 1]] == [[t["id"] for t in tweets] for tweets, _ in pages]
+    # Retried straight away using the other credential
+    assert 1 == len(sessions["0"].requests)
+    assert [] == clock.sleeps
+    assert [1, 0] == [c["rate_limited"] for c in pool.stats()]
+
+
+def test_session_pool_all_credentials_revoked(clock):
+    url = "https://api.twitter.com/1.1/users/lookup.json"
+    pool, sessions = make_pool(
+        [FakeResponse({"errors": [{"code": 89}]}, status_code=401)]
+    )
+    assert 401 == utils.api_get(pool, url).status_code
+    with pytest.raises(click.ClickException):
+        utils.api_get(pool, url)
+    with pytest.raises(click.ClickException):
+        pool.post("https://stream.twitter.com/1.1/statuses/filter.json")
+
+
+def test_load_auths_from_directory_and_files(tmpdir):
+    auth_dir = tmpdir.mkdir("auths")
+    for name in ("b", "a"):
+        (auth_dir / "{}.json".format(name)).write(json.dumps({"name": name}))
+    (tmpdir / "c.json").write(json.dumps({"name": "c"}))
+    auths = utils.load_auths([str(auth_dir), str(tmpdir / "c.json")])
+    assert ["a", "b", "c"] == [auth["name"] for _, auth in auths]
+
+
+def test_cli_fetch_with_auth_directory(tmpdir, monkeypatch, clock):
+    sessions = {
+        "a": FakeSession([FakeResponse({"errors": [{"code": 89}]}, 401)]),
+        "b": FakeSession([{"id": 1}]),
+    }
+    monkeypatch.setattr(utils, "session_for_auth", lambda auth: sessions[auth["name"]])
+    auth_dir = tmpdir.mkdir("auths")
+    for name in sessions:
+        (auth_dir / "{}.json".format(name)).write(json.dumps({"name": name}))
+    result = CliRunner().invoke(
+        cli.cli,
+        ["fetch", "https://api.twitter.com/1.1/users/show.json", "-a", str(auth_dir)],
+    )
+    assert 0 == result.exit_code, result.output
+    assert {"id": 1} == json.loads(result.stdout)
+    assert (
+        "{}: 1 requests, 0 rate limited, revoked\n"
+        "{}: 1 requests, 0 rate limited\n".format(
+            auth_dir / "a.json", auth_dir / "b.json"
+        )
+    ) == result.stderr
+
+
+def test_pipeline_many_interleaves_but_keeps_order():
+    def generator(name):
+        for i in range(20):
+            yield "{}-{}".format(name, i)
+
+    generators = [generator(name) for name in ("a", "b", "c")]
+    items = list(utils.pipeline_many(generators, concurrency=3))
+    assert 60 == len(items)
+    for name in ("a", "b", "c"):
+        assert ["{}-{}".format(name, i) for i in range(20)] == [
+            item for item in items if item.startswith(name)
+        ]
+
+
+PROFILE = json.load(open(pathlib.Path(__file__).parent / "tweets.json"))[0]["user"]
+
+
+class TimelineSession:
+    "Serves users/show and paged user_timeline responses for several users"
+
+    def __init__(self, timelines):
+        self.timelines = timelines
+        self.threads = set()
+
+    def get(self, url, params=None):
+        self.threads.add(threading.get_ident())
+        time.sleep(0.01)
+        params = dict(params or {})
+        if "?" in url:
+            url, query = url.split("?")
+            params.update(urllib.parse.parse_qsl(query))
+        screen_name = params["screen_name"]
+        tweet_ids = self.timelines[screen_name]
+        user = dict(
+            PROFILE,
+            id=100 + sorted(self.timelines).index(screen_name),
+            screen_name=screen_name,
+            statuses_count=len(tweet_ids),
+        )
+        if url.endswith("users/show.json"):
+            return FakeResponse(user)
+        max_id = params.get("max_id")
+        page = [id for id in tweet_ids if max_id is None or id <= max_id][:2]
+        return FakeResponse(
+            [
+                {
+                    "id": id,
+                    "full_text": "",
+                    "entities": {},
+                    "source": '<a href="https://example.com" rel="nofollow">Web</a>',
+                    "created_at": "Mon Sep 16 01:03:17 +0000 2019",
+                    "user": user,
+                }
+                for id in page
+            ]
+        )
+
+
+def test_cli_user_timeline_concurrency(tmpdir, monkeypatch):
+    timelines = {
+        "a": [19, 15, 12, 10, 2],
+        "b": [18, 14, 9],
+        "c": [17, 5, 3, 1],
+    }
+    session = TimelineSession(timelines)
+    monkeypatch.setattr(utils, "session_for_auth", lambda auth: session)
+    auth = str(tmpdir / "auth.json")
+    open(auth, "w").write("{}")
+    db_path = str(tmpdir / "twitter.db")
+    result = CliRunner().invoke(
+        cli.cli,
+        ["user-timeline", db_path, "a", "b", "c", "-a", auth, "--concurrency", "3"],
+    )
+    assert 0 == result.exit_code, result.output
+    db = sqlite_utils.Database(db_path)
+    assert {"a", "b", "c"} == {u["screen_name"] for u in db["users"].rows}
+    assert sorted(sum(timelines.values(), [])) == sorted(
+        r["id"] for r in db["tweets"].rows
+    )
+    assert [
+        {"type": 1, "key": "a", "since_id": 19, "min_id": 2},
+        {"type": 1, "key": "b", "since_id": 18, "min_id": 9},
+        {"type": 1, "key": "c", "since_id": 17, "min_id": 1},
+    ] == list(db["since_ids"].rows_where(order_by="key"))
+    assert len(session.threads) > 1
+
+
+class FollowersSession:
+    "Generates pages of 200 followers as they are requested"
+
+    def __init__(self, num_pages):
+        self.num_pages = num_pages
+
+    def get(self, url, params=None):
+        params = dict(params or {})
+        params.update(urllib.parse.parse_qsl(urllib.parse.urlparse(url).query))
+        if url.startswith("https://api.twitter.com/1.1/users/show.json"):
+            return FakeResponse(dict(PROFILE, followers_count=200 * self.num_pages))
+        page = max(int(params["cursor"]), 1)
+        users = [
+            dict(PROFILE, id=page * 1000 + i, screen_name="user{}".format(i))
+            for i in range(200)
+        ]
+        next_cursor = page + 1 if page < self.num_pages else 0
+        return FakeResponse({"users": users, "next_cursor": next_cursor})
+
+
+def followers_peak_memory(tmpdir, monkeypatch, num_pages):
+    monkeypatch.setattr(
+        utils, "session_for_auth", lambda auth: FollowersSession(num_pages)
+    )
+    auth = str(tmpdir / "auth.json")
+    open(auth, "w").write("{}")
+    db_path = str(tmpdir / "followers-{}.db".format(num_pages))
+    tracemalloc.start()
+    try:
+        result = CliRunner().invoke(
+            cli.cli, ["followers", db_path, "simonw", "-a", auth, "--silent"]
+        )
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert 0 == result.exit_code, result.output
+    assert 200 * num_pages + 1 == sqlite_utils.Database(db_path)["users"].count
+    return peak
+
+
+def test_followers_memory_does_not_grow_with_pages(tmpdir, monkeypatch):
+    small = followers_peak_memory(tmpdir, monkeypatch, 4)
+    large = followers_peak_memory(tmpdir, monkeypatch, 24)
+    # Holding on to every user would make this around six times larger
+    assert large < small * 1.5
+
+
+class FlakySession(FakeSession):
+    "FakeSession that raises an error once it runs out of responses"
+
+    def get(self, url, params=None):
+        if not self.responses:
+            raise ConnectionError("Connection reset")
+        return super().get(url, params)
+
+
+def test_cli_followers_ids_resume(tmpdir, monkeypatch):
+    profile = dict(PROFILE, id=1, screen_name="simonw")
+    session = FlakySession(
+        [
+            profile,
+            {"ids": [101, 102], "next_cursor": 2},
+            {"ids": [103, 104], "next_cursor": 3},
+        ]
+    )
+    monkeypatch.setattr(utils, "session_for_auth", lambda auth: session)
+    auth = str(tmpdir / "auth.json")
+    open(auth, "w").write("{}")
+    db_path = str(tmpdir / "twitter.db")
+    result = CliRunner().invoke(
+        cli.cli, ["followers-ids", db_path, "simonw", "-a", auth]
+    )
+    assert isinstance(result.exception, ConnectionError)
+    db = sqlite_utils.Database(db_path)
+    assert [{"endpoint": "/1.1/followers/ids.json", "key": "id:1", "cursor": 3}] == [
+        {k: v for k, v in row.items() if k != "updated"}
+        for row in db["cursor_checkpoints"].rows
+    ]
+    # --resume carries on from the saved cursor
+    session.responses = [profile, {"ids": [105], "next_cursor": 0}]
+    session.requests = []
+    result = CliRunner().invoke(
+        cli.cli, ["followers-ids", db_path, "simonw", "-a", auth, "--resume"]
+    )
+    assert 0 == result.exit_code, result.output
+    assert 3 == session.requests[1][1]["cursor"]
+    assert [101, 102, 103, 104, 105] == [
+        r["follower_id"] for r in db["following"].rows_where(order_by="follower_id")
+    ]
+    # Finished, so the checkpoint is removed
+    assert 0 == db["cursor_checkpoints"].count
+
+
+def test_fetch_user_list_pages_resume(db):
+    utils.save_cursor_checkpoint(
+        db,
+        {"endpoint": "/1.1/friends/list.json", "key": "id:1", "cursor": 55},
+    )
+    session = FakeSession([{"users": [], "next_cursor": 0}])
+    pages = utils.fetch_user_list_pages(
+        session, user_id=1, noun="friends", db=db, resume=True
+    )
+    assert [
+        ([], {"endpoint": "/1.1/friends/list.json", "key": "id:1", "cursor": 0})
+    ] == list(pages)
+    assert 55 == session.requests[0][1]["cursor"]
+
+
+def test_stale_user_ids(db):
+    db["following"].insert_all(
+        [
+            {"followed_id": 1, "follower_id": 2},
+            {"followed_id": 1, "follower_id": 3},
+        ]
+    )
+    db["list_members"].insert({"list": 10, "user": 4})
+    db["favorited_by"].insert({"tweet": 20, "user": 5})
+    utils.save_users(db, [dict(PROFILE, id=id) for id in (1, 2, 4)])
+    db["user_fetches"].update(2, {"fetched": "2000-01-01T00:00:00+00:00"})
+    db["user_fetches"].delete(4)
+    assert [3, 5] == utils.stale_user_ids(db)
+    assert [2, 3, 4, 5] == utils.stale_user_ids(db, datetime.timedelta(days=7))
+    # Tombstoned users are skipped until the ttl has passed
+    utils.save_user_tombstones(db, [3])
+    db["user_tombstones"].insert(
+        {"id": 5, "checked": "2000-01-01T00:00:00+00:00"}, replace=True
+    )
+    assert [] == utils.stale_user_ids(db)
+    assert [2, 4, 5] == utils.stale_user_ids(db, datetime.timedelta(days=7))
+
+
+class UsersLookupSession:
+    "Serves users/lookup, recording the IDs requested"
+
+    def __init__(self, missing=()):
+        self.requested = []
+        self.missing = set(missing)
+        self.lock = threading.Lock()
+
+    def get(self, url, params=None):
+        ids = [int(id) for id in params["user_id"].split(",")]
+        with self.lock:
+            self.requested.append(ids)
+        users = [
+            dict(PROFILE, id=id, screen_name="user{}".format(id))
+            for id in ids
+            if id not in self.missing
+        ]
+        if not users:
+            return FakeResponse(
+                {"errors": [{"code": 17, "message": "No user matches."}]}, 404
+            )
+        return FakeResponse(users)
+
+
+def test_cli_hydrate_users(tmpdir, monkeypatch):
+    session = UsersLookupSession()
+    monkeypatch.setattr(utils, "session_for_auth", lambda auth: session)
+    auth = str(tmpdir / "auth.json")
+    open(auth, "w").write("{}")
+    db_path = str(tmpdir / "twitter.db")
+    db = sqlite_utils.Database(db_path)
+    utils.ensure_tables(db)
+    db["following"].insert_all(
+        {"followed_id": 1, "follower_id": id} for id in range(2, 202)
+    )
+    args = ["hydrate-users", db_path, "-a", auth, "--silent"]
+    result = CliRunner().invoke(cli.cli, args)
+    assert 0 == result.exit_code, result.output
+    assert [70, 70, 61] == sorted(len(ids) for ids in session.requested)[::-1]
+    assert list(range(1, 202)) == [
+        r["id"] for r in db["users"].rows_where(order_by="id")
+    ]
+    assert 201 == db["user_fetches"].count
+    # Everything is fresh, so a second run fetches nothing
+    session.requested = []
+    result = CliRunner().invoke(cli.cli, args + ["--ttl", "1"])
+    assert 0 == result.exit_code, result.output
+    assert [] == session.requested
+
+
+def test_cli_hydrate_users_tombstones_missing_users(tmpdir, monkeypatch):
+    # 3-72 are all missing, so that batch gets a "No user matches" error
+    session = UsersLookupSession(missing=list(range(3, 73)) + [80])
+    monkeypatch.setattr(utils, "session_for_auth", lambda auth: session)
+    auth = str(tmpdir / "auth.json")
+    open(auth, "w").write("{}")
+    db_path = str(tmpdir / "twitter.db")
+    db = sqlite_utils.Database(db_path)
+    utils.ensure_tables(db)
+    db["following"].insert_all(
+        {"followed_id": 1, "follower_id": id} for id in range(2, 100)
+    )
+    args = ["hydrate-users", db_path, "-a", auth, "--silent"]
+    result = CliRunner().invoke(cli.cli, args)
+    assert 0 == result.exit_code, result.output
+    assert [1, 2] + [id for id in range(73, 100) if id != 80] == [
+        r["id"] for r in db["users"].rows_where(order_by="id")
+    ]
+    assert list(range(3, 73)) + [80] == [
+        r["id"] for r in db["user_tombstones"].rows_where(order_by="id")
+    ]
+    # The missing users are not requested again
+    session.requested = []
+    result = CliRunner().invoke(cli.cli, args)
+    assert 0 == result.exit_code, result.output
+    assert [] == session.requested
+
+
+class StatusesLookupSession:
+    "Serves statuses/lookup for the tweets in tweets, recording the IDs requested"
+
+    def __init__(self, tweets):
+        self.tweets = {tweet["id"]: tweet for tweet in tweets}
+        self.requested = []
+
+    def get(self, url, params=None):
+        ids = [int(id) for id in params["id"].split(",")]
+        self.requested.append(ids)
+        return FakeResponse([self.tweets[id] for id in ids if id in self.tweets])
+
+
+def reply(id, in_reply_to_status_id=None):
+    return {
+        "id": id,
+        "full_text": "Reply {}".format(id),
+        "entities": {},
+        "source": '<a href="https://example.com" rel="nofollow">Web</a>',
+        "created_at": "Mon Sep 16 01:03:17 +0000 2019",
+        "in_reply_to_status_id": in_reply_to_status_id,
+        "user": dict(PROFILE),
+    }
+
+
+def test_cli_backfill_references(tmpdir, monkeypatch):
+    # 5 replies to 4, which replies to 3, which replies to 2 - deleted.
+    # 6 replies to 1, and 8 quotes 7 - protected
+    session = StatusesLookupSession([reply(4, 3), reply(3, 2), reply(1)])
+    monkeypatch.setattr(utils, "session_for_auth", lambda auth: session)
+    auth = str(tmpdir / "auth.json")
+    open(auth, "w").write("{}")
+    db_path = str(tmpdir / "twitter.db")
+    db = sqlite_utils.Database(db_path)
+    utils.save_tweets(db, [reply(5, 4), reply(6, 1), reply(8)])
+    db["tweets"].update(8, {"quoted_status": 7})
+    args = ["backfill-references", db_path, "-a", auth, "--silent"]
+    result = CliRunner().invoke(cli.cli, args + ["--depth", "2"])
+    assert 0 == result.exit_code, result.output
+    assert [[1, 4, 7], [3]] == session.requested
+    assert [1, 3, 4, 5, 6, 8] == [
+        r["id"] for r in db["tweets"].rows_where(order_by="id")
+    ]
+    assert [7] == [r["id"] for r in db["tweet_tombstones"].rows]
+    # Carries on from where depth 2 stopped, and does not retry tombstones
+    result = CliRunner().invoke(cli.cli, args + ["--depth", "5"])
+    assert 0 == result.exit_code, result.output
+    assert [[1, 4, 7], [3], [2]] == session.requested
+    assert [2, 7] == [r["id"] for r in db["tweet_tombstones"].rows_where(order_by="id")]
+
+
+def test_cli_backfill_references_text_columns(tmpdir, monkeypatch):
+    session = StatusesLookupSession([reply(4)])
+    monkeypatch.setattr(utils, "session_for_auth", lambda auth: session)
+    auth = str(tmpdir / "auth.json")
+    open(auth, "w").write("{}")
+    db_path = str(tmpdir / "twitter.db")
+    db = sqlite_utils.Database(db_path)
+    # As created by versions that stored these references as TEXT
+    db["tweets"].insert(
+        {"id": 5, "in_reply_to_status_id": "4", "quoted_status": "4"}, pk="id"
+    )
+    assert [4] == utils.dangling_tweet_ids(db)
+    args = ["backfill-references", db_path, "-a", auth, "--silent"]
+    result = CliRunner().invoke(cli.cli, args)
+    assert 0 == result.exit_code, result.output
+    assert [4, 5] == [r["id"] for r in db["tweets"].rows_where(order_by="id")]
+    assert [] == list(db["tweet_tombstones"].rows)
+
+
+def test_cli_backfill_references_error_response(tmpdir, monkeypatch):
+    session = FakeSession([{"errors": [{"code": 32, "message": "Bad auth"}]}])
+    monkeypatch.setattr(utils, "session_for_auth", lambda auth: session)
+    auth = str(tmpdir / "auth.json")
+    open(auth, "w").write("{}")
+    db_path = str(tmpdir / "twitter.db")
+    db = sqlite_utils.Database(db_path)
+    utils.save_tweets(db, [reply(5, 4)])
+    result = CliRunner().invoke(
+        cli.cli, ["backfill-references", db_path, "-a", auth, "--silent"]
+    )
+    assert 1 == result.exit_code
+    assert "Bad auth" in result.output
+    assert [] == list(db["tweet_tombstones"].rows)
+
+
+def test_cli_search_records_runs_only_when_something_is_saved(tmpdir, monkeypatch):
+    auth = str(tmpdir / "auth.json")
+    open(auth, "w").write("{}")
+    db_path = str(tmpdir / "twitter.db")
+
+    def search(responses, *args):
+        session = FakeSession(responses)
+        monkeypatch.setattr(utils, "session_for_auth", lambda auth: session)
+        result = CliRunner().invoke(
+            cli.cli, ["search", db_path, "dogsheep", "-a", auth] + list(args)
+        )
+        assert 0 == result.exit_code, result.output
+
+    search([{"statuses": [reply(5), reply(4)]}, {"statuses": []}])
+    db = sqlite_utils.Database(db_path)
+    checkpoint = list(db["since_ids"].rows)[0]
+    assert 1 == db["search_runs"].count
+    # Nothing new
+    search([{"statuses": []}], "--since")
+    # A last page holding only the checkpoint that is already saved
+    monkeypatch.setattr(
+        utils, "fetch_timeline_pages", lambda *args, **kwargs: iter([([], checkpoint)])
+    )
+    search([])
+    assert 1 == db["search_runs"].count
+    assert 2 == db["search_runs_tweets"].count
+
+
+def test_missing_tweet_ids(db):
+    utils.save_tweets(db, [reply(2), reply(4)])
+    # In the order given, as statuses-lookup fetches them in that order
+    assert [5, 3, 3, 1] == utils.missing_tweet_ids(
+        db, ["5", "4", "3", "3", "2", "1"], batch_size=2
+    )
+    # The temporary table is dropped again afterwards
+    assert [] == db.conn.execute("select name from temp.sqlite_master").fetchall()
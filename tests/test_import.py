@@ -4,7 +4,7 @@ import pathlib
 import pytest
 import sqlite_utils
 from click.testing import CliRunner
-from twitter_to_sqlite import cli
+from twitter_to_sqlite import archive, cli
 
 from .utils import create_zip
 
@@ -70,6 +70,118 @@ def test_cli_import_specific_files(tmpdir, zip_contents_path):
     assert ["archive_follower", "archive_following"] == db.table_names()
 
 
+@pytest.mark.parametrize("chunk_size", [1, 7, 1024])
+def test_iter_json_array(chunk_size):
+    items = [
+        {"tweet": {"id": "1", "full_text": "Brackets ] and commas , \u00e9 \u2603"}},
+        [1, 2, {"nested": ["[", "]"]}],
+        12345,
+        "string",
+        None,
+    ]
+    content = "window.YTD.tweet.part0 = [ {} ]\n".format(
+        " ,\n ".join(archive.json.dumps(item, ensure_ascii=False) for item in items)
+    ).encode("utf8")
+    fp = io.BytesIO(content)
+    assert items == list(archive.iter_json_array(fp, chunk_size=chunk_size))
+
+
+@pytest.mark.parametrize(
+    "content,expected",
+    [(b"[]", []), (b"window.YTD.like.part0 = [ ]", []), (b"\xef\xbb\xbf[1]", [1])],
+)
+def test_iter_json_array_empty_and_bom(content, expected):
+    assert expected == list(archive.iter_json_array(io.BytesIO(content)))
+
+
+@pytest.mark.parametrize(
+    "content", [b"window.YTD.like.part0 = [ {", b"[1 2]", b"alert(1); [1]", b""]
+)
+def test_iter_json_array_invalid(content):
+    with pytest.raises(ValueError):
+        list(archive.iter_json_array(io.BytesIO(content), chunk_size=4))
+
+
+def test_iter_json_array_invalid_item_raises_before_eof():
+    content = b"[" + b", ".join([b'{"ok": 1}', b'{"bad" 2}'] + [b"[3]"] * 1000) + b"]"
+    fp = io.BytesIO(content)
+    with pytest.raises(ValueError) as e:
+        list(archive.iter_json_array(fp, chunk_size=64))
+    assert "Invalid JSON array item" in str(e.value)
+    assert fp.tell() < len(content)
+
+
+@pytest.mark.parametrize("chunk_size", range(1, 12))
+def test_iter_json_array_numbers_split_across_chunks(chunk_size):
+    fp = io.BytesIO(b"[1.5, 2e3, -4E-2, 10]")
+    assert [1.5, 2000.0, -0.04, 10] == list(
+        archive.iter_json_array(fp, chunk_size=chunk_size)
+    )
+
+
+@pytest.mark.parametrize(
+    "content,message",
+    [
+        (b"[1, tru]", "Invalid"),
+        (b'[1, {"a" 2}]', "Invalid"),
+        (b'[1, {"a": ', "Truncated"),
+        (b'[1, "abc', "Truncated"),
+    ],
+)
+def test_iter_json_array_invalid_or_truncated_at_end(content, message):
+    with pytest.raises(ValueError) as e:
+        list(archive.iter_json_array(io.BytesIO(content)))
+    assert str(e.value).startswith(message)
+
+
+def test_import_from_fp_keeps_existing_table_on_bad_file(tmpdir):
+    def like_js(ids, tail=b" ]"):
+        likes = ", ".join(
+            archive.json.dumps({"like": {"tweetId": str(id), "fullText": "like"}})
+            for id in ids
+        )
+        return b"window.YTD.like.part0 = [ " + likes.encode("utf8") + tail
+
+    db = sqlite_utils.Database(str(tmpdir / "output.db"))
+    archive.import_from_fp(db, "like.js", io.BytesIO(like_js(range(5))))
+    bad = like_js(range(10, 15), tail=b', {"like": ')
+    with pytest.raises(ValueError):
+        archive.import_from_fp(db, "like.js", io.BytesIO(bad), batch_size=2)
+    assert ["0", "1", "2", "3", "4"] == [
+        r["tweetId"] for r in db["archive_like"].rows_where(order_by="tweetId")
+    ]
+    assert ["archive_like"] == db.table_names()
+    # A good file still replaces it
+    archive.import_from_fp(db, "like.js", io.BytesIO(like_js([20])), batch_size=2)
+    assert ["20"] == [r["tweetId"] for r in db["archive_like"].rows]
+
+
+def test_import_from_fp_inserts_in_batches(tmpdir):
+    content = "window.YTD.like.part0 = [ {} ]".format(
+        ", ".join(
+            archive.json.dumps({"like": like})
+            for like in [
+                {"tweetId": "1", "fullText": "one"},
+                {"tweetId": "2", "fullText": "two"},
+                # Columns missing from the first batch are added
+                {"tweetId": "3", "fullText": "three", "expandedUrl": "https://x"},
+            ]
+        )
+    ).encode("utf8")
+    db = sqlite_utils.Database(str(tmpdir / "output.db"))
+    statements = []
+    db.conn.set_trace_callback(statements.append)
+    archive.import_from_fp(db, "like.js", io.BytesIO(content), batch_size=2)
+    db.conn.set_trace_callback(None)
+    # One INSERT for each batch of 2
+    assert 2 == len([s for s in statements if s.startswith("INSERT")])
+    assert [
+        {"tweetId": "1", "fullText": "one", "expandedUrl": None},
+        {"tweetId": "2", "fullText": "two", "expandedUrl": None},
+        {"tweetId": "3", "fullText": "three", "expandedUrl": "https://x"},
+    ] == list(db["archive_like"].rows)
+
+
 def assert_imported_db(db):
     assert {
         "archive_follower",
@@ -0,0 +1,135 @@
+import gzip
+import io
+import json
+import pathlib
+
+import pytest
+import sqlite_utils
+from click.testing import CliRunner
+from twitter_to_sqlite import cli, ingest, utils
+
+TWEETS_PATH = pathlib.Path(__file__).parent / "tweets.json"
+TWEETS = json.loads(TWEETS_PATH.read_text())
+
+
+@pytest.fixture
+def expected():
+    db = sqlite_utils.Database(memory=True)
+    utils.save_tweets(db, json.loads(json.dumps(TWEETS)))
+    return db
+
+
+def jsonl(items):
+    return b"".join(json.dumps(item).encode("utf8") + b"\n\n" for item in items)
+
+
+def assert_same_tweets(expected, db):
+    for table in ("tweets", "sources", "media", "media_tweets"):
+        assert list(expected[table].rows) == list(db[table].rows), table
+
+
+def ingest_cli(args, **kwargs):
+    result = CliRunner().invoke(cli.cli, ["ingest"] + args, **kwargs)
+    assert 0 == result.exit_code, result.output
+    return result
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_ingest_jsonl_gzip(tmpdir, expected, processes):
+    path = str(tmpdir / "stream.jsonl.gz")
+    with gzip.open(path, "wb") as fp:
+        fp.write(jsonl(TWEETS + [{"delete": {"status": {"id": 1}}}]))
+    db_path = str(tmpdir / "twitter.db")
+    result = ingest_cli(
+        [db_path, path, "--batch-size", "2", "--processes", str(processes)]
+    )
+    assert_same_tweets(expected, sqlite_utils.Database(db_path))
+    assert result.stderr.startswith(
+        "Saved {} tweets and 0 users from 1 file (".format(len(TWEETS))
+    )
+    assert result.stderr.strip().endswith("skipped 1 other objects")
+
+
+def test_ingest_json_documents_and_stdin(tmpdir, expected):
+    users_path = str(tmpdir / "followers.json")
+    users = [dict(TWEETS[0]["user"], id=id) for id in (1, 2)]
+    open(users_path, "w").write(
+        json.dumps({"users": users, "next_cursor": 0}, indent=2)
+    )
+    db_path = str(tmpdir / "twitter.db")
+    # tweets.json is a pretty-printed JSON array
+    ingest_cli([db_path, users_path, "-"], input=TWEETS_PATH.read_bytes())
+    db = sqlite_utils.Database(db_path)
+    assert_same_tweets(expected, db)
+    assert {1, 2} <= {row["id"] for row in db["users"].rows}
+
+
+def test_ingest_zstd(tmpdir, expected):
+    zstandard = pytest.importorskip("zstandard")
+    path = str(tmpdir / "stream.jsonl.zst")
+    open(path, "wb").write(zstandard.ZstdCompressor().compress(jsonl(TWEETS)))
+    db = sqlite_utils.Database(memory=True)
+    stats = ingest.ingest_paths(db, [path])
+    assert len(TWEETS) == stats["tweets"]
+    assert_same_tweets(expected, db)
+
+
+def test_payload_objects():
+    tweet = {"id": 1, "text": "", "user": {}}
+    assert [tweet, tweet, tweet] == list(
+        ingest.payload_objects([tweet, {"statuses": [tweet]}, [tweet]])
+    )
+
+
+@pytest.mark.parametrize("processes", [1, 2])
+def test_ingest_counts_invalid_lines(tmpdir, processes):
+    path = str(tmpdir / "stream.jsonl")
+    open(path, "wb").write(jsonl(TWEETS[:1]) + b'{"id": 12\n' + jsonl(TWEETS[1:]))
+    db_path = str(tmpdir / "twitter.db")
+    result = ingest_cli(
+        [db_path, path, "--batch-size", "1", "--processes", str(processes)]
+    )
+    assert result.stderr.strip().endswith("skipped 1 invalid line")
+    ids = {row["id"] for row in sqlite_utils.Database(db_path)["tweets"].rows}
+    assert {tweet["id"] for tweet in TWEETS} <= ids
+
+
+@pytest.mark.parametrize("bad_line", [b'{"id": 12\n', b"not json\n"])
+def test_ingest_counts_invalid_first_line(tmpdir, bad_line):
+    path = str(tmpdir / "stream.jsonl")
+    open(path, "wb").write(bad_line + jsonl(TWEETS))
+    db_path = str(tmpdir / "twitter.db")
+    result = ingest_cli([db_path, path])
+    assert result.stderr.strip().endswith("skipped 1 invalid line")
+    ids = {row["id"] for row in sqlite_utils.Database(db_path)["tweets"].rows}
+    assert {tweet["id"] for tweet in TWEETS} <= ids
+
+
+def test_read_batches_does_not_read_whole_file_for_bad_first_line():
+    fp = io.BytesIO(b'{"id": 12\n' + jsonl(TWEETS) * 100)
+    batches = ingest.read_batches(fp, 2)
+    num_bytes, batch = next(batches)
+    assert [b'{"id": 12\n', jsonl(TWEETS[:1]).strip() + b"\n"] == batch
+    assert fp.tell() < len(fp.getvalue()) / 2
+
+
+def test_ingest_invalid_document(tmpdir):
+    path = str(tmpdir / "broken.json")
+    open(path, "w").write('{\n  "id": 1,\n')
+    result = CliRunner().invoke(cli.cli, ["ingest", str(tmpdir / "twitter.db"), path])
+    assert 1 == result.exit_code
+    assert "broken.json: not valid JSON or JSONL" in result.stderr
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        json.dumps(TWEETS, indent=2).encode("utf8"),
+        json.dumps(TWEETS).encode("utf8") + b"\n",
+    ],
+)
+def test_read_batches_splits_json_arrays(content):
+    batches = list(ingest.read_batches(io.BytesIO(content), 2))
+    assert [2, 1] == [len(batch) for _, batch in batches]
+    assert [t["id"] for t in TWEETS] == [t["id"] for _, b in batches for t in b]
+    assert len(content) == sum(num_bytes for num_bytes, _ in batches)
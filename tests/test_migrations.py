@@ -53,3 +53,18 @@ def test_convert_source_column():
 def test_convert_source_column_against_real_database(db):
     assert "migrations" not in db.table_names()
     migrations.convert_source_column(db)
+
+
+def test_add_since_ids_min_id():
+    db = sqlite_utils.Database(memory=True)
+    db["since_id_types"].insert_all(
+        [{"id": 1, "name": "user"}, {"id": 2, "name": "home"}], pk="id"
+    )
+    db["since_ids"].insert(
+        {"type": 1, "key": "simonw", "since_id": 5}, pk=("type", "key")
+    )
+    migrations.add_since_ids_min_id(db)
+    assert [{"type": 1, "key": "simonw", "since_id": 5, "min_id": None}] == list(
+        db["since_ids"].rows
+    )
+    assert "favorites" in {r["name"] for r in db["since_id_types"].rows}
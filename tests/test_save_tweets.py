@@ -2,6 +2,7 @@ import json
 import pathlib
 
 import pytest
+from dateutil import parser
 import sqlite_utils
 from twitter_to_sqlite import utils
 
@@ -39,6 +40,10 @@ def test_tables(db):
         "media_tweets",
         "since_id_types",
         "since_ids",
+        "cursor_checkpoints",
+        "user_fetches",
+        "tweet_tombstones",
+        "user_tombstones",
         "count_history_types",
         "count_history",
     } == set(db.table_names())
@@ -95,6 +100,8 @@ def test_users(db):
             "follow_request_sent": 0,
             "notifications": 0,
             "translator_type": "regular",
+            "withheld_in_countries": None,
+            "withheld_scope": None,
         },
         {
             "id": 14148390,
@@ -137,6 +144,8 @@ def test_users(db):
             "follow_request_sent": 0,
             "notifications": 0,
             "translator_type": "none",
+            "withheld_in_countries": None,
+            "withheld_scope": None,
         },
         {
             "id": 22737278,
@@ -179,6 +188,8 @@ def test_users(db):
             "follow_request_sent": 0,
             "notifications": 0,
             "translator_type": "none",
+            "withheld_in_countries": None,
+            "withheld_scope": None,
         },
     ] == user_rows
 
@@ -210,6 +221,15 @@ def test_tweets(db):
             "retweeted": 0,
             "possibly_sensitive": 0,
             "lang": "en",
+            "quote_count": None,
+            "reply_count": None,
+            "text": None,
+            "filter_level": None,
+            "timestamp_ms": None,
+            "metadata": None,
+            "withheld_copyright": None,
+            "withheld_in_countries": None,
+            "withheld_scope": None,
         },
         {
             "id": 1168529001599533000,
@@ -235,6 +255,15 @@ def test_tweets(db):
             "retweeted": 0,
             "possibly_sensitive": 0,
             "lang": "en",
+            "quote_count": None,
+            "reply_count": None,
+            "text": None,
+            "filter_level": None,
+            "timestamp_ms": None,
+            "metadata": None,
+            "withheld_copyright": None,
+            "withheld_in_countries": None,
+            "withheld_scope": None,
         },
         {
             "id": 1169196446043664400,
@@ -247,8 +276,8 @@ def test_tweets(db):
             "source": None,
             "truncated": 0,
             "display_text_range": "[45, 262]",
-            "in_reply_to_status_id": "1169079390577320000",
-            "in_reply_to_user_id": "82016165",
+            "in_reply_to_status_id": 1169079390577320000,
+            "in_reply_to_user_id": 82016165,
             "in_reply_to_screen_name": "scientiffic",
             "geo": None,
             "coordinates": None,
@@ -260,6 +289,15 @@ def test_tweets(db):
             "retweeted": 0,
             "possibly_sensitive": 0,
             "lang": "en",
+            "quote_count": None,
+            "reply_count": None,
+            "text": None,
+            "filter_level": None,
+            "timestamp_ms": None,
+            "metadata": None,
+            "withheld_copyright": None,
+            "withheld_in_countries": None,
+            "withheld_scope": None,
         },
         {
             "id": 1169242008432644000,
@@ -285,6 +323,15 @@ def test_tweets(db):
             "retweeted": 1,
             "possibly_sensitive": 0,
             "lang": "en",
+            "quote_count": None,
+            "reply_count": None,
+            "text": None,
+            "filter_level": None,
+            "timestamp_ms": None,
+            "metadata": None,
+            "withheld_copyright": None,
+            "withheld_in_countries": None,
+            "withheld_scope": None,
         },
         {
             "id": 1169246717864136700,
@@ -310,6 +357,15 @@ def test_tweets(db):
             "retweeted": 1,
             "possibly_sensitive": None,
             "lang": "en",
+            "quote_count": None,
+            "reply_count": None,
+            "text": None,
+            "filter_level": None,
+            "timestamp_ms": None,
+            "metadata": None,
+            "withheld_copyright": None,
+            "withheld_in_countries": None,
+            "withheld_scope": None,
         },
     ] == tweet_rows
 
@@ -373,8 +429,212 @@ def test_media(db):
             "expanded_url": "https://twitter.com/UpturnedBathtub/status/504727120812453889/photo/1",
             "type": "photo",
             "sizes": '{"thumb": {"w": 150, "h": 150, "resize": "crop"}, "large": {"w": 1024, "h": 768, "resize": "fit"}, "medium": {"w": 1024, "h": 768, "resize": "fit"}, "small": {"w": 680, "h": 510, "resize": "fit"}}',
+            "original_info": None,
+            "video_info": None,
+            "additional_media_info": None,
+            "ext_alt_text": None,
+            "source_status_id": None,
+            "source_status_id_str": None,
+            "source_user_id": None,
+            "source_user_id_str": None,
         }
     ] == media_rows
     assert [
         {"media_id": 504727051174031360, "tweets_id": 1169196446043664400}
     ] == media_tweets_rows
+
+
+def test_favorited_by(tweets):
+    db = sqlite_utils.Database(memory=True)
+    utils.save_tweets(db, tweets, favorited_by=12497)
+    assert [
+        {"tweet": 1169246717864136700, "user": 12497},
+        {"tweet": 1169196446043664400, "user": 12497},
+        {"tweet": 1168529001599533000, "user": 12497},
+    ] == list(db["favorited_by"].rows)
+
+
+def test_count_history_once_per_user_per_batch(db):
+    # simonw appears on two tweets in the fixture but only gets one row per type
+    assert [
+        (1, 22737278, 132789),
+        (2, 22737278, 2723),
+        (3, 22737278, 4644),
+        (1, 12497, 17754),
+        (2, 12497, 3460),
+        (3, 12497, 1230),
+        (1, 14148390, 4300),
+        (2, 14148390, 639),
+        (3, 14148390, 235),
+    ] == db.conn.execute("select type, user, count from count_history").fetchall()
+
+
+def test_ensure_tables_uses_schema_cache(db):
+    utils.ensure_tables(db)
+    # Schema is unchanged, so the second call should not query the catalog
+    statements = []
+    db.conn.set_trace_callback(statements.append)
+    utils.ensure_tables(db)
+    db.conn.set_trace_callback(None)
+    assert ["PRAGMA schema_version"] == statements
+
+
+def test_schema_state_invalidated_on_schema_change(db):
+    state = utils.schema_state(db)
+    assert "new_table" not in state.table_names()
+    assert "extra" not in state.columns("places")
+    db["new_table"].create({"id": int})
+    db["places"].add_column("extra", str)
+    assert "new_table" in state.table_names()
+    assert "extra" in state.columns("places")
+
+
+def test_latest_user_counts(db):
+    db["count_history"].insert(
+        {"type": 1, "user": 12497, "datetime": "2099-01-01T00:00:00+00:00", "count": 5}
+    )
+    assert {
+        (1, 12497): 5,
+        (2, 12497): 3460,
+        (3, 12497): 1230,
+    } == utils.latest_user_counts(db, [12497, 404])
+
+
+def test_user_count_rows_only_changed_counts(db):
+    user = dict(db["users"].get(12497), followers_count=17755)
+    rows = utils.user_count_rows(db, [user])
+    assert [(1, 12497, 17755)] == [(r["type"], r["user"], r["count"]) for r in rows]
+
+
+@pytest.mark.parametrize(
+    "s",
+    [
+        "Wed Oct 10 20:19:24 +0000 2018",
+        "Mon Feb 29 00:00:01 -0530 2016",
+        "Sun Dec 31 23:59:59 +1400 2017",
+        # Not Twitter's format, so these fall back to dateutil
+        "2019-09-04T13:51:55+00:00",
+        "2019-09-04 13:51:55",
+    ],
+)
+def test_parse_datetime(s):
+    expected = parser.parse(s)
+    actual = utils.parse_datetime(s)
+    assert expected == actual
+    assert expected.isoformat() == actual.isoformat()
+
+
+def test_expand_entities_uses_indices():
+    s = "a https://t.co/1 b https://t.co/1 c"
+    entities = {
+        "urls": [
+            {
+                "url": "https://t.co/1",
+                "expanded_url": "https://one/",
+                "indices": [2, 16],
+            },
+            {
+                "url": "https://t.co/1",
+                "expanded_url": "https://two/",
+                "indices": [19, 33],
+            },
+        ],
+        "hashtags": [{"text": "b", "indices": [17, 18]}],
+    }
+    assert "a https://one/ b https://two/ c" == utils.expand_entities(s, entities)
+
+
+def test_expand_entities_without_indices():
+    entities = {"urls": [{"url": "https://t.co/1", "expanded_url": "https://one/"}]}
+    assert "a https://one/" == utils.expand_entities("a https://t.co/1", entities)
+
+
+@pytest.mark.parametrize("use_orjson", [True, False])
+def test_json_loads(monkeypatch, use_orjson):
+    if not use_orjson:
+        monkeypatch.setattr(utils, "orjson", None)
+    elif utils.orjson is None:
+        pytest.skip("orjson is not installed")
+    assert {"id": 1169246717864136700, "a": [1.5, None]} == utils.json_loads(
+        b'{"id": 1169246717864136700, "a": [1.5, null]}'
+    )
+    # NaN is not valid JSON but the json module accepts it
+    assert [1] == utils.json_loads("[1, NaN]")[:1]
+
+
+def test_save_tweets_writes_each_batch(tweets):
+    db = sqlite_utils.Database(memory=True)
+    saved = []
+
+    def generate():
+        for tweet in tweets:
+            yield tweet
+            saved.append(db["tweets"].count if db["tweets"].exists() else 0)
+
+    utils.save_tweets(db, generate(), batch_size=1)
+    # Each tweet (plus its quoted/retweeted tweet) is written before the
+    # generator is asked for the next one
+    assert [2, 3, 5] == saved
+
+
+def test_ensure_tables_adds_canonical_columns_to_existing_tables():
+    db = sqlite_utils.Database(memory=True)
+    db["places"].create({"id": str}, pk="id")
+    utils.ensure_tables(db)
+    assert list(utils.PLACES_COLUMNS) == list(db["places"].columns_dict)
+
+
+def test_unknown_keys_are_added_as_columns(db):
+    tweet = json.load(open(pathlib.Path(__file__).parent / "tweets.json"))[1]
+    tweet["brand_new_field"] = 5
+    statements = []
+    db.conn.set_trace_callback(statements.append)
+    utils.save_tweets(db, [tweet])
+    db.conn.set_trace_callback(None)
+    assert db["tweets"].columns_dict["brand_new_field"] is int
+    assert 5 == db["tweets"].get(tweet["id"])["brand_new_field"]
+    assert 1 == len([s for s in statements if s.startswith("ALTER TABLE")])
+
+
+def test_media_written_once_per_save_tweets_call(tweets):
+    db = sqlite_utils.Database(memory=True)
+    tweet = [t for t in tweets if t.get("extended_entities")][0]
+    # The same photo on the tweet and on a retweet of it, in separate batches
+    retweet = json.loads(json.dumps(tweet))
+    retweet["id"] += 1
+    statements = []
+    db.conn.set_trace_callback(statements.append)
+    utils.save_tweets(db, [tweet, retweet], batch_size=1)
+    db.conn.set_trace_callback(None)
+    media_inserts = [s for s in statements if "INTO [media]" in s]
+    assert 1 == len(media_inserts)
+    assert 2 == db["media_tweets"].count
+
+
+def test_media_rewritten_by_later_save_tweets_call(tweets):
+    db = sqlite_utils.Database(memory=True)
+    tweet = [t for t in tweets if t.get("extended_entities")][0]
+    utils.save_tweets(db, [json.loads(json.dumps(tweet))])
+    changed = json.loads(json.dumps(tweet))
+    changed["extended_entities"]["media"][0]["display_url"] = "pic.twitter.com/new"
+    utils.save_tweets(db, [changed])
+    assert ["pic.twitter.com/new"] == [r["display_url"] for r in db["media"].rows]
+
+
+def test_write_rows_stores_datetimes_as_iso_strings(monkeypatch):
+    # sqlite-utils 2.4.2's jsonify_if_needed() leaves datetimes alone
+    monkeypatch.setattr(
+        utils,
+        "jsonify_if_needed",
+        lambda value: json.dumps(value) if isinstance(value, (dict, list)) else value,
+    )
+    db = sqlite_utils.Database(memory=True)
+    rows = [
+        {"id": 1, "created_at": utils.parse_datetime("Wed Oct 10 20:19:24 +0000 2018")},
+        {"id": 2, "created_at": utils.parse_datetime("Sun Dec 31 23:59:59 +1400 2017")},
+    ]
+    utils.write_rows(db, "users", rows, pk="id")
+    assert [
+        (1, "2018-10-10T20:19:24+00:00"),
+        (2, "2017-12-31T23:59:59+14:00"),
+    ] == db.execute("select id, created_at from users order by id").fetchall()
@@ -0,0 +1,471 @@
+import http.server
+import json
+import pathlib
+import sqlite3
+import threading
+import time
+from unittest import mock
+
+import pytest
+import requests
+import sqlite_utils
+from click.testing import CliRunner
+from twitter_to_sqlite import cli, utils
+
+from .utils import ThreadingHTTPServer
+
+
+def tweet(id):
+    return {"id": id, "created_at": "Mon Sep 16 01:03:17 +0000 2019", "text": "Hi"}
+
+
+class FakeStreamServer:
+    "Serves a fake statuses/filter stream, one scripted behaviour per connection"
+
+    def __init__(self, script):
+        self.script = list(script)
+        self.requests = []
+        self.done = threading.Event()
+        server = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                server.requests.append(self.path)
+                server.script.pop(0)(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = "http://127.0.0.1:{}/1.1/statuses/filter.json".format(
+            self.server.server_address[1]
+        )
+
+
+def status(code):
+    def respond(handler):
+        handler.send_response(code)
+        handler.send_header("content-length", "0")
+        handler.end_headers()
+
+    return respond
+
+
+def hang_up(handler):
+    handler.close_connection = True
+
+
+def stream(*parts, then=None):
+    "Stream parts as chunks - tweets, keep-alive blank lines or a pause"
+
+    def respond(handler):
+        handler.send_response(200)
+        handler.send_header("transfer-encoding", "chunked")
+        handler.end_headers()
+        for part in parts:
+            if isinstance(part, float):
+                threading.Event().wait(part)
+                continue
+            data = b"\r\n" if part is None else json.dumps(part).encode() + b"\r\n"
+            handler.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        if then is not None:
+            then.wait(5)
+        handler.wfile.write(b"0\r\n\r\n")
+        handler.close_connection = True
+
+    return respond
+
+
+@pytest.fixture
+def server():
+    servers = []
+
+    def start(script):
+        server = FakeStreamServer(script)
+        threading.Thread(target=server.server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.done.set()
+        server.server.shutdown()
+
+
+def test_stream_connection_reconnects_with_backoff(server, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(utils.time, "sleep", sleeps.append)
+    done = threading.Event()
+    api = server(
+        [
+            status(420),
+            status(503),
+            # Two tweets and a keep-alive, then silence until the stall timeout
+            stream(tweet(1), None, tweet(2), 1.0),
+            # Closed by Twitter
+            stream(tweet(3)),
+            hang_up,
+            hang_up,
+            stream(tweet(4), tweet(5), then=done),
+        ]
+    )
+    connection = utils.StreamConnection(
+        requests.Session(), api.url, {"track": "kakapo"}, stall_timeout=0.3
+    )
+    tweets = utils.stream_tweets(connection)
+    try:
+        assert [1, 2, 3, 4, 5] == [next(tweets)["id"] for _ in range(5)]
+    finally:
+        tweets.close()
+        done.set()
+    # 420 and other HTTP errors back off exponentially, from 1 minute and 5
+    # seconds, network errors and stalls linearly by 250ms
+    assert [60, 5, 0.25, 0.25, 0.5, 0.75] == sleeps
+    assert "track=kakapo" in api.requests[0]
+    stats = connection.stats()
+    assert 6 == stats["reconnects"]
+    assert {"rate_limited": 1, "http": 1, "stall": 1, "network": 3} == stats[
+        "disconnects"
+    ]
+    assert 5 == stats["lines"]
+    # The stall left a gap of at least the stall timeout
+    assert stats["gap_seconds"] >= 0.3
+    assert stats["estimated_lost_lines"] >= 0
+    assert 0 < stats["uptime"] < 1
+
+
+def test_stream_connection_backoff_limits():
+    connection = utils.StreamConnection(None, None, {})
+    for _ in range(100):
+        connection.failed("network")
+    assert 16 == connection.backoff()
+    for _ in range(10):
+        connection.failed("http")
+    assert 320 == connection.backoff()
+    connection.failed("rate_limited")
+    connection.failed("rate_limited")
+    assert 120 == connection.backoff()
+
+
+def test_stream_connection_fatal_errors(server):
+    api = server([status(401)])
+    connection = utils.StreamConnection(requests.Session(), api.url, {})
+    with pytest.raises(utils.TwitterApiError):
+        next(connection.lines())
+
+
+TWEETS = json.load(open(pathlib.Path(__file__).parent / "tweets.json"))
+
+
+def decoded_tweet(id):
+    "A tweet as it reaches GroupCommitWriter, after decoding"
+    return {
+        "id": id,
+        "full_text": "Tweet {}".format(id),
+        "entities": {},
+        "source": '<a href="https://example.com" rel="nofollow">Web</a>',
+        "created_at": "Mon Sep 16 01:03:17 +0000 2019",
+        "user": dict(TWEETS[0]["user"]),
+    }
+
+
+def test_group_commit_writer_flushes_full_batches(tmpdir):
+    db = sqlite_utils.Database(str(tmpdir / "twitter.db"))
+    writer = utils.GroupCommitWriter(db, batch_size=3, max_delay=60)
+    for id in range(1, 8):
+        writer.add(decoded_tweet(id))
+    assert 6 == db["tweets"].count
+    assert 0 < writer.time_left() <= 60
+    writer.flush()
+    assert 7 == db["tweets"].count
+    assert writer.time_left() is None
+    stats = writer.stats()
+    assert (7, 3, 3) == (stats["tweets"], stats["batches"], stats["largest_batch"])
+    assert 0 <= stats["latency_p50"] <= stats["latency_max"]
+
+
+def test_group_commit_writer_keeps_batch_that_fails_to_save(tmpdir, monkeypatch):
+    db = sqlite_utils.Database(str(tmpdir / "twitter.db"))
+    writer = utils.GroupCommitWriter(db, batch_size=100, max_delay=60)
+    for id in range(1, 4):
+        writer.add(decoded_tweet(id))
+    save_tweet_batches = utils.save_tweet_batches
+
+    def locked(db, batches, written_media=None):
+        raise sqlite3.OperationalError("database is locked")
+
+    monkeypatch.setattr(utils, "save_tweet_batches", locked)
+    with pytest.raises(sqlite3.OperationalError):
+        writer.flush()
+    assert 0 == db["tweets"].count
+    monkeypatch.setattr(utils, "save_tweet_batches", save_tweet_batches)
+    writer.add(decoded_tweet(4))
+    writer.flush()
+    assert [1, 2, 3, 4] == [r["id"] for r in db["tweets"].rows_where(order_by="id")]
+    assert (4, 2) == (writer.stats()["tweets"], writer.stats()["batches"])
+
+
+def test_save_streamed_tweets_bounds_queue(tmpdir):
+    db = sqlite_utils.Database(str(tmpdir / "twitter.db"))
+    writer = utils.GroupCommitWriter(db, batch_size=5, max_delay=60)
+    produced = []
+    read_ahead = []
+
+    def stream():
+        for id in range(1, 21):
+            produced.append(id)
+            yield decoded_tweet(id)
+
+    def on_tweet(tweet):
+        if not read_ahead:
+            # A slow database, while the reader thread keeps reading
+            time.sleep(0.3)
+            read_ahead.append(len(produced))
+
+    utils.save_streamed_tweets(writer, stream(), on_tweet=on_tweet, queue_size=2)
+    # One being saved, two in the queue and one waiting to be queued
+    assert [4] == read_ahead
+    assert 20 == db["tweets"].count
+
+
+def test_save_streamed_tweets_flushes_after_max_delay(tmpdir):
+    db_path = str(tmpdir / "twitter.db")
+    writer = utils.GroupCommitWriter(
+        sqlite_utils.Database(db_path), batch_size=100, max_delay=0.05
+    )
+    saved_counts = []
+
+    def stream():
+        yield decoded_tweet(1)
+        yield decoded_tweet(2)
+        time.sleep(0.3)
+        # Runs on the reader thread, so it needs its own connection
+        saved_counts.append(sqlite_utils.Database(db_path)["tweets"].count)
+        yield decoded_tweet(3)
+        raise ConnectionError("Stream disconnected")
+
+    with pytest.raises(ConnectionError):
+        utils.save_streamed_tweets(writer, stream())
+    # The first two were saved while the stream was quiet, the third on error
+    assert [2] == saved_counts
+    assert 3 == sqlite_utils.Database(db_path)["tweets"].count
+    assert 2 == writer.stats()["batches"]
+
+
+def test_save_streamed_tweets_flushes_backlog_after_max_delay(tmpdir):
+    db = sqlite_utils.Database(str(tmpdir / "twitter.db"))
+    writer = utils.GroupCommitWriter(db, batch_size=1000, max_delay=0.05)
+
+    def on_tweet(tweet):
+        # A slow database, so there are always more tweets waiting
+        time.sleep(0.01)
+
+    stream = (decoded_tweet(id) for id in range(1, 41))
+    utils.save_streamed_tweets(writer, stream, on_tweet=on_tweet, queue_size=100)
+    stats = writer.stats()
+    assert 40 == stats["tweets"]
+    # About 5 tweets arrive within max_delay, rather than all 40 in one batch
+    assert stats["largest_batch"] <= 20
+
+
+class StreamSession:
+    "Streams lines once, then fails to reconnect"
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def post(self, url, **kwargs):
+        if self.lines is None:
+            raise RuntimeError("No more connections")
+        lines, self.lines = self.lines, None
+        return mock.Mock(status_code=200, iter_lines=lambda chunk_size: iter(lines))
+
+
+def test_cli_track_group_commits(tmpdir, monkeypatch):
+    lines = [
+        json.dumps(dict(decoded_tweet(id), text="")).encode("utf8") for id in range(5)
+    ]
+    session = StreamSession(lines)
+    monkeypatch.setattr(utils, "session_for_auth", lambda auth: session)
+    monkeypatch.setattr(utils.time, "sleep", lambda seconds: None)
+    auth = str(tmpdir / "auth.json")
+    open(auth, "w").write("{}")
+    db_path = str(tmpdir / "twitter.db")
+    result = CliRunner().invoke(
+        cli.cli, ["track", db_path, "dogsheep", "-a", auth, "--batch-size", "2"]
+    )
+    assert isinstance(result.exception, RuntimeError)
+    assert 5 == sqlite_utils.Database(db_path)["tweets"].count
+    connection_stats, commit_stats = result.stderr.splitlines()
+    assert "1 reconnect (1 network)" in connection_stats
+    assert commit_stats.startswith(
+        "Saved 5 tweets in 3 batches, mean batch size 1.7, largest 2,"
+    )
+
+
+def test_save_streamed_lines_matches_save_tweets(tmpdir):
+    tweets = TWEETS
+    lines = [json.dumps(t).encode("utf8") for t in tweets]
+    lines.insert(1, b"")
+    lines.insert(2, json.dumps({"limit": {"track": 5}}).encode("utf8"))
+    expected = sqlite_utils.Database(memory=True)
+    utils.save_tweets(expected, json.loads(json.dumps(tweets)))
+    db = sqlite_utils.Database(str(tmpdir / "twitter.db"))
+    writer = utils.GroupCommitWriter(db, batch_size=2, max_delay=60)
+    utils.save_streamed_lines(writer, iter(lines), processes=2)
+    for table in ("tweets", "users", "sources", "media", "media_tweets", "places"):
+        assert list(expected[table].rows) == list(db[table].rows), table
+    assert len(tweets) == writer.stats()["tweets"]
+
+
+def test_save_streamed_lines_reraises_stream_errors(tmpdir):
+    def lines():
+        yield json.dumps(TWEETS[0]).encode("utf8")
+        raise ConnectionError("Stream disconnected")
+
+    db = sqlite_utils.Database(str(tmpdir / "twitter.db"))
+    writer = utils.GroupCommitWriter(db, batch_size=100, max_delay=60)
+    with pytest.raises(ConnectionError):
+        utils.save_streamed_lines(writer, lines(), processes=2)
+    # The buffered tweet was saved first
+    assert TWEETS[0]["id"] in [r["id"] for r in db["tweets"].rows]
+
+
+def test_save_streamed_lines_saves_interrupted_batch(tmpdir, monkeypatch):
+    db = sqlite_utils.Database(str(tmpdir / "twitter.db"))
+    writer = utils.GroupCommitWriter(db, batch_size=100, max_delay=60)
+    save_collected = writer.save_collected
+    calls = []
+
+    def interrupted(*args):
+        calls.append(args)
+        if len(calls) == 1:
+            raise KeyboardInterrupt
+        save_collected(*args)
+
+    monkeypatch.setattr(writer, "save_collected", interrupted)
+    lines = [json.dumps(t).encode("utf8") for t in TWEETS]
+    with pytest.raises(KeyboardInterrupt):
+        utils.save_streamed_lines(writer, iter(lines), processes=2)
+    # Saved again after the interrupt, rather than dropped
+    assert 2 == len(calls)
+    assert {t["id"] for t in TWEETS} <= {r["id"] for r in db["tweets"].rows}
+    assert [] == writer.unsaved
+
+
+def test_save_streamed_lines_bounds_queue(tmpdir):
+    db = sqlite_utils.Database(str(tmpdir / "twitter.db"))
+    writer = utils.GroupCommitWriter(db, batch_size=1, max_delay=60)
+    produced = []
+
+    def lines():
+        for i in range(50):
+            produced.append(i)
+            yield json.dumps(TWEETS[0]).encode("utf8")
+
+    save_collected = writer.save_collected
+    read_ahead = []
+
+    def slow(*args):
+        if not read_ahead:
+            time.sleep(0.5)
+            read_ahead.append(len(produced))
+        save_collected(*args)
+
+    writer.save_collected = slow
+    utils.save_streamed_lines(writer, lines(), processes=2, queue_size=2)
+    # One being saved, five groups in the pool, two lines queued, one being
+    # grouped and one waiting to be queued
+    assert read_ahead[0] <= 10
+    assert 50 == writer.stats()["tweets"]
+
+
+def test_stream_journal_rotates_and_resumes_from_offset(tmpdir):
+    journal = utils.StreamJournal(str(tmpdir), segment_size=20)
+    for i in range(10):
+        journal.append(b"line %d" % i)
+    # Each segment is full after three 7 byte lines
+    assert [0, 1, 2, 3] == journal.segments()
+    assert {"bytes": 70, "segments": 4} == journal.lag()
+    lines, offset = journal.read(4, max_delay=0)
+    assert [b"line 0", b"line 1", b"line 2", b"line 3"] == lines
+    assert (1, 7) == offset
+    journal.commit(offset)
+    assert [1, 2, 3] == journal.segments()
+    assert {"bytes": 42, "segments": 3} == journal.lag()
+    # Read but never committed, as if the process died before saving them
+    assert 4 == len(journal.read(4, max_delay=0)[0])
+    journal.close()
+    journal = utils.StreamJournal(str(tmpdir), segment_size=20)
+    lines, offset = journal.read(100, max_delay=0, timeout=0)
+    assert [b"line %d" % i for i in range(4, 10)] == lines
+    journal.append(b"line 10")
+    assert ([b"line 10"], (3, 15)) == journal.read(100, max_delay=0, timeout=0)
+
+
+def test_stream_journal_read_waits_for_lines(tmpdir):
+    journal = utils.StreamJournal(str(tmpdir))
+    assert ([], (0, 0)) == journal.read(10, max_delay=0, timeout=0.01)
+    timer = threading.Timer(0.05, journal.append, [b"late"])
+    timer.start()
+    assert [b"late"] == journal.read(10, max_delay=0, timeout=5)[0]
+
+
+def test_save_journaled_lines_recovers_unsaved_lines(tmpdir):
+    db = sqlite_utils.Database(str(tmpdir / "twitter.db"))
+    journal = utils.StreamJournal(str(tmpdir / "journal"))
+    # Journaled by a run that died before saving anything
+    journal.append(json.dumps(TWEETS[0]).encode("utf8"))
+    journal.close()
+    journal = utils.StreamJournal(str(tmpdir / "journal"))
+    writer = utils.GroupCommitWriter(db, batch_size=2, max_delay=0.01)
+    lags = []
+    utils.save_journaled_lines(
+        writer,
+        journal,
+        iter([json.dumps(t).encode("utf8") for t in TWEETS[1:]]),
+        on_lag=lags.append,
+        lag_interval=0,
+    )
+    expected = sqlite_utils.Database(memory=True)
+    utils.save_tweets(expected, json.loads(json.dumps(TWEETS)))
+    assert list(expected["tweets"].rows) == list(db["tweets"].rows)
+    assert 0 == journal.lag()["bytes"]
+    assert lags and all("bytes" in lag for lag in lags)
+
+
+def test_stream_journal_truncates_torn_last_line(tmpdir):
+    db = sqlite_utils.Database(str(tmpdir / "twitter.db"))
+    journal = utils.StreamJournal(str(tmpdir / "journal"))
+    journal.append(json.dumps(TWEETS[0]).encode("utf8"))
+    journal.close()
+    # The process died part way through appending the next line
+    torn = json.dumps(TWEETS[1]).encode("utf8")[:30]
+    with open(str(tmpdir / "journal" / "000000000000.jsonl"), "ab") as fp:
+        fp.write(torn)
+    journal = utils.StreamJournal(str(tmpdir / "journal"))
+    assert len(torn) == journal.truncated
+    writer = utils.GroupCommitWriter(db, batch_size=10, max_delay=0.01)
+    utils.save_journaled_lines(
+        writer, journal, iter([json.dumps(t).encode("utf8") for t in TWEETS[1:]])
+    )
+    expected = sqlite_utils.Database(memory=True)
+    utils.save_tweets(expected, json.loads(json.dumps(TWEETS)))
+    assert list(expected["tweets"].rows) == list(db["tweets"].rows)
+    assert 0 == journal.skipped
+    assert 0 == journal.lag()["bytes"]
+
+
+def test_save_journaled_lines_skips_undecodable_lines(tmpdir):
+    db = sqlite_utils.Database(str(tmpdir / "twitter.db"))
+    journal = utils.StreamJournal(str(tmpdir / "journal"))
+    writer = utils.GroupCommitWriter(db, batch_size=10, max_delay=0.01)
+    lines = [json.dumps(TWEETS[0]).encode("utf8"), b'{"id": 12']
+    lines.append(json.dumps(TWEETS[1]).encode("utf8"))
+    utils.save_journaled_lines(writer, journal, iter(lines))
+    assert 1 == journal.skipped
+    ids = {r[0] for r in db.conn.execute("select id from tweets")}
+    assert {TWEETS[0]["id"], TWEETS[1]["id"]} <= ids
+    assert 0 == journal.lag()["bytes"]
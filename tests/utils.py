@@ -1,4 +1,6 @@
+import http.server
 import io
+import socketserver
 import zipfile
 
 
@@ -10,3 +12,9 @@ def create_zip(path, buf=None):
         if filepath.is_file():
             zf.write(filepath, str(filepath.relative_to(path)))
     return zf
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    "http.server.ThreadingHTTPServer, which needs Python 3.7"
+
+    daemon_threads = True
@@ -1,5 +1,10 @@
 # Utilities for dealing with Twitter archives
+import codecs
+import io
 import json
+import re
+
+from .utils import chunks
 
 # Goal is to have a mapping of filename to a tuple with
 # (callable, pk=) triples, where the callable
@@ -7,6 +12,11 @@ import json
 # of tables that should be created {"tabe": [rows-to-upsert]}
 transformers = {}
 
+# Files that map one array item to one row, as (callable, pk=) pairs where the
+# callable takes a single item. These are imported without loading the whole
+# file into memory.
+item_transformers = {}
+
 # These files are deliberately ignored
 IGNORE = {"manifest"}
 
@@ -16,6 +26,7 @@ def register(filename, each, pk=None):
         return {filename: [item.get(each) for item in data]}
 
     transformers[filename] = (callback, pk)
+    item_transformers[filename] = (lambda item: item.get(each), pk)
 
 
 def register_each(filename, pk=None):
@@ -24,6 +35,7 @@ def register_each(filename, pk=None):
             return {filename: [fn(item) for item in data]}
 
         transformers[filename] = (callback, pk)
+        item_transformers[filename] = (fn, pk)
 
     return inner
 
@@ -42,12 +54,84 @@ def register_all(filename):
     return inner
 
 
-def extract_json(contents):
-    # window.YTD.account_creation_ip.part0 = [ ... data ...]
-    contents = contents.strip()
-    if contents.startswith(b"window."):
-        contents = contents.split(b" = ", 1)[1]
-    return json.loads(contents)
+WHITESPACE = re.compile(r"[ \t\n\r]*")
+# The longest token that can be cut short at the end of the buffer
+LONGEST_TOKEN = len("-Infinity")
+# Characters that can carry on a number, such as the ".5" of "1.5"
+NUMBER_TAIL = re.compile(r"[0-9.eE+-]*")
+
+
+def iter_json_array(fp, chunk_size=1024 * 1024):
+    """
+    Yields the items of the JSON array in binary file fp one at a time,
+    skipping any "window.YTD.... = " prefix. Only chunk_size bytes plus the
+    current item are held in memory.
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8-sig")()
+    buf, pos, eof = "", 0, False
+
+    def fill():
+        nonlocal buf, pos, eof
+        chunk = fp.read(chunk_size)
+        eof = not chunk
+        buf = buf[pos:] + text.decode(chunk, final=eof)
+        pos = 0
+
+    def next_char():
+        # Skips whitespace, returning the next character or "" at the end
+        nonlocal pos
+        while True:
+            pos = WHITESPACE.match(buf, pos).end()
+            if pos < len(buf) or eof:
+                return buf[pos : pos + 1]
+            fill()
+
+    while "[" not in buf and not eof:
+        fill()
+    start = buf.find("[")
+    prefix = buf[:start].strip() if start != -1 else buf.strip()
+    if start == -1 or (prefix and not prefix.startswith("window.")):
+        raise ValueError("Expected a JSON array, got {!r}".format(buf[:40]))
+    pos = start + 1
+    if next_char() == "]":
+        return
+    while True:
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+        except json.JSONDecodeError as e:
+            # Only an error at the end of the buffer can be fixed by reading
+            # more, otherwise the item is malformed
+            cut_short = e.msg.startswith("Unterminated string") or (
+                e.pos >= len(buf) - (0 if eof else LONGEST_TOKEN)
+            )
+            if eof or not cut_short:
+                raise ValueError(
+                    "{} JSON array item at: {!r}".format(
+                        "Truncated" if cut_short else "Invalid", buf[pos : pos + 40]
+                    )
+                )
+            fill()
+            continue
+        # A number that runs to the end of the buffer may be cut short, such
+        # as 1 from 1.5 or 1e5, so only accept it once something else follows
+        if (
+            not eof
+            and isinstance(item, (int, float))
+            and not isinstance(item, bool)
+            and NUMBER_TAIL.match(buf, end).end() == len(buf)
+        ):
+            fill()
+            continue
+        pos = end
+        yield item
+        separator = next_char()
+        pos += 1
+        if separator == "]":
+            return
+        if separator != ",":
+            raise ValueError("Expected , or ] but got {!r}".format(separator))
+        next_char()
 
 
 register("account-creation-ip", each="accountCreationIp")
@@ -227,6 +311,14 @@ def _list_from_common(data):
 
 
 def import_from_file(db, filename, content):
+    import_from_fp(db, filename, io.BytesIO(content))
+
+
+def import_from_fp(db, filename, fp, batch_size=1000):
+    """
+    Import the archive .js file open as binary file fp. Files with an item
+    transformer are parsed and inserted batch_size rows at a time.
+    """
     assert filename.endswith(".js"), "{} does not end with .js".format(filename)
     existing_tables = set(db.table_names())
     filename = filename[: -len(".js")]
@@ -234,15 +326,41 @@ def import_from_file(db, filename, content):
         if filename not in IGNORE:
             print("{}: not yet implemented".format(filename))
         return
-    transformer, pk = transformers.get(filename)
-    data = extract_json(content)
-    to_insert = transformer(data)
+    if filename in item_transformers:
+        fn, pk = item_transformers[filename]
+        rows = (fn(item) for item in iter_json_array(fp))
+        to_insert = {filename: rows}
+    else:
+        transformer, pk = transformers[filename]
+        to_insert = transformer(list(iter_json_array(fp)))
     for table, rows in to_insert.items():
         table_name = "archive_{}".format(table.replace("-", "_"))
-        # Drop and re-create if it already exists
+        # Move any existing table aside rather than dropping it, so that a
+        # file that fails partway through can put it back as it was
+        previous_table_name = "{}_previous".format(table_name)
+        if previous_table_name in existing_tables:
+            db[previous_table_name].drop()
         if table_name in existing_tables:
-            db[table_name].drop()
-        if pk is not None:
-            db[table_name].insert_all(rows, pk=pk, replace=True)
-        else:
-            db[table_name].insert_all(rows, hash_id="pk", replace=True)
+            rename_table(db, table_name, previous_table_name)
+        try:
+            for batch in chunks(rows, batch_size):
+                # Later batches can have keys the first one did not, hence alter
+                if pk is not None:
+                    db[table_name].insert_all(batch, pk=pk, replace=True, alter=True)
+                else:
+                    db[table_name].insert_all(
+                        batch, hash_id="pk", replace=True, alter=True
+                    )
+        except Exception:
+            if table_name in db.table_names():
+                db[table_name].drop()
+            if table_name in existing_tables:
+                rename_table(db, previous_table_name, table_name)
+            raise
+        if table_name in existing_tables:
+            db[previous_table_name].drop()
+
+
+def rename_table(db, name, new_name):
+    with db.conn:
+        db.conn.execute("alter table [{}] rename to [{}]".format(name, new_name))
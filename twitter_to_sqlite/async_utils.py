@@ -0,0 +1,237 @@
+"""
+asyncio versions of the fetch functions in utils.py, used by --async.
+
+These need aiohttp, which is installed by: pip install twitter-to-sqlite[async]
+"""
+
+import asyncio
+import collections
+import urllib.parse
+
+import click
+from oauthlib.oauth1 import Client
+
+from . import utils
+
+try:
+    import aiohttp
+    import yarl
+except ImportError:
+    aiohttp = None
+
+
+class Response:
+    "Just enough of requests.Response for utils.response_json() and friends"
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    def json(self):
+        return utils.json_loads(self.content)
+
+
+class AsyncSession:
+    """
+    An aiohttp session that signs its requests with OAuth1.
+
+    Connections are kept alive between requests, responses are requested
+    gzipped, and at most concurrency requests to any one endpoint run at
+    once. Rate limit headers are tracked in the same way as utils.api_get().
+    Use it with "async with".
+    """
+
+    def __init__(self, auth, concurrency=4):
+        if aiohttp is None:
+            raise click.ClickException(
+                "--async requires aiohttp: pip install twitter-to-sqlite[async]"
+            )
+        self.client = Client(
+            auth["api_key"],
+            client_secret=auth["api_secret_key"],
+            resource_owner_key=auth["access_token"],
+            resource_owner_secret=auth["access_token_secret"],
+        )
+        self.concurrency = concurrency
+        self.limiter = utils.RateLimiter()
+        self.semaphores = {}
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(headers={"Accept-Encoding": "gzip"})
+        return self
+
+    async def __aexit__(self, *args):
+        await self.session.close()
+
+    def semaphore(self, endpoint):
+        if endpoint not in self.semaphores:
+            self.semaphores[endpoint] = asyncio.Semaphore(self.concurrency)
+        return self.semaphores[endpoint]
+
+    async def get(self, url, params=None, max_retries=5):
+        if params:
+            url += ("&" if "?" in url else "?") + urllib.parse.urlencode(params)
+        endpoint = self.limiter.endpoint(url)
+        async with self.semaphore(endpoint):
+            for _ in range(max_retries):
+                # Other requests may use up the budget while this one waits,
+                # so keep waiting until a call is actually available
+                while not self.limiter.try_acquire(endpoint):
+                    await asyncio.sleep(self.limiter.wait_time(endpoint))
+                # Signed for each attempt, as the signature includes a timestamp
+                uri, headers, _ = self.client.sign(url)
+                # encoded=True stops the signed query string being re-quoted
+                async with self.session.get(
+                    yarl.URL(uri, encoded=True), headers=headers
+                ) as r:
+                    response = Response(r.status, r.headers, await r.read())
+                self.limiter.update(endpoint, response.headers)
+                if response.status_code != 429:
+                    break
+                self.limiter.exhausted(endpoint)
+        return response
+
+
+def run(coroutine):
+    "Run coroutine in a new event loop, like asyncio.run() in Python 3.7+"
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        asyncio.set_event_loop(None)
+        loop.close()
+
+
+async def in_order(coroutines, concurrency):
+    "Run coroutines, at most concurrency at a time, yielding results in order"
+    pending = collections.deque()
+    try:
+        for coroutine in coroutines:
+            pending.append(asyncio.ensure_future(coroutine))
+            if len(pending) >= concurrency:
+                yield await pending.popleft()
+        while pending:
+            yield await pending.popleft()
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def fetch_timeline(
+    session,
+    url,
+    db,
+    args=None,
+    stop_after=None,
+    key=None,
+    since_id=None,
+    since=False,
+    since_type=None,
+    since_key=None,
+    backfill=False,
+):
+    async for tweets, checkpoint in fetch_timeline_pages(
+        session,
+        url,
+        db,
+        args=args,
+        stop_after=stop_after,
+        key=key,
+        since_id=since_id,
+        since=since,
+        since_type=since_type,
+        since_key=since_key,
+        backfill=backfill,
+    ):
+        for tweet in tweets:
+            yield tweet
+        utils.save_checkpoint(db, checkpoint)
+
+
+async def fetch_timeline_pages(
+    session,
+    url,
+    db,
+    args=None,
+    stop_after=None,
+    key=None,
+    since_id=None,
+    since=False,
+    since_type=None,
+    since_key=None,
+    backfill=False,
+):
+    "Yields (tweets, checkpoint) pairs, like utils.fetch_timeline_pages()"
+    args, timeline_range = utils.timeline_args(
+        db, args, stop_after, since_id, since, since_type, since_key, backfill
+    )
+    num_rate_limit_errors = 0
+    while True:
+        tweets = utils.response_json(await session.get(url, params=args))
+        if "errors" in tweets:
+            if utils.RATE_LIMIT_ERROR_CODE == tweets["errors"][0]["code"]:
+                num_rate_limit_errors += 1
+                assert num_rate_limit_errors < 5, "More than 5 rate limit errors"
+                session.limiter.exhausted(session.limiter.endpoint(url))
+                continue
+            else:
+                raise Exception(str(tweets["errors"]))
+        if key is not None:
+            tweets = tweets[key]
+        if not tweets:
+            checkpoint = timeline_range.finished()
+            if checkpoint is not None:
+                yield [], checkpoint
+            break
+        args["max_id"] = min(t["id"] for t in tweets) - 1
+        checkpoint, reached_saved = timeline_range.page(tweets)
+        yield tweets, checkpoint
+        if stop_after is not None or reached_saved:
+            break
+
+
+async def fetch_user_batches(session, ids_or_screen_names, use_ids=False):
+    "Yields lists of up to 70 users, fetching several batches at once"
+    url = "https://api.twitter.com/1.1/users/lookup.json"
+
+    async def fetch(batch):
+        if use_ids:
+            args = {"user_id": ",".join(map(str, batch))}
+        else:
+            args = {"screen_name": ",".join(batch)}
+        return utils.response_json(await session.get(url, params=args))
+
+    batches = utils.chunks(ids_or_screen_names, 70)
+    async for users in in_order(map(fetch, batches), session.concurrency):
+        yield users
+
+
+async def fetch_status_batches(session, tweet_ids):
+    "Yields lists of up to 100 tweets, fetching several batches at once"
+    url = "https://api.twitter.com/1.1/statuses/lookup.json"
+
+    async def fetch(batch):
+        args = {"id": ",".join(map(str, batch)), "tweet_mode": "extended"}
+        return utils.response_json(await session.get(url, params=args))
+
+    batches = utils.chunks(tweet_ids, 100)
+    async for tweets in in_order(map(fetch, batches), session.concurrency):
+        yield tweets
+
+
+async def cursor_paginate(session, url, args, key, page_size=200):
+    "Execute cursor pagination, yielding 'key' for each page"
+    args = dict(args)
+    args["page_size"] = page_size
+    cursor = -1
+    while cursor:
+        args["cursor"] = cursor
+        r = await session.get(url, params=args)
+        utils.raise_if_error(r)
+        body = utils.response_json(r)
+        yield body[key]
+        cursor = body["next_cursor"]
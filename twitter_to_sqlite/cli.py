@@ -3,11 +3,14 @@ import hashlib
 import json
 import os
 import pathlib
-import time
+import signal
+import sys
 
 import click
 
 from twitter_to_sqlite import archive
+from twitter_to_sqlite import async_utils
+from twitter_to_sqlite import ingest
 from twitter_to_sqlite import utils
 
 
@@ -30,6 +33,85 @@ def add_identifier_options(subcommand):
     return subcommand
 
 
+def add_stream_options(subcommand):
+    for decorator in reversed(
+        (
+            click.option(
+                "--verbose", is_flag=True, help="Verbose mode: display every tweet"
+            ),
+            click.option(
+                "--batch-size",
+                type=int,
+                default=100,
+                help="Save buffered tweets once this many have arrived",
+            ),
+            click.option(
+                "--max-delay",
+                type=int,
+                default=500,
+                help="Save buffered tweets after at most this many milliseconds",
+            ),
+            click.option(
+                "--stall-timeout",
+                type=float,
+                default=90,
+                help="Reconnect if nothing arrives for this many seconds",
+            ),
+            click.option(
+                "--processes",
+                type=int,
+                default=1,
+                help="Decode and transform tweets using this many worker processes",
+            ),
+            click.option(
+                "--journal",
+                type=click.Path(file_okay=False, dir_okay=True),
+                help="Directory to journal the stream to before saving it",
+            ),
+        )
+    ):
+        subcommand = decorator(subcommand)
+    return subcommand
+
+
+def session_for_auth(auth):
+    "Session for the -a option, pooling the credentials if there are several"
+    auths = utils.load_auths(auth)
+    if not auths:
+        raise click.ClickException("No auth.json files found")
+    if len(auths) == 1:
+        return utils.session_for_auth(auths[0][1])
+    pool = utils.SessionPool(auths)
+    click.get_current_context().call_on_close(lambda: echo_pool_stats(pool))
+    return pool
+
+
+def run_async(auth, run, context=None, concurrency=4):
+    "Call run(session) with an async_utils.AsyncSession, in a new event loop"
+    auths = utils.load_auths(auth)
+    if len(auths) != 1:
+        raise click.ClickException("--async can only use one auth.json file")
+
+    async def main():
+        async with async_utils.AsyncSession(
+            auths[0][1], concurrency=concurrency
+        ) as session:
+            await run(session)
+
+    with context or utils.nullcontext():
+        async_utils.run(main())
+
+
+def echo_pool_stats(pool):
+    for stats in pool.stats():
+        message = "{name}: {requests} requests, {rate_limited} rate limited".format(
+            **stats
+        )
+        if stats["revoked"]:
+            message += ", revoked"
+        click.echo(message, err=True)
+
+
 @click.group()
 @click.version_option()
 def cli():
@@ -41,15 +123,15 @@ def cli():
 @click.option(
     "-a",
     "--auth",
-    type=click.Path(file_okay=True, dir_okay=False, allow_dash=True, exists=True),
-    default="auth.json",
-    help="Path to auth.json token file",
+    type=click.Path(file_okay=True, dir_okay=True, allow_dash=True, exists=True),
+    default=["auth.json"],
+    multiple=True,
+    help="Path to auth.json token file or directory, can be repeated",
 )
 def fetch(url, auth):
     "Make an authenticated request to the Twitter API"
-    auth = json.load(open(auth))
-    session = utils.session_for_auth(auth)
-    click.echo(json.dumps(session.get(url).json(), indent=4))
+    session = session_for_auth(auth)
+    click.echo(json.dumps(utils.response_json(session.get(url)), indent=4))
 
 
 @cli.command()
@@ -93,25 +175,28 @@ def auth(auth):
 @click.option(
     "-a",
     "--auth",
-    type=click.Path(file_okay=True, dir_okay=False, allow_dash=True, exists=True),
-    default="auth.json",
-    help="Path to auth.json token file",
+    type=click.Path(file_okay=True, dir_okay=True, allow_dash=True, exists=True),
+    default=["auth.json"],
+    multiple=True,
+    help="Path to auth.json token file or directory, can be repeated",
 )
 @click.option("--ids", is_flag=True, help="Treat input as user IDs, not screen names")
 @click.option("--silent", is_flag=True, help="Disable progress bar")
-def followers(db_path, identifiers, attach, sql, auth, ids, silent):
+@click.option(
+    "--resume", is_flag=True, help="Continue from where an interrupted run stopped"
+)
+def followers(db_path, identifiers, attach, sql, auth, ids, silent, resume):
     "Save followers for specified users (defaults to authenticated user)"
     _shared_friends_followers(
-        db_path, identifiers, attach, sql, auth, ids, silent, "followers"
+        db_path, identifiers, attach, sql, auth, ids, silent, resume, "followers"
     )
 
 
 def _shared_friends_followers(
-    db_path, identifiers, attach, sql, auth, ids, silent, noun
+    db_path, identifiers, attach, sql, auth, ids, silent, resume, noun
 ):
     assert noun in ("friends", "followers")
-    auth = json.load(open(auth))
-    session = utils.session_for_auth(auth)
+    session = session_for_auth(auth)
     db = utils.open_database(db_path)
 
     identifiers = utils.resolve_identifiers(db, identifiers, attach, sql)
@@ -126,7 +211,6 @@ def _shared_friends_followers(
         else:
             kwargs = {"screen_name": identifier}
 
-        fetched = []
         # Get the follower count, so we can have a progress bar
         count = 0
 
@@ -141,11 +225,13 @@ def _shared_friends_followers(
             save_users_kwargs["follower_id"] = user_id
 
         def go(update):
-            for users_chunk in utils.fetch_user_list_chunks(
-                session, user_id, screen_name, noun=noun
-            ):
-                fetched.extend(users_chunk)
+            pages = utils.fetch_user_list_pages(
+                session, user_id, screen_name, noun=noun, db=db, resume=resume
+            )
+            # Only the pages waiting in the pipeline's queue are held in memory
+            for users_chunk, checkpoint in utils.pipeline(pages):
                 utils.save_users(db, users_chunk, **save_users_kwargs)
+                utils.save_cursor_checkpoint(db, checkpoint)
                 update(len(users_chunk))
 
         if not silent:
@@ -169,16 +255,20 @@ def _shared_friends_followers(
 @click.option(
     "-a",
     "--auth",
-    type=click.Path(file_okay=True, dir_okay=False, allow_dash=True, exists=True),
-    default="auth.json",
-    help="Path to auth.json token file",
+    type=click.Path(file_okay=True, dir_okay=True, allow_dash=True, exists=True),
+    default=["auth.json"],
+    multiple=True,
+    help="Path to auth.json token file or directory, can be repeated",
 )
 @click.option("--ids", is_flag=True, help="Treat input as user IDs, not screen names")
 @click.option("--silent", is_flag=True, help="Disable progress bar")
-def friends(db_path, identifiers, attach, sql, auth, ids, silent):
+@click.option(
+    "--resume", is_flag=True, help="Continue from where an interrupted run stopped"
+)
+def friends(db_path, identifiers, attach, sql, auth, ids, silent, resume):
     "Save friends for specified users (defaults to authenticated user)"
     _shared_friends_followers(
-        db_path, identifiers, attach, sql, auth, ids, silent, "friends"
+        db_path, identifiers, attach, sql, auth, ids, silent, resume, "friends"
     )
 
 
@@ -191,25 +281,53 @@ def friends(db_path, identifiers, attach, sql, auth, ids, silent):
 @click.option(
     "-a",
     "--auth",
-    type=click.Path(file_okay=True, dir_okay=False, allow_dash=True, exists=True),
-    default="auth.json",
-    help="Path to auth.json token file",
+    type=click.Path(file_okay=True, dir_okay=True, allow_dash=True, exists=True),
+    default=["auth.json"],
+    multiple=True,
+    help="Path to auth.json token file or directory, can be repeated",
 )
 @click.option("--user_id", help="Numeric user ID")
 @click.option("--screen_name", help="Screen name")
 @click.option("--stop_after", type=int, help="Stop after this many")
-def favorites(db_path, auth, user_id, screen_name, stop_after):
+@click.option(
+    "--backfill",
+    is_flag=True,
+    help="Continue fetching older tweets from where an interrupted run stopped",
+)
+def favorites(db_path, auth, user_id, screen_name, stop_after, backfill):
     "Save tweets favorited by specified user"
-    auth = json.load(open(auth))
-    session = utils.session_for_auth(auth)
+    session = session_for_auth(auth)
     db = utils.open_database(db_path)
     profile = utils.get_profile(db, session, user_id, screen_name)
+    if not (user_id or screen_name):
+        # So the fetched range is recorded against the authenticated user
+        user_id = profile["id"]
+    pages = utils.fetch_favorites_pages(
+        session, db, user_id, screen_name, stop_after, backfill
+    )
     with click.progressbar(
-        utils.fetch_favorites(session, db, user_id, screen_name, stop_after),
+        _save_pages(
+            db,
+            pages,
+            lambda tweets: utils.save_tweets(db, tweets, favorited_by=profile["id"]),
+        ),
         label="Importing favorites",
         show_pos=True,
     ) as bar:
-        utils.save_tweets(db, bar, favorited_by=profile["id"])
+        for tweet in bar:
+            pass
+
+
+def _save_pages(db, pages, save):
+    """
+    Fetch pages on a background thread while calling save(tweets) for each
+    one here, recording since_id checkpoints only after their tweets are
+    saved. Yields the saved tweets, for progress bars.
+    """
+    for tweets, checkpoint in utils.pipeline(pages):
+        save(tweets)
+        utils.save_checkpoint(db, checkpoint)
+        yield from tweets
 
 
 @cli.command(name="user-timeline")
@@ -222,9 +340,10 @@ def favorites(db_path, auth, user_id, screen_name, stop_after):
 @click.option(
     "-a",
     "--auth",
-    type=click.Path(file_okay=True, dir_okay=False, allow_dash=True, exists=True),
-    default="auth.json",
-    help="Path to auth.json token file",
+    type=click.Path(file_okay=True, dir_okay=True, allow_dash=True, exists=True),
+    default=["auth.json"],
+    multiple=True,
+    help="Path to auth.json token file or directory, can be repeated",
 )
 @click.option("--ids", is_flag=True, help="Treat input as user IDs, not screen names")
 @click.option("--stop_after", type=int, help="Only pull this number of recent tweets")
@@ -236,6 +355,17 @@ def favorites(db_path, auth, user_id, screen_name, stop_after):
     help="Pull tweets since last retrieved tweet",
 )
 @click.option("--since_id", type=str, help="Pull tweets since this Tweet ID")
+@click.option(
+    "--concurrency",
+    type=int,
+    default=1,
+    help="Number of users to fetch timelines for at once",
+)
+@click.option(
+    "--backfill",
+    is_flag=True,
+    help="Continue fetching older tweets from where an interrupted run stopped",
+)
 def user_timeline(
     db_path,
     identifiers,
@@ -248,10 +378,11 @@ def user_timeline(
     screen_name,
     since,
     since_id,
+    concurrency,
+    backfill,
 ):
     "Save tweets posted by specified user"
-    auth = json.load(open(auth))
-    session = utils.session_for_auth(auth)
+    session = session_for_auth(auth)
     db = utils.open_database(db_path)
     identifiers = utils.resolve_identifiers(db, identifiers, attach, sql)
 
@@ -277,6 +408,20 @@ def user_timeline(
         identifiers = [profile["screen_name"]]
         ids = False
 
+    if concurrency > 1:
+        _user_timelines_concurrently(
+            db,
+            session,
+            identifiers,
+            ids,
+            concurrency,
+            stop_after=stop_after,
+            since_id=since_id,
+            since=since,
+            backfill=backfill,
+        )
+        return
+
     format_string = (
         "@{:" + str(max(len(str(identifier)) for identifier in identifiers)) + "}"
     )
@@ -296,28 +441,69 @@ def user_timeline(
         if since or since_id:
             expected_length = None
 
+        pages = utils.fetch_user_timeline_pages(
+            session,
+            db,
+            stop_after=stop_after,
+            since_id=since_id,
+            since=since,
+            backfill=backfill,
+            **kwargs
+        )
         with click.progressbar(
-            utils.fetch_user_timeline(
-                session,
-                db,
-                stop_after=stop_after,
-                since_id=since_id,
-                since=since,
-                **kwargs
-            ),
+            _save_pages(db, pages, lambda tweets: utils.save_tweets(db, tweets)),
             length=expected_length,
             label=format_string.format(profile["screen_name"]),
             show_pos=True,
         ) as bar:
-            # Save them 100 at a time
-            chunk = []
             for tweet in bar:
-                chunk.append(tweet)
-                if len(chunk) >= 100:
-                    utils.save_tweets(db, chunk)
-                    chunk = []
-            if chunk:
-                utils.save_tweets(db, chunk)
+                pass
+
+
+def _user_timelines_concurrently(db, session, identifiers, ids, concurrency, **kwargs):
+    """
+    Fetch timelines for several users at once on worker threads, which share
+    the session's rate limits. Everything is saved here on the main thread,
+    with each user's since_id checkpoint saved after that user's tweets.
+    """
+    jobs = []
+    for identifier in identifiers:
+        user_kwargs = {"user_id": identifier} if ids else {"screen_name": identifier}
+        # Created here as this reads since_ids from the database
+        pages = utils.fetch_user_timeline_pages(session, db, **kwargs, **user_kwargs)
+        jobs.append(_user_timeline_job(session, user_kwargs, pages))
+
+    def save_jobs():
+        num_tweets = 0
+        for kind, value in utils.pipeline_many(jobs, concurrency):
+            if kind == "profile":
+                utils.save_users(db, [value])
+            elif kind == "page":
+                tweets, checkpoint = value
+                utils.save_tweets(db, tweets)
+                utils.save_checkpoint(db, checkpoint)
+                num_tweets += len(tweets)
+            else:
+                yield num_tweets
+
+    with click.progressbar(
+        save_jobs(),
+        length=len(jobs),
+        label="Fetching {} users".format(len(jobs)),
+        show_pos=True,
+        item_show_func=lambda num_tweets: (
+            None if num_tweets is None else "{} tweets".format(num_tweets)
+        ),
+    ) as bar:
+        for _ in bar:
+            pass
+
+
+def _user_timeline_job(session, user_kwargs, pages):
+    yield "profile", utils.fetch_profile(session, **user_kwargs)
+    for page in pages:
+        yield "page", page
+    yield "done", None
 
 
 @cli.command(name="home-timeline")
@@ -329,9 +515,10 @@ def user_timeline(
 @click.option(
     "-a",
     "--auth",
-    type=click.Path(file_okay=True, dir_okay=False, allow_dash=True, exists=True),
-    default="auth.json",
-    help="Path to auth.json token file",
+    type=click.Path(file_okay=True, dir_okay=True, allow_dash=True, exists=True),
+    default=["auth.json"],
+    multiple=True,
+    help="Path to auth.json token file or directory, can be repeated",
 )
 @click.option(
     "--since",
@@ -361,9 +548,10 @@ def home_timeline(db_path, auth, since, since_id):
 @click.option(
     "-a",
     "--auth",
-    type=click.Path(file_okay=True, dir_okay=False, allow_dash=True, exists=True),
-    default="auth.json",
-    help="Path to auth.json token file",
+    type=click.Path(file_okay=True, dir_okay=True, allow_dash=True, exists=True),
+    default=["auth.json"],
+    multiple=True,
+    help="Path to auth.json token file or directory, can be repeated",
 )
 @click.option(
     "--since",
@@ -380,55 +568,45 @@ def mentions_timeline(db_path, auth, since, since_id):
         since_id,
         table="mentions_tweets",
         api_url="https://api.twitter.com/1.1/statuses/mentions_timeline.json",
-        sleep=10,
         since_type="mentions",
     )
 
 
-def _shared_timeline(
-    db_path, auth, since, since_id, table, api_url, sleep=1, since_type=None
-):
-    auth = json.load(open(auth))
-    session = utils.session_for_auth(auth)
+def _shared_timeline(db_path, auth, since, since_id, table, api_url, since_type=None):
+    session = session_for_auth(auth)
     db = utils.open_database(db_path)
     profile = utils.get_profile(db, session)
     expected_length = 800
     since_key = profile["id"]
 
+    pages = utils.fetch_timeline_pages(
+        session,
+        api_url,
+        db,
+        since=since,
+        since_id=since_id,
+        since_type=since_type,
+        since_key=since_key,
+    )
+
+    def save_chunk(chunk):
+        utils.save_tweets(db, chunk)
+        # Record who's timeline they came from
+        db[table].insert_all(
+            [{"user": profile["id"], "tweet": tweet["id"]} for tweet in chunk],
+            pk=("user", "tweet"),
+            foreign_keys=("user", "tweet"),
+            replace=True,
+        )
+
     with click.progressbar(
-        utils.fetch_timeline(
-            session,
-            api_url,
-            db,
-            sleep=sleep,
-            since=since,
-            since_id=since_id,
-            since_type=since_type,
-            since_key=since_key,
-        ),
+        _save_pages(db, pages, save_chunk),
         length=expected_length,
         label="Importing tweets",
         show_pos=True,
     ) as bar:
-        # Save them 100 at a time
-        def save_chunk(db, chunk):
-            utils.save_tweets(db, chunk)
-            # Record who's timeline they came from
-            db[table].insert_all(
-                [{"user": profile["id"], "tweet": tweet["id"]} for tweet in chunk],
-                pk=("user", "tweet"),
-                foreign_keys=("user", "tweet"),
-                replace=True,
-            )
-
-        chunk = []
         for tweet in bar:
-            chunk.append(tweet)
-            if len(chunk) >= 100:
-                save_chunk(db, chunk)
-                chunk = []
-        if chunk:
-            save_chunk(db, chunk)
+            pass
 
 
 @cli.command(name="users-lookup")
@@ -441,18 +619,34 @@ def _shared_timeline(
 @click.option(
     "-a",
     "--auth",
-    type=click.Path(file_okay=True, dir_okay=False, allow_dash=True, exists=True),
-    default="auth.json",
-    help="Path to auth.json token file",
+    type=click.Path(file_okay=True, dir_okay=True, allow_dash=True, exists=True),
+    default=["auth.json"],
+    multiple=True,
+    help="Path to auth.json token file or directory, can be repeated",
 )
 @click.option("--ids", is_flag=True, help="Treat input as user IDs, not screen names")
-def users_lookup(db_path, identifiers, attach, sql, auth, ids):
+@click.option(
+    "--async",
+    "use_async",
+    is_flag=True,
+    help="Fetch several batches at once using asyncio (requires aiohttp)",
+)
+def users_lookup(db_path, identifiers, attach, sql, auth, ids, use_async):
     "Fetch user accounts"
-    auth = json.load(open(auth))
-    session = utils.session_for_auth(auth)
     db = utils.open_database(db_path)
     identifiers = utils.resolve_identifiers(db, identifiers, attach, sql)
-    for batch in utils.fetch_user_batches(session, identifiers, ids):
+    if use_async:
+
+        async def run(session):
+            async for batch in async_utils.fetch_user_batches(
+                session, identifiers, ids
+            ):
+                utils.save_users(db, batch)
+
+        run_async(auth, run)
+        return
+    session = session_for_auth(auth)
+    for batch in utils.pipeline(utils.fetch_user_batches(session, identifiers, ids)):
         utils.save_users(db, batch)
 
 
@@ -466,38 +660,197 @@ def users_lookup(db_path, identifiers, attach, sql, auth, ids):
 @click.option(
     "-a",
     "--auth",
-    type=click.Path(file_okay=True, dir_okay=False, allow_dash=True, exists=True),
-    default="auth.json",
-    help="Path to auth.json token file",
+    type=click.Path(file_okay=True, dir_okay=True, allow_dash=True, exists=True),
+    default=["auth.json"],
+    multiple=True,
+    help="Path to auth.json token file or directory, can be repeated",
 )
 @click.option(
     "--skip-existing", is_flag=True, help="Skip tweets that are already in the DB"
 )
 @click.option("--silent", is_flag=True, help="Disable progress bar")
-def statuses_lookup(db_path, identifiers, attach, sql, auth, skip_existing, silent):
+@click.option(
+    "--async",
+    "use_async",
+    is_flag=True,
+    help="Fetch several batches at once using asyncio (requires aiohttp)",
+)
+def statuses_lookup(
+    db_path, identifiers, attach, sql, auth, skip_existing, silent, use_async
+):
     "Fetch tweets by their IDs"
-    auth = json.load(open(auth))
-    session = utils.session_for_auth(auth)
     db = utils.open_database(db_path)
     identifiers = utils.resolve_identifiers(db, identifiers, attach, sql)
     if skip_existing:
-        existing_ids = set(
-            r[0] for r in db.conn.execute("select id from tweets").fetchall()
-        )
-        identifiers = [i for i in identifiers if int(i) not in existing_ids]
+        identifiers = utils.missing_tweet_ids(db, identifiers)
     if silent:
-        for batch in utils.fetch_status_batches(session, identifiers):
-            utils.save_tweets(db, batch)
+        bar = None
     else:
         # Do it with a progress bar
         count = len(identifiers)
-        with click.progressbar(
+        bar = click.progressbar(
             length=count,
             label="Importing {:,} tweet{}".format(count, "" if count == 1 else "s"),
-        ) as bar:
-            for batch in utils.fetch_status_batches(session, identifiers):
+        )
+
+    def save(batch):
+        utils.save_tweets(db, batch)
+        if bar is not None:
+            bar.update(len(batch))
+
+    if use_async:
+
+        async def run(session):
+            async for batch in async_utils.fetch_status_batches(session, identifiers):
+                save(batch)
+
+        run_async(auth, run, bar)
+        return
+    session = session_for_auth(auth)
+    with bar or utils.nullcontext():
+        for batch in utils.pipeline(utils.fetch_status_batches(session, identifiers)):
+            save(batch)
+
+
+@cli.command(name="hydrate-users")
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.option(
+    "-a",
+    "--auth",
+    type=click.Path(file_okay=True, dir_okay=True, allow_dash=True, exists=True),
+    default=["auth.json"],
+    multiple=True,
+    help="Path to auth.json token file or directory, can be repeated",
+)
+@click.option(
+    "--ttl",
+    type=float,
+    help="Also refresh users last fetched more than this many days ago",
+)
+@click.option(
+    "--concurrency",
+    type=int,
+    default=4,
+    help="Number of batches of users to fetch at once",
+)
+@click.option("--silent", is_flag=True, help="Disable progress bar")
+@click.option(
+    "--async",
+    "use_async",
+    is_flag=True,
+    help="Fetch several batches at once using asyncio (requires aiohttp)",
+)
+def hydrate_users(db_path, auth, ttl, concurrency, silent, use_async):
+    "Fetch users referenced by following, tweets, list_members and favorited_by"
+    db = utils.open_database(db_path)
+    if ttl is not None:
+        ttl = datetime.timedelta(days=ttl)
+    user_ids = utils.stale_user_ids(db, ttl)
+    if silent:
+        bar = None
+    else:
+        count = len(user_ids)
+        bar = click.progressbar(
+            length=count,
+            label="Fetching {:,} user{}".format(count, "" if count == 1 else "s"),
+        )
+
+    def save(ids, batch):
+        if not isinstance(batch, list):
+            errors = batch.get("errors") or [{}]
+            if errors[0].get("code") != utils.NO_USER_MATCHES_ERROR_CODE:
+                raise click.ClickException(
+                    "users/lookup failed: {}".format(batch.get("errors", batch))
+                )
+            batch = []
+        utils.save_users(db, batch)
+        # Deleted and suspended users are not returned
+        fetched = {user["id"] for user in batch}
+        missing = [id for id in ids if id not in fetched]
+        if missing:
+            utils.save_user_tombstones(db, missing)
+        if bar is not None:
+            bar.update(len(ids))
+
+    if use_async:
+
+        async def run(session):
+            id_batches = utils.chunks(user_ids, 70)
+            async for batch in async_utils.fetch_user_batches(session, user_ids, True):
+                save(next(id_batches), batch)
+
+        run_async(auth, run, bar, concurrency)
+        return
+    session = session_for_auth(auth)
+
+    def fetch(ids):
+        for batch in utils.fetch_user_batches(session, ids, use_ids=True):
+            yield ids, batch
+
+    # One generator per batch, so concurrency batches are fetched at once
+    batches = (fetch(ids) for ids in utils.chunks(user_ids, 70))
+    with bar or utils.nullcontext():
+        for ids, batch in utils.pipeline_many(batches, concurrency):
+            save(ids, batch)
+
+
+@cli.command(name="backfill-references")
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.option(
+    "-a",
+    "--auth",
+    type=click.Path(file_okay=True, dir_okay=True, allow_dash=True, exists=True),
+    default=["auth.json"],
+    multiple=True,
+    help="Path to auth.json token file or directory, can be repeated",
+)
+@click.option(
+    "--depth",
+    type=int,
+    default=1,
+    help="Repeat this many times, to follow chains of replies",
+)
+@click.option("--silent", is_flag=True, help="Disable progress bar")
+def backfill_references(db_path, auth, depth, silent):
+    "Fetch retweeted, quoted and replied-to tweets that are missing from the DB"
+    db = utils.open_database(db_path)
+    session = session_for_auth(auth)
+    for _ in range(depth):
+        tweet_ids = utils.dangling_tweet_ids(db)
+        if not tweet_ids:
+            break
+        fetched = set()
+        count = len(tweet_ids)
+        if silent:
+            bar = None
+        else:
+            bar = click.progressbar(
+                length=count,
+                label="Fetching {:,} tweet{}".format(count, "" if count == 1 else "s"),
+            )
+        with bar or utils.nullcontext():
+            for batch in utils.pipeline(utils.fetch_status_batches(session, tweet_ids)):
+                if not isinstance(batch, list):
+                    # An error response, so nothing can be tombstoned
+                    raise click.ClickException(
+                        "statuses/lookup failed: {}".format(batch.get("errors", batch))
+                    )
+                fetched.update(tweet["id"] for tweet in batch)
                 utils.save_tweets(db, batch)
-                bar.update(len(batch))
+                if bar is not None:
+                    bar.update(len(batch))
+        # Deleted tweets, and those by protected accounts, are not returned
+        missing = [id for id in tweet_ids if id not in fetched]
+        if missing:
+            utils.save_tweet_tombstones(db, missing)
 
 
 @cli.command(name="lists")
@@ -510,22 +863,24 @@ def statuses_lookup(db_path, identifiers, attach, sql, auth, skip_existing, sile
 @click.option(
     "-a",
     "--auth",
-    type=click.Path(file_okay=True, dir_okay=False, allow_dash=True, exists=True),
-    default="auth.json",
-    help="Path to auth.json token file",
+    type=click.Path(file_okay=True, dir_okay=True, allow_dash=True, exists=True),
+    default=["auth.json"],
+    multiple=True,
+    help="Path to auth.json token file or directory, can be repeated",
 )
 @click.option("--ids", is_flag=True, help="Treat input as user IDs, not screen_names")
 @click.option("--members", is_flag=True, help="Retrieve members for each list")
-def lists(db_path, identifiers, attach, sql, auth, ids, members):
+@click.option(
+    "--resume", is_flag=True, help="Continue from where an interrupted run stopped"
+)
+def lists(db_path, identifiers, attach, sql, auth, ids, members, resume):
     "Fetch lists belonging to specified users"
-    auth = json.load(open(auth))
-    session = utils.session_for_auth(auth)
+    session = session_for_auth(auth)
     db = utils.open_database(db_path)
     identifiers = utils.resolve_identifiers(db, identifiers, attach, sql)
     # Make sure we have saved these users to the database
     for batch in utils.fetch_user_batches(session, identifiers, ids):
         utils.save_users(db, batch)
-    first = True
     for identifier in identifiers:
         if ids:
             kwargs = {"user_id": identifier}
@@ -535,12 +890,8 @@ def lists(db_path, identifiers, attach, sql, auth, ids, members):
         if members:
             for new_list in fetched_lists:
                 utils.fetch_and_save_list(
-                    db, session, new_list["full_name"].rstrip("@")
+                    db, session, new_list["full_name"].rstrip("@"), resume=resume
                 )
-        if not first:
-            # Rate limit is one per minute
-            first = False
-            time.sleep(60)
 
 
 @cli.command(name="list-members")
@@ -553,20 +904,23 @@ def lists(db_path, identifiers, attach, sql, auth, ids, members):
 @click.option(
     "-a",
     "--auth",
-    type=click.Path(file_okay=True, dir_okay=False, allow_dash=True, exists=True),
-    default="auth.json",
-    help="Path to auth.json token file",
+    type=click.Path(file_okay=True, dir_okay=True, allow_dash=True, exists=True),
+    default=["auth.json"],
+    multiple=True,
+    help="Path to auth.json token file or directory, can be repeated",
 )
 @click.option(
     "--ids", is_flag=True, help="Treat input as list IDs, not user/slug strings"
 )
-def list_members(db_path, identifiers, auth, ids):
+@click.option(
+    "--resume", is_flag=True, help="Continue from where an interrupted run stopped"
+)
+def list_members(db_path, identifiers, auth, ids, resume):
     "Fetch lists - accepts one or more screen_name/list_slug identifiers"
-    auth = json.load(open(auth))
-    session = utils.session_for_auth(auth)
+    session = session_for_auth(auth)
     db = utils.open_database(db_path)
     for identifier in identifiers:
-        utils.fetch_and_save_list(db, session, identifier, ids)
+        utils.fetch_and_save_list(db, session, identifier, ids, resume=resume)
 
 
 @cli.command(name="followers-ids")
@@ -579,17 +933,23 @@ def list_members(db_path, identifiers, auth, ids):
 @click.option(
     "-a",
     "--auth",
-    type=click.Path(file_okay=True, dir_okay=False, allow_dash=True, exists=True),
-    default="auth.json",
-    help="Path to auth.json token file",
+    type=click.Path(file_okay=True, dir_okay=True, allow_dash=True, exists=True),
+    default=["auth.json"],
+    multiple=True,
+    help="Path to auth.json token file or directory, can be repeated",
 )
 @click.option(
     "--ids", is_flag=True, help="Treat input as list IDs, not user/slug strings"
 )
 @click.option(
-    "--sleep", type=int, default=61, help="Seconds to sleep between API calls"
+    "--sleep",
+    type=int,
+    help="Extra seconds to sleep between API calls, on top of rate limits",
 )
-def followers_ids(db_path, identifiers, attach, sql, auth, ids, sleep):
+@click.option(
+    "--resume", is_flag=True, help="Continue from where an interrupted run stopped"
+)
+def followers_ids(db_path, identifiers, attach, sql, auth, ids, sleep, resume):
     "Populate followers table with IDs of account followers"
     _shared_friends_ids_followers_ids(
         db_path,
@@ -599,6 +959,7 @@ def followers_ids(db_path, identifiers, attach, sql, auth, ids, sleep):
         auth,
         ids,
         sleep,
+        resume,
         api_url="https://api.twitter.com/1.1/followers/ids.json",
         first_key="followed_id",
         second_key="follower_id",
@@ -615,17 +976,23 @@ def followers_ids(db_path, identifiers, attach, sql, auth, ids, sleep):
 @click.option(
     "-a",
     "--auth",
-    type=click.Path(file_okay=True, dir_okay=False, allow_dash=True, exists=True),
-    default="auth.json",
-    help="Path to auth.json token file",
+    type=click.Path(file_okay=True, dir_okay=True, allow_dash=True, exists=True),
+    default=["auth.json"],
+    multiple=True,
+    help="Path to auth.json token file or directory, can be repeated",
 )
 @click.option(
     "--ids", is_flag=True, help="Treat input as list IDs, not user/slug strings"
 )
 @click.option(
-    "--sleep", type=int, default=61, help="Seconds to sleep between API calls"
+    "--sleep",
+    type=int,
+    help="Extra seconds to sleep between API calls, on top of rate limits",
 )
-def friends_ids(db_path, identifiers, attach, sql, auth, ids, sleep):
+@click.option(
+    "--resume", is_flag=True, help="Continue from where an interrupted run stopped"
+)
+def friends_ids(db_path, identifiers, attach, sql, auth, ids, sleep, resume):
     "Populate followers table with IDs of account friends"
     _shared_friends_ids_followers_ids(
         db_path,
@@ -635,6 +1002,7 @@ def friends_ids(db_path, identifiers, attach, sql, auth, ids, sleep):
         auth,
         ids,
         sleep,
+        resume,
         api_url="https://api.twitter.com/1.1/friends/ids.json",
         first_key="follower_id",
         second_key="followed_id",
@@ -651,21 +1019,17 @@ def friends_ids(db_path, identifiers, attach, sql, auth, ids, sleep):
 @click.option(
     "-a",
     "--auth",
-    type=click.Path(file_okay=True, dir_okay=False, allow_dash=True, exists=True),
-    default="auth.json",
-    help="Path to auth.json token file",
+    type=click.Path(file_okay=True, dir_okay=True, allow_dash=True, exists=True),
+    default=["auth.json"],
+    multiple=True,
+    help="Path to auth.json token file or directory, can be repeated",
 )
-@click.option("--verbose", is_flag=True, help="Verbose mode: display every tweet")
-def track(db_path, track, auth, verbose):
+@add_stream_options
+def track(db_path, track, auth, **stream_options):
     "Experimental: Save tweets matching these keywords in real-time"
-    auth = json.load(open(auth))
-    session = utils.session_for_auth(auth)
+    session = session_for_auth(auth)
     db = utils.open_database(db_path)
-    for tweet in utils.stream_filter(session, track=track):
-        if verbose:
-            print(json.dumps(tweet, indent=2))
-        with db.conn:
-            utils.save_tweets(db, [tweet])
+    _save_stream(db, session, {"track": track}, **stream_options)
 
 
 @cli.command()
@@ -679,15 +1043,15 @@ def track(db_path, track, auth, verbose):
 @click.option(
     "-a",
     "--auth",
-    type=click.Path(file_okay=True, dir_okay=False, allow_dash=True, exists=True),
-    default="auth.json",
-    help="Path to auth.json token file",
+    type=click.Path(file_okay=True, dir_okay=True, allow_dash=True, exists=True),
+    default=["auth.json"],
+    multiple=True,
+    help="Path to auth.json token file or directory, can be repeated",
 )
-@click.option("--verbose", is_flag=True, help="Verbose mode: display every tweet")
-def follow(db_path, identifiers, attach, sql, ids, auth, verbose):
+@add_stream_options
+def follow(db_path, identifiers, attach, sql, ids, auth, **stream_options):
     "Experimental: Follow these Twitter users and save tweets in real-time"
-    auth = json.load(open(auth))
-    session = utils.session_for_auth(auth)
+    session = session_for_auth(auth)
     db = utils.open_database(db_path)
     identifiers = utils.resolve_identifiers(db, identifiers, attach, sql)
     # Make sure we have saved these users to the database
@@ -699,18 +1063,136 @@ def follow(db_path, identifiers, attach, sql, ids, auth, verbose):
     else:
         follow = utils.user_ids_for_screen_names(db, identifiers)
     # Start streaming:
-    for tweet in utils.stream_filter(session, follow=follow):
+    _save_stream(db, session, {"follow": follow}, **stream_options)
+
+
+def _save_stream(
+    db,
+    session,
+    filters,
+    verbose,
+    batch_size,
+    max_delay,
+    stall_timeout,
+    processes,
+    journal,
+):
+    "Save streamed tweets in groups, then report on the connection and commits"
+    if verbose and processes > 1:
+        raise click.ClickException("Cannot use --verbose with --processes")
+    if journal and processes > 1:
+        raise click.ClickException("Cannot use --journal with --processes")
+    connection = utils.filter_connection(
+        session, stall_timeout=stall_timeout, **filters
+    )
+    writer = utils.GroupCommitWriter(db, batch_size, max_delay / 1000)
+
+    def on_tweet(tweet):
         if verbose:
             print(json.dumps(tweet, indent=2))
-        with db.conn:
-            utils.save_tweets(db, [tweet])
+
+    def on_sigterm(signum, frame):
+        # Exit via SystemExit, so buffered tweets are still saved
+        sys.exit(0)
+
+    previous_handler = signal.signal(signal.SIGTERM, on_sigterm)
+    if journal:
+        journal = utils.StreamJournal(journal)
+        if journal.truncated:
+            click.echo(
+                "Truncated a partly written line of {:,} bytes from the journal".format(
+                    journal.truncated
+                ),
+                err=True,
+            )
+    try:
+        if journal:
+            utils.save_journaled_lines(
+                writer,
+                journal,
+                connection.lines(),
+                on_tweet,
+                on_lag=lambda lag: echo_journal_lag(journal, lag),
+            )
+        elif processes > 1:
+            utils.save_streamed_lines(writer, connection.lines(), processes)
+        else:
+            tweets = utils.stream_tweets(connection)
+            utils.save_streamed_tweets(writer, tweets, on_tweet)
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+        echo_connection_stats(connection)
+        echo_group_commit_stats(writer)
+        if journal:
+            echo_journal_lag(journal)
+            journal.close()
+
+
+def echo_journal_lag(journal, lag=None):
+    lag = lag or journal.lag()
+    message = "Journal lag: {:,} bytes in {} segment{}".format(
+        lag["bytes"], lag["segments"], "" if lag["segments"] == 1 else "s"
+    )
+    if journal.skipped:
+        message += ", skipped {:,} undecodable line{}".format(
+            journal.skipped, "" if journal.skipped == 1 else "s"
+        )
+    click.echo(message, err=True)
+
+
+def echo_connection_stats(connection):
+    stats = connection.stats()
+    message = "Connected for {:.0f}s of {:.0f}s, {} reconnect{}".format(
+        stats["connected"],
+        stats["elapsed"],
+        stats["reconnects"],
+        "" if stats["reconnects"] == 1 else "s",
+    )
+    if stats["disconnects"]:
+        message += " ({})".format(
+            ", ".join(
+                "{} {}".format(count, kind)
+                for kind, count in sorted(stats["disconnects"].items())
+            )
+        )
+    if stats["gap_seconds"]:
+        message += ", about {:,} tweets missed in {:.0f}s of gaps".format(
+            stats["estimated_lost_lines"], stats["gap_seconds"]
+        )
+    click.echo(message, err=True)
+
+
+def echo_group_commit_stats(writer):
+    stats = writer.stats()
+    message = "Saved {tweets:,} tweets in {batches:,} batches".format(**stats)
+    if stats["batches"]:
+        message += (
+            ", mean batch size {:.1f}, largest {},"
+            " commit latency p50 {:.0f}ms p99 {:.0f}ms max {:.0f}ms"
+        ).format(
+            stats["mean_batch_size"],
+            stats["largest_batch"],
+            stats["latency_p50"] * 1000,
+            stats["latency_p99"] * 1000,
+            stats["latency_max"] * 1000,
+        )
+    click.echo(message, err=True)
 
 
 def _shared_friends_ids_followers_ids(
-    db_path, identifiers, attach, sql, auth, ids, sleep, api_url, first_key, second_key
+    db_path,
+    identifiers,
+    attach,
+    sql,
+    auth,
+    ids,
+    sleep,
+    resume,
+    api_url,
+    first_key,
+    second_key,
 ):
-    auth = json.load(open(auth))
-    session = utils.session_for_auth(auth)
+    session = session_for_auth(auth)
     db = utils.open_database(db_path)
     identifiers = utils.resolve_identifiers(db, identifiers, attach, sql)
     for identifier in identifiers:
@@ -719,9 +1201,19 @@ def _shared_friends_ids_followers_ids(
         arg_screen_name = None if ids else identifier
         profile = utils.get_profile(db, session, arg_user_id, arg_screen_name)
         user_id = profile["id"]
-        args = {("user_id" if ids else "screen_name"): identifier}
-        for id_batch in utils.cursor_paginate(
-            session, api_url, args, "ids", 5000, sleep
+        args = {("user_id" if ids else "screen_name"): identifier, "page_size": 5000}
+        checkpoint_key = "id:{}".format(user_id)
+        cursor = -1
+        if resume:
+            cursor = utils.load_cursor_checkpoint(db, api_url, checkpoint_key)
+        for id_batch, checkpoint in utils.cursor_pages(
+            session,
+            api_url,
+            args,
+            "ids",
+            checkpoint_key=checkpoint_key,
+            cursor=cursor,
+            sleep=sleep,
         ):
             first_seen = datetime.datetime.utcnow().isoformat()
             db["following"].insert_all(
@@ -731,7 +1223,7 @@ def _shared_friends_ids_followers_ids(
                 ),
                 ignore=True,
             )
-        time.sleep(sleep)
+            utils.save_cursor_checkpoint(db, checkpoint)
 
 
 @cli.command(name="import")
@@ -746,7 +1238,13 @@ def _shared_friends_ids_followers_ids(
     required=True,
     nargs=-1,
 )
-def import_(db_path, paths):
+@click.option(
+    "--batch-size",
+    type=int,
+    default=1000,
+    help="Number of rows to insert at a time",
+)
+def import_(db_path, paths, batch_size):
     """
     Import data from a Twitter exported archive. Input can be the path to a zip
     file, a directory full of .js files or one or more direct .js files.
@@ -755,18 +1253,75 @@ def import_(db_path, paths):
     for filepath in paths:
         path = pathlib.Path(filepath)
         if path.suffix == ".zip":
-            for filename, content in utils.read_archive_js(filepath):
-                archive.import_from_file(db, filename, content)
+            for filename, fp in utils.open_archive_js(filepath):
+                with fp:
+                    archive.import_from_fp(db, filename, fp, batch_size)
         elif path.is_dir():
             # Import every .js file in this directory
             for filepath in path.glob("*.js"):
-                archive.import_from_file(db, filepath.name, open(filepath, "rb").read())
+                with open(filepath, "rb") as fp:
+                    archive.import_from_fp(db, filepath.name, fp, batch_size)
         elif path.suffix == ".js":
-            archive.import_from_file(db, path.name, open(path, "rb").read())
+            with open(path, "rb") as fp:
+                archive.import_from_fp(db, path.name, fp, batch_size)
         else:
             raise click.ClickException("Path must be a .js or .zip file or a directory")
 
 
+@cli.command(name="ingest")
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    required=True,
+)
+@click.argument(
+    "paths",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=True, exists=True),
+    required=True,
+    nargs=-1,
+)
+@click.option(
+    "--batch-size",
+    type=int,
+    default=1000,
+    help="Number of JSONL lines to save in each transaction",
+)
+@click.option(
+    "--processes",
+    type=int,
+    default=1,
+    help="Decode payloads using this many worker processes",
+)
+def ingest_(db_path, paths, batch_size, processes):
+    """
+    Save tweets and users from saved API responses or streams. Input can be
+    JSON or JSONL files, optionally gzip or zstd compressed, or - for stdin.
+    """
+    db = utils.open_database(db_path)
+    stats = ingest.ingest_paths(db, paths, batch_size, processes)
+    elapsed = stats["elapsed"] or 1e-9
+    message = (
+        "Saved {:,} tweets and {:,} users from {:,} file{} ({:,.1f}MB) in {:.1f}s:"
+        " {:,.0f} tweets/s, {:,.1f}MB/s"
+    ).format(
+        stats["tweets"],
+        stats["users"],
+        stats["files"],
+        "" if stats["files"] == 1 else "s",
+        stats["bytes"] / 1024 / 1024,
+        stats["elapsed"],
+        stats["tweets"] / elapsed,
+        stats["bytes"] / 1024 / 1024 / elapsed,
+    )
+    if stats["skipped"]:
+        message += ", skipped {:,} other objects".format(stats["skipped"])
+    if stats["invalid"]:
+        message += ", skipped {:,} invalid line{}".format(
+            stats["invalid"], "" if stats["invalid"] == 1 else "s"
+        )
+    click.echo(message, err=True)
+
+
 @cli.command()
 @click.argument(
     "db_path",
@@ -777,9 +1332,10 @@ def import_(db_path, paths):
 @click.option(
     "-a",
     "--auth",
-    type=click.Path(file_okay=True, dir_okay=False, allow_dash=True, exists=True),
-    default="auth.json",
-    help="Path to auth.json token file",
+    type=click.Path(file_okay=True, dir_okay=True, allow_dash=True, exists=True),
+    default=["auth.json"],
+    multiple=True,
+    help="Path to auth.json token file or directory, can be repeated",
 )
 @click.option(
     "--since",
@@ -797,7 +1353,12 @@ def import_(db_path, paths):
 @click.option("--count", type=int, default=100, help="Number of results per page")
 @click.option("--stop_after", type=int, help="Stop after this many")
 @click.option("--since_id", type=str, help="Pull tweets since this Tweet ID")
-def search(db_path, q, auth, since, **kwargs):
+@click.option(
+    "--backfill",
+    is_flag=True,
+    help="Continue fetching older tweets from where an interrupted run stopped",
+)
+def search(db_path, q, auth, since, backfill, **kwargs):
     """
     Save tweets from a search. Full documentation here:
 
@@ -805,8 +1366,7 @@ def search(db_path, q, auth, since, **kwargs):
     """
     since_id = kwargs.pop("since_id", None)
     stop_after = kwargs.pop("stop_after", None)
-    auth = json.load(open(auth))
-    session = utils.session_for_auth(auth)
+    session = session_for_auth(auth)
     db = utils.open_database(db_path)
 
     search_args = {"q": q}
@@ -818,21 +1378,19 @@ def search(db_path, q, auth, since, **kwargs):
         json.dumps(search_args, sort_keys=True, separators=(",", ":")).encode("utf8")
     ).hexdigest()
 
-    tweets = utils.fetch_timeline(
+    pages = utils.fetch_timeline_pages(
         session,
         "https://api.twitter.com/1.1/search/tweets.json",
         db,
         search_args,
-        sleep=6,
         key="statuses",
         stop_after=stop_after,
         since_id=since_id,
+        since=since,
         since_type="search",
         since_key=args_hash,
+        backfill=backfill,
     )
-    chunk = []
-    first = True
-
     if not db["search_runs"].exists():
         db["search_runs"].create(
             {"id": int, "name": str, "args": str, "started": str, "hash": str}, pk="id"
@@ -851,10 +1409,21 @@ def search(db_path, q, auth, since, **kwargs):
             replace=True,
         )
 
+    def changes_checkpoint(checkpoint):
+        if checkpoint is None:
+            return False
+        if not db["since_ids"].exists():
+            return True
+        saved = db.conn.execute(
+            "select since_id, min_id from since_ids where type = ? and key = ?",
+            [checkpoint["type"], checkpoint["key"]],
+        ).fetchone()
+        return saved != (checkpoint["since_id"], checkpoint["min_id"])
+
     search_run_id = None
-    for tweet in tweets:
-        if first:
-            first = False
+    for tweets, checkpoint in utils.pipeline(pages):
+        # No run is recorded for a search that found nothing new
+        if search_run_id is None and (tweets or changes_checkpoint(checkpoint)):
             search_run_id = (
                 db["search_runs"]
                 .insert(
@@ -872,9 +1441,6 @@ def search(db_path, q, auth, since, **kwargs):
                 )
                 .last_pk
             )
-        chunk.append(tweet)
-        if len(chunk) >= 10:
-            save_chunk(db, search_run_id, chunk)
-            chunk = []
-    if chunk:
-        save_chunk(db, search_run_id, chunk)
+        if tweets:
+            save_chunk(db, search_run_id, tweets)
+        utils.save_checkpoint(db, checkpoint)
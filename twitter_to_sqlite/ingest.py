@@ -0,0 +1,233 @@
+# Utilities for loading tweets and users from saved API payloads
+import collections
+import gzip
+import io
+import itertools
+import multiprocessing
+import re
+import sys
+import time
+
+import click
+
+from . import archive, utils
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+# The first line of a pretty-printed JSON document, such as "[" or "{", or
+# "window.YTD.tweet.part0 = [ {" from an archive, which holds no whole value
+DOCUMENT_START = re.compile(rb"\s*(window\.[^=]*=)?[\s\[{]*")
+
+
+def open_payload(path):
+    "Open path, or stdin for '-', decompressing gzip or zstd if needed"
+    if path == "-":
+        fp = sys.stdin.buffer
+    else:
+        fp = open(path, "rb")
+    if not hasattr(fp, "peek"):
+        fp = io.BufferedReader(fp)
+    magic = fp.peek(4)[:4]
+    if magic.startswith(GZIP_MAGIC):
+        return io.BufferedReader(gzip.GzipFile(fileobj=fp))
+    if magic == ZSTD_MAGIC:
+        if zstandard is None:
+            raise click.ClickException(
+                "Reading zstd files requires zstandard: "
+                "pip install twitter-to-sqlite[zstd]"
+            )
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(fp))
+    return fp
+
+
+def read_batches(fp, batch_size):
+    """
+    Yields (num_bytes, batch) pairs, where batch is up to batch_size JSONL
+    lines from fp. JSON arrays - a file holding a pretty-printed array, or an
+    array on one line - are decoded here instead, and their tweets and users
+    batched as decoded objects. A file holding any other JSON document, such
+    as a saved API response, is decoded here too.
+
+    The format is told from the first line: a pretty-printed document starts
+    with a line of just opening brackets, while anything else is JSONL, so an
+    invalid first line is skipped like any other invalid line.
+    """
+    reader = CountingReader(fp)
+    first = reader.readline()
+    while first and not first.strip():
+        first = reader.readline()
+    if not first:
+        return
+    if DOCUMENT_START.fullmatch(first):
+        reader.unread(first)
+        if first.lstrip().startswith(b"{"):
+            values = [utils.json_loads(reader.read())]
+        else:
+            values = archive.iter_json_array(reader)
+        items = (item for value in values for item in payload_objects(value))
+    else:
+        items = _jsonl_items(first, reader)
+    for batch in utils.chunks(items, batch_size):
+        yield reader.take_count(), batch
+
+
+def _jsonl_items(first, reader):
+    for line in itertools.chain([first], reader):
+        if not line.strip():
+            continue
+        if line.lstrip().startswith(b"["):
+            # Split up so that a long array is not all one batch
+            try:
+                yield from payload_objects(utils.json_loads(line))
+                continue
+            except ValueError:
+                pass
+        yield line
+
+
+class CountingReader:
+    "Wraps binary file fp, counting the bytes read from it"
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.pushed_back = b""
+        self.count = 0
+
+    def unread(self, data):
+        self.pushed_back = data + self.pushed_back
+        self.count -= len(data)
+
+    def read(self, size=-1):
+        data, self.pushed_back = self.pushed_back, b""
+        if size is None or size < 0:
+            data += self.fp.read()
+        elif not data:
+            data = self.fp.read(size)
+        self.count += len(data)
+        return data
+
+    def readline(self):
+        line = self.fp.readline()
+        self.count += len(line)
+        return line
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+    def take_count(self):
+        count, self.count = self.count, 0
+        return count
+
+
+def payload_objects(value):
+    "Every tweet or user object in a decoded API payload"
+    if isinstance(value, list):
+        for item in value:
+            yield from payload_objects(item)
+    elif isinstance(value, dict):
+        # search/tweets and followers/list responses wrap their results
+        for key in ("statuses", "users"):
+            if isinstance(value.get(key), list):
+                yield from payload_objects(value[key])
+                return
+        yield value
+
+
+def parse_batch(lines):
+    """
+    Decode a batch of JSONL lines or decoded objects into (num_tweets, tweet
+    batches, users, skipped, invalid), with the tweets already run through
+    collect_tweet_batches(). Runs in worker processes when ingest_paths() is
+    called with processes > 1.
+    """
+    tweets, users, skipped, invalid = [], [], 0, 0
+    for line in lines:
+        if isinstance(line, bytes):
+            try:
+                value = utils.json_loads(line)
+            except ValueError:
+                invalid += 1
+                continue
+        else:
+            value = line
+        for item in payload_objects(value):
+            if (
+                "id" in item
+                and "user" in item
+                and ("full_text" in item or "text" in item)
+            ):
+                utils.fix_streaming_tweet(item)
+                tweets.append(item)
+            elif "id" in item and "screen_name" in item:
+                users.append(item)
+            else:
+                skipped += 1
+    return len(tweets), utils.collect_tweet_batches(tweets), users, skipped, invalid
+
+
+def ingest_paths(db, paths, batch_size=1000, processes=1):
+    """
+    Save every tweet and user in the payload files at paths, in transactions
+    of up to batch_size lines, returning counts and timings.
+    """
+    utils.ensure_tables(db)
+    stats = {
+        "files": 0,
+        "tweets": 0,
+        "users": 0,
+        "skipped": 0,
+        "invalid": 0,
+        "bytes": 0,
+    }
+    start = time.perf_counter()
+    written_media = set()
+
+    def batches():
+        for path in paths:
+            fp = open_payload(path)
+            try:
+                for num_bytes, batch in read_batches(fp, batch_size):
+                    stats["bytes"] += num_bytes
+                    yield batch
+            except ValueError as e:
+                raise click.ClickException(
+                    "{}: not valid JSON or JSONL: {}".format(path, e)
+                )
+            finally:
+                if path != "-":
+                    fp.close()
+            stats["files"] += 1
+
+    def save(result):
+        num_tweets, tweet_batches, users, skipped, invalid = result
+        if num_tweets:
+            tweet_batches = utils.finish_tweet_batches(db, tweet_batches, written_media)
+            utils.save_tweet_batches(db, tweet_batches, written_media)
+        if users:
+            utils.save_users(db, users)
+        stats["tweets"] += num_tweets
+        stats["users"] += len(users)
+        stats["skipped"] += skipped
+        stats["invalid"] += invalid
+
+    if processes > 1:
+        with multiprocessing.Pool(processes) as pool:
+            # Submitted from here rather than by Pool.imap(), so that reading
+            # stays at most 2 * processes batches ahead of what has been saved
+            pending = collections.deque()
+            for batch in batches():
+                pending.append(pool.apply_async(parse_batch, (batch,)))
+                if len(pending) >= 2 * processes:
+                    save(pending.popleft().get())
+            while pending:
+                save(pending.popleft().get())
+    else:
+        for batch in batches():
+            save(parse_batch(batch))
+    stats["elapsed"] = time.perf_counter() - start
+    return stats
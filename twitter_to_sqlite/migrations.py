@@ -1,4 +1,4 @@
-from .utils import extract_and_save_source
+from .utils import extract_and_save_source, SINCE_ID_TYPES
 
 MIGRATIONS = []
 
@@ -26,3 +26,15 @@ def convert_source_column(db):
         db["tweets"].add_foreign_key("source")
     except Exception:
         pass
+
+
+@migration
+def add_since_ids_min_id(db):
+    if "since_ids" not in set(db.table_names()):
+        return
+    if "min_id" not in db["since_ids"].columns_dict:
+        db["since_ids"].add_column("min_id", int)
+    db["since_id_types"].insert_all(
+        [{"id": id, "name": name} for name, id in SINCE_ID_TYPES.items()],
+        ignore=True,
+    )
@@ -1,26 +1,49 @@
 import click
+import collections
+import contextlib
 import datetime
+import functools
+import hashlib
 import html
 import json
+import multiprocessing
+import os
 import pathlib
+import queue
 import re
+import signal
 import sqlite3
+import threading
 import time
 import urllib.parse
+import weakref
 import zipfile
 
 from dateutil import parser
 from requests_oauthlib import OAuth1Session
+import requests
+import urllib3
 import sqlite_utils
+from sqlite_utils.db import jsonify_if_needed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Twitter API error codes
 RATE_LIMIT_ERROR_CODE = 88
+# "Could not authenticate you" and "Invalid or expired token"
+AUTH_ERROR_CODES = {32, 89}
+# users/lookup found none of the requested users
+NO_USER_MATCHES_ERROR_CODE = 17
 
 SINCE_ID_TYPES = {
     "user": 1,
     "home": 2,
     "mentions": 3,
     "search": 4,
+    "favorites": 5,
 }
 COUNT_HISTORY_TYPES = {
     "followers": 1,
@@ -32,7 +55,138 @@ COUNT_HISTORY_TYPES = {
     # "statuses": 5,
 }
 
+# Known v1.1 fields, created up front so that inserts rarely need to alter
+# the table. Anything else still gets added as a column when first seen.
+TWEETS_COLUMNS = {
+    "id": int,
+    "user": int,
+    "created_at": str,
+    "full_text": str,
+    "retweeted_status": int,
+    "quoted_status": int,
+    "place": str,
+    "source": str,
+    "truncated": int,
+    "display_text_range": str,
+    "in_reply_to_status_id": int,
+    "in_reply_to_user_id": int,
+    "in_reply_to_screen_name": str,
+    "geo": str,
+    "coordinates": str,
+    "contributors": str,
+    "is_quote_status": int,
+    "quote_count": int,
+    "reply_count": int,
+    "retweet_count": int,
+    "favorite_count": int,
+    "favorited": int,
+    "retweeted": int,
+    "possibly_sensitive": int,
+    "lang": str,
+    # Streaming API
+    "text": str,
+    "filter_level": str,
+    "timestamp_ms": str,
+    # Search API
+    "metadata": str,
+    "withheld_copyright": int,
+    "withheld_in_countries": str,
+    "withheld_scope": str,
+}
+USERS_COLUMNS = {
+    "id": int,
+    "screen_name": str,
+    "name": str,
+    "description": str,
+    "location": str,
+    "url": str,
+    "protected": int,
+    "followers_count": int,
+    "friends_count": int,
+    "listed_count": int,
+    "created_at": str,
+    "favourites_count": int,
+    "utc_offset": str,
+    "time_zone": str,
+    "geo_enabled": int,
+    "verified": int,
+    "statuses_count": int,
+    "lang": str,
+    "contributors_enabled": int,
+    "is_translator": int,
+    "is_translation_enabled": int,
+    "profile_background_color": str,
+    "profile_background_image_url": str,
+    "profile_background_image_url_https": str,
+    "profile_background_tile": int,
+    "profile_image_url": str,
+    "profile_image_url_https": str,
+    "profile_banner_url": str,
+    "profile_link_color": str,
+    "profile_sidebar_border_color": str,
+    "profile_sidebar_fill_color": str,
+    "profile_text_color": str,
+    "profile_use_background_image": int,
+    "has_extended_profile": int,
+    "default_profile": int,
+    "default_profile_image": int,
+    "following": int,
+    "follow_request_sent": int,
+    "notifications": int,
+    "translator_type": str,
+    "withheld_in_countries": str,
+    "withheld_scope": str,
+}
+PLACES_COLUMNS = {
+    "id": str,
+    "url": str,
+    "place_type": str,
+    "name": str,
+    "full_name": str,
+    "country_code": str,
+    "country": str,
+    "contained_within": str,
+    "bounding_box": str,
+    "attributes": str,
+}
+MEDIA_COLUMNS = {
+    "id": int,
+    "id_str": str,
+    "indices": str,
+    "media_url": str,
+    "media_url_https": str,
+    "url": str,
+    "display_url": str,
+    "expanded_url": str,
+    "type": str,
+    "sizes": str,
+    "original_info": str,
+    "video_info": str,
+    "additional_media_info": str,
+    "ext_alt_text": str,
+    "source_status_id": int,
+    "source_status_id_str": str,
+    "source_user_id": int,
+    "source_user_id_str": str,
+}
+CANONICAL_COLUMNS = {
+    "tweets": TWEETS_COLUMNS,
+    "users": USERS_COLUMNS,
+    "places": PLACES_COLUMNS,
+    "media": MEDIA_COLUMNS,
+}
+
 source_re = re.compile('<a href="(?P<url>.*?)".*?>(?P<name>.*?)</a>')
+# Twitter's created_at format, e.g. "Wed Oct 10 20:19:24 +0000 2018"
+twitter_datetime_re = re.compile(
+    r"^(?:Mon|Tue|Wed|Thu|Fri|Sat|Sun) "
+    r"(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec) "
+    r"(\d\d) (\d\d):(\d\d):(\d\d) ([+-])(\d\d)(\d\d) (\d{4})$"
+)
+MONTHS = {
+    month: i + 1
+    for i, month in enumerate("Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split())
+}
 
 
 class UserDoesNotExist(click.ClickException):
@@ -40,6 +194,22 @@ class UserDoesNotExist(click.ClickException):
         super().__init__("User '{}' does not exist".format(identifier))
 
 
+def json_loads(s):
+    "Decode JSON str or bytes, using orjson if it is installed"
+    if orjson is not None:
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            # orjson rejects some things json accepts, e.g. NaN or non-UTF-8
+            pass
+    return json.loads(s)
+
+
+def response_json(response):
+    "Like response.json() but decoded with json_loads()"
+    return json_loads(response.content)
+
+
 def open_database(db_path):
     db = sqlite_utils.Database(db_path)
     # Only run migrations if this is an existing DB (has tables)
@@ -51,7 +221,7 @@ def open_database(db_path):
 def migrate(db):
     from twitter_to_sqlite.migrations import MIGRATIONS
 
-    if "migrations" not in db.table_names():
+    if "migrations" not in schema_state(db).table_names():
         db["migrations"].create({"name": str, "applied": str}, pk="name")
     applied_migrations = {
         m[0] for m in db.conn.execute("select name from migrations").fetchall()
@@ -75,28 +245,325 @@ def session_for_auth(auth):
     )
 
 
+class RateLimiter:
+    """
+    Tracks the x-rate-limit-* headers for each API endpoint.
+
+    Each endpoint is a token bucket holding the number of calls Twitter says
+    are remaining, which refills when the window resets. acquire() only
+    sleeps when the bucket is empty, and then only until the reset time.
+    Async code should use try_acquire() and wait_time() instead, as acquire()
+    would block the event loop.
+    """
+
+    def __init__(self, margin=1):
+        # Seconds to wait past the reset time, to allow for clock skew
+        self.margin = margin
+        self.lock = threading.Lock()
+        self.budgets = {}
+
+    @staticmethod
+    def endpoint(url):
+        return urllib.parse.urlparse(url).path
+
+    def update(self, endpoint, headers):
+        remaining = headers.get("x-rate-limit-remaining")
+        reset = headers.get("x-rate-limit-reset")
+        if remaining is None or reset is None:
+            return
+        with self.lock:
+            self.budgets[endpoint] = {
+                "limit": int(headers.get("x-rate-limit-limit") or 0) or None,
+                "remaining": int(remaining),
+                "reset": int(reset),
+            }
+
+    def exhausted(self, endpoint):
+        "Mark endpoint as having no calls left, e.g. after a 429 response"
+        with self.lock:
+            budget = self.budgets.setdefault(
+                endpoint, {"limit": None, "remaining": 0, "reset": None}
+            )
+            budget["remaining"] = 0
+            if budget["reset"] is None or budget["reset"] < time.time():
+                # No reset time to go on, so wait out a full 15 minute window
+                budget["reset"] = int(time.time()) + 15 * 60
+
+    def budget(self, endpoint):
+        "Returns {limit, remaining, reset} for endpoint, or None if unknown"
+        with self.lock:
+            budget = self.budgets.get(endpoint)
+            if budget is None:
+                return None
+            budget = dict(budget)
+        if budget["reset"] is not None and budget["reset"] <= time.time():
+            # The window has reset since we last heard
+            budget["remaining"] = budget["limit"]
+        return budget
+
+    def wait_time(self, endpoint):
+        budget = self.budget(endpoint)
+        if budget is None or budget["remaining"] is None or budget["remaining"] > 0:
+            return 0
+        return max(0, budget["reset"] + self.margin - time.time())
+
+    def try_acquire(self, endpoint):
+        "Use up a call to endpoint if one is available, returning False if not"
+        with self.lock:
+            budget = self.budgets.get(endpoint)
+            if budget is None:
+                return True
+            if budget["reset"] is not None and budget["reset"] <= time.time():
+                budget["remaining"] = budget["limit"]
+                budget["reset"] = None
+            if budget["remaining"] == 0 and budget["reset"] is not None:
+                return False
+            if budget["remaining"]:
+                budget["remaining"] -= 1
+            return True
+
+    def acquire(self, endpoint):
+        "Sleep until endpoint has a call available, then use it up"
+        while not self.try_acquire(endpoint):
+            time.sleep(self.wait_time(endpoint))
+
+
+_rate_limiters = weakref.WeakKeyDictionary()
+
+
+def rate_limiter(session):
+    "Return the RateLimiter shared by everything using this session"
+    limiter = _rate_limiters.get(session)
+    if limiter is None:
+        limiter = _rate_limiters[session] = RateLimiter()
+    return limiter
+
+
+def api_get(session, url, params=None, max_retries=5):
+    "session.get() that waits for rate limits and retries 429 responses"
+    if isinstance(session, SessionPool):
+        return session.get(url, params=params, max_retries=max_retries)
+    limiter = rate_limiter(session)
+    endpoint = limiter.endpoint(url)
+    for _ in range(max_retries):
+        limiter.acquire(endpoint)
+        response = session.get(url, params=params)
+        limiter.update(endpoint, response.headers)
+        if response.status_code != 429:
+            return response
+        limiter.exhausted(endpoint)
+    return response
+
+
+def mark_rate_limited(session, url, response):
+    """
+    Record that response, from a call to url, reported a rate limit error.
+    A SessionPool parks the credential that made the call, otherwise the next
+    call to that endpoint waits for its window to reset.
+    """
+    if isinstance(session, SessionPool):
+        session.rate_limited(url, response)
+    else:
+        limiter = rate_limiter(session)
+        limiter.exhausted(limiter.endpoint(url))
+
+
+def load_auths(paths):
+    """
+    Load credentials from auth.json files, or from directories of them.
+
+    Returns a list of (name, auth) pairs.
+    """
+    if isinstance(paths, (str, pathlib.Path)):
+        paths = [paths]
+    auths = []
+    for path in paths:
+        path = pathlib.Path(path)
+        files = sorted(path.glob("*.json")) if path.is_dir() else [path]
+        for file in files:
+            auths.append((str(file), json.load(open(file))))
+    return auths
+
+
+class PooledCredential:
+    def __init__(self, name, session):
+        self.name = name
+        self.session = session
+        self.limiter = RateLimiter()
+        self.requests = 0
+        self.rate_limited = 0
+        self.revoked = False
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "requests": self.requests,
+            "rate_limited": self.rate_limited,
+            "revoked": self.revoked,
+        }
+
+
+class SessionPool:
+    """
+    Spreads API calls across several sets of credentials.
+
+    Each call goes to the credential with the most remaining budget for that
+    endpoint. Rate limited credentials are parked until their window resets,
+    and credentials that fail to authenticate are dropped for the rest of
+    the run. Other 401s, such as for protected accounts, are returned as
+    they are. Can be used anywhere an OAuth1Session is expected.
+    """
+
+    def __init__(self, auths, session_factory=None):
+        session_factory = session_factory or session_for_auth
+        self.credentials = [
+            PooledCredential(name, session_factory(auth)) for name, auth in auths
+        ]
+        self.lock = threading.Lock()
+
+    def choose(self, endpoint):
+        "Credential that can make the next call to endpoint soonest"
+        active = [c for c in self.credentials if not c.revoked]
+        if not active:
+            return None
+
+        def key(credential):
+            budget = credential.limiter.budget(endpoint)
+            remaining = None if budget is None else budget["remaining"]
+            if remaining is None:
+                # Not used against this endpoint yet, so has its full budget
+                remaining = float("inf")
+            return (
+                credential.limiter.wait_time(endpoint),
+                -remaining,
+                credential.requests,
+            )
+
+        return min(active, key=key)
+
+    def get(self, url, params=None, max_retries=5):
+        endpoint = RateLimiter.endpoint(url)
+        response = None
+        retries = 0
+        while retries < max_retries:
+            credential = self.checkout(endpoint)
+            if credential is None:
+                break
+            credential.limiter.acquire(endpoint)
+            response = credential.session.get(url, params=params)
+            # So that mark_rate_limited() can find the credential that was used
+            response.pooled_credential = credential
+            credential.limiter.update(endpoint, response.headers)
+            if response.status_code == 401 and is_auth_error(response):
+                with self.lock:
+                    credential.revoked = True
+            elif response.status_code == 429:
+                self.rate_limited(url, response)
+                retries += 1
+            else:
+                break
+        if response is None:
+            raise click.ClickException("Every credential has been revoked")
+        return response
+
+    def post(self, url, **kwargs):
+        "Streaming connections are made using the first working credential"
+        credential = self.checkout(RateLimiter.endpoint(url))
+        if credential is None:
+            raise click.ClickException("Every credential has been revoked")
+        return credential.session.post(url, **kwargs)
+
+    def checkout(self, endpoint):
+        "Choose a credential for a call to endpoint and count the request"
+        with self.lock:
+            credential = self.choose(endpoint)
+            if credential is not None:
+                credential.requests += 1
+        return credential
+
+    def rate_limited(self, url, response):
+        "Park the credential that made response until its window resets"
+        credential = getattr(response, "pooled_credential", None)
+        if credential is None:
+            return
+        with self.lock:
+            credential.rate_limited += 1
+        credential.limiter.exhausted(RateLimiter.endpoint(url))
+
+    def stats(self):
+        return [credential.stats() for credential in self.credentials]
+
+
+def is_auth_error(response):
+    """
+    Did the credentials fail? Protected timelines and follower lists also
+    return 401, with a "Not authorized." error that has no code.
+    """
+    try:
+        errors = response_json(response).get("errors")
+    except (ValueError, AttributeError):
+        return False
+    return any(
+        isinstance(error, dict) and error.get("code") in AUTH_ERROR_CODES
+        for error in errors or []
+    )
+
+
 def fetch_user_list_chunks(
-    session, user_id=None, screen_name=None, sleep=61, noun="followers"
+    session, user_id=None, screen_name=None, sleep=None, noun="followers"
+):
+    for users, _ in fetch_user_list_pages(
+        session, user_id, screen_name, noun=noun, sleep=sleep
+    ):
+        yield users
+
+
+def fetch_user_list_pages(
+    session,
+    user_id=None,
+    screen_name=None,
+    noun="followers",
+    db=None,
+    resume=False,
+    sleep=None,
 ):
+    """
+    Returns a generator of (users, checkpoint) for each page of followers or
+    friends. With resume=True it starts from the cursor saved in db.
+    """
+    url = "https://api.twitter.com/1.1/{}/list.json".format(noun)
+    args = user_args(user_id, screen_name)
+    args["count"] = 200
+    checkpoint_key = "id:{}".format(user_id) if user_id else screen_name
     cursor = -1
-    users = []
-    while cursor:
-        headers, body = fetch_user_list(session, cursor, user_id, screen_name, noun)
-        yield body["users"]
-        cursor = body["next_cursor"]
-        if not cursor:
-            break
-        time.sleep(sleep)  # Rate limit = 15 per 15 minutes!
+    if resume:
+        cursor = load_cursor_checkpoint(db, url, checkpoint_key)
+    return cursor_pages(
+        session,
+        url,
+        args,
+        "users",
+        checkpoint_key=checkpoint_key,
+        cursor=cursor,
+        sleep=sleep,
+    )
+
+
+def extra_sleep(sleep):
+    # Rate limits are handled by api_get(), this is for any additional delay
+    if sleep:
+        time.sleep(sleep)
 
 
 def fetch_user_list(session, cursor, user_id=None, screen_name=None, noun="followers"):
     args = user_args(user_id, screen_name)
     args.update({"count": 200, "cursor": cursor})
-    r = session.get(
+    r = api_get(
+        session,
         "https://api.twitter.com/1.1/{}/list.json?".format(noun)
-        + urllib.parse.urlencode(args)
+        + urllib.parse.urlencode(args),
     )
-    return r.headers, r.json()
+    return r.headers, response_json(r)
 
 
 def fetch_lists(db, session, user_id=None, screen_name=None):
@@ -105,32 +572,40 @@ def fetch_lists(db, session, user_id=None, screen_name=None):
     args["count"] = 1000
     fetched_lists = []
     # For the moment we don't paginate
-    for list_row in session.get(lists_url, params=args).json()["lists"]:
+    for list_row in response_json(api_get(session, lists_url, params=args))["lists"]:
         del list_row["id_str"]
         user = list_row.pop("user")
         save_users(db, [user])
         list_row["user"] = user["id"]
-        list_row["created_at"] = parser.parse(list_row["created_at"])
+        list_row["created_at"] = parse_datetime(list_row["created_at"])
         fetched_lists.append(list_row)
     db["lists"].insert_all(fetched_lists, pk="id", foreign_keys=("user",), replace=True)
     return fetched_lists
 
 
 def get_profile(db, session, user_id=None, screen_name=None):
+    profile = fetch_profile(session, user_id, screen_name)
+    save_users(db, [profile])
+    return profile
+
+
+def fetch_profile(session, user_id=None, screen_name=None):
+    "Like get_profile() but without saving, so it can run on any thread"
     if not (user_id or screen_name):
-        profile = session.get(
-            "https://api.twitter.com/1.1/account/verify_credentials.json"
-        ).json()
+        profile = response_json(
+            api_get(
+                session, "https://api.twitter.com/1.1/account/verify_credentials.json"
+            )
+        )
     else:
         args = user_args(user_id, screen_name)
         url = "https://api.twitter.com/1.1/users/show.json"
         if args:
             url += "?" + urllib.parse.urlencode(args)
-        response = session.get(url)
+        response = api_get(session, url)
         if response.status_code == 404:
             raise UserDoesNotExist(screen_name or user_id)
-        profile = response.json()
-    save_users(db, [profile])
+        profile = response_json(response)
     return profile
 
 
@@ -139,32 +614,126 @@ def fetch_timeline(
     url,
     db,
     args=None,
-    sleep=1,
+    sleep=None,
+    stop_after=None,
+    key=None,
+    since_id=None,
+    since=False,
+    since_type=None,
+    since_key=None,
+):
+    yield from tweets_from_pages(
+        db,
+        fetch_timeline_pages(
+            session,
+            url,
+            db,
+            args,
+            sleep=sleep,
+            stop_after=stop_after,
+            key=key,
+            since_id=since_id,
+            since=since,
+            since_type=since_type,
+            since_key=since_key,
+        ),
+    )
+
+
+def fetch_timeline_pages(
+    session,
+    url,
+    db,
+    args=None,
+    sleep=None,
     stop_after=None,
     key=None,
     since_id=None,
     since=False,
     since_type=None,
     since_key=None,
+    backfill=False,
+):
+    """
+    Returns a generator of (tweets, checkpoint) pairs, one per API page.
+
+    checkpoint is a since_ids row to save once those tweets are stored, or
+    None. The database is only read here, before the generator starts, so
+    the pages can be fetched on another thread - see pipeline().
+
+    backfill=True continues an interrupted fetch from the oldest tweet it
+    saved. See TimelineRange for how the fetched range is tracked.
+    """
+    args, timeline_range = timeline_args(
+        db, args, stop_after, since_id, since, since_type, since_key, backfill
+    )
+
+    def pages():
+        num_rate_limit_errors = 0
+        while True:
+            response = api_get(session, url, params=args)
+            tweets = response_json(response)
+            if "errors" in tweets:
+                # Was it a rate limit error? If so wait for the reset and try again
+                if RATE_LIMIT_ERROR_CODE == tweets["errors"][0]["code"]:
+                    num_rate_limit_errors += 1
+                    assert num_rate_limit_errors < 5, "More than 5 rate limit errors"
+                    mark_rate_limited(session, url, response)
+                    continue
+                else:
+                    raise Exception(str(tweets["errors"]))
+            if key is not None:
+                tweets = tweets[key]
+            if not tweets:
+                checkpoint = timeline_range.finished()
+                if checkpoint is not None:
+                    yield [], checkpoint
+                break
+            args["max_id"] = min(t["id"] for t in tweets) - 1
+            checkpoint, reached_saved = timeline_range.page(tweets)
+            yield tweets, checkpoint
+            if stop_after is not None or reached_saved:
+                break
+            extra_sleep(sleep)
+
+    return pages()
+
+
+def timeline_args(
+    db,
+    args=None,
+    stop_after=None,
+    since_id=None,
+    since=False,
+    since_type=None,
+    since_key=None,
+    backfill=False,
 ):
+    """
+    Returns (args, timeline_range) for fetching a timeline: the API arguments
+    for the first page, and a TimelineRange for its checkpoints.
+    """
     # See https://developer.twitter.com/en/docs/tweets/timelines/guides/working-with-timelines
     if since and since_id:
         raise click.ClickException("Use either --since or --since_id, not both")
+    if backfill and (since or since_id):
+        raise click.ClickException("Use either --since or --backfill, not both")
 
     since_type_id = None
     last_since_id = None
+    last_min_id = None
     if since_type is not None:
         assert since_key is not None
         since_type_id = SINCE_ID_TYPES[since_type]
-        # Figure out the last since_id in case we need it
+        # Figure out the last fetched range in case we need it
         try:
-            last_since_id = db.conn.execute(
+            last_since_id, last_min_id = db.conn.execute(
                 """
-                select since_id from since_ids
+                select since_id, min_id from since_ids
                 where type = ? and key = ?
                 """,
                 [since_type_id, since_key],
-            ).fetchall()[0][0]
+            ).fetchall()[0]
         except (IndexError, sqlite3.OperationalError):
             pass
 
@@ -178,51 +747,227 @@ def fetch_timeline(
         args["count"] = stop_after
     if since_id:
         args["since_id"] = since_id
+    if backfill and last_min_id is not None:
+        args["max_id"] = last_min_id - 1
     args["tweet_mode"] = "extended"
-    min_seen_id = None
-    num_rate_limit_errors = 0
-    while True:
-        if min_seen_id is not None:
-            args["max_id"] = min_seen_id - 1
-        response = session.get(url, params=args)
-        tweets = response.json()
-        if "errors" in tweets:
-            # Was it a rate limit error? If so sleep and try again
-            if RATE_LIMIT_ERROR_CODE == tweets["errors"][0]["code"]:
-                num_rate_limit_errors += 1
-                assert num_rate_limit_errors < 5, "More than 5 rate limit errors"
-                print(
-                    "Rate limit exceeded - will sleep 15s and try again {}".format(
-                        repr(response.headers)
-                    )
-                )
-                time.sleep(15)
-                continue
-            else:
-                raise Exception(str(tweets["errors"]))
-        if key is not None:
-            tweets = tweets[key]
-        if not tweets:
-            break
-        for tweet in tweets:
-            yield tweet
-        min_seen_id = min(t["id"] for t in tweets)
-        max_seen_id = max(t["id"] for t in tweets)
-        if last_since_id is not None:
-            max_seen_id = max((last_since_id, max_seen_id))
-            last_since_id = max_seen_id
-        if since_type_id is not None and since_key is not None:
-            db["since_ids"].insert(
-                {
-                    "type": since_type_id,
-                    "key": since_key,
-                    "since_id": max_seen_id,
-                },
-                replace=True,
-            )
-        if stop_after is not None:
-            break
-        time.sleep(sleep)
+
+    if since_id:
+        mode = "since"
+    elif last_min_id is None:
+        mode = "new"
+    elif backfill:
+        mode = "backfill"
+    else:
+        mode = "refresh"
+    timeline_range = TimelineRange(
+        since_type_id,
+        since_key,
+        last_since_id,
+        last_min_id,
+        mode,
+        # --since_id options are strings
+        int(since_id) if since_id else None,
+    )
+    return args, timeline_range
+
+
+class TimelineRange:
+    """
+    Tracks the range of tweet IDs fetched from a timeline.
+
+    since_ids records the newest (since_id) and oldest (min_id) tweets
+    fetched, and everything between the two has been fetched. The mode says
+    how this run relates to that range:
+
+    - "new": nothing is known, so the fetched range starts at the newest tweet
+    - "since": only tweets newer than fetch_since_id are fetched. Once the
+      run has fetched all of them the saved range is extended up, if
+      fetch_since_id is within it, or else left alone so the gap between
+      them is not recorded as fetched
+    - "backfill": paging continues down from min_id, extending it down
+    - "refresh": fetching from the newest tweet until reaching since_id, at
+      which point the rest are already saved and fetching can stop early
+    """
+
+    def __init__(
+        self, since_type_id, since_key, since_id, min_id, mode, fetch_since_id=None
+    ):
+        self.since_type_id = since_type_id
+        self.since_key = since_key
+        self.since_id = since_id
+        self.min_id = min_id
+        self.mode = mode
+        self.fetch_since_id = fetch_since_id
+        # Range covered by this run
+        self.top = None
+        self.bottom = None
+
+    def checkpoint(self, since_id, min_id):
+        if self.since_type_id is None or self.since_key is None:
+            return None
+        return {
+            "type": self.since_type_id,
+            "key": self.since_key,
+            "since_id": since_id,
+            "min_id": min_id,
+        }
+
+    def page(self, tweets):
+        "Returns (checkpoint, reached_saved) after fetching a page of tweets"
+        ids = [t["id"] for t in tweets]
+        self.top = max(ids + ([self.top] if self.top else []))
+        self.bottom = min(ids + ([self.bottom] if self.bottom else []))
+        newest = max(self.top, self.since_id or 0)
+        if self.mode == "backfill":
+            return self.checkpoint(newest, self.bottom), False
+        if self.mode == "since":
+            if self.bottom > self.fetch_since_id:
+                return None, False
+            return self.since_checkpoint(), True
+        if self.mode == "refresh":
+            if self.bottom > self.since_id:
+                # Not joined up with the saved range yet, so nothing to record
+                return None, False
+            return self.checkpoint(newest, self.joined_min_id()), True
+        return self.checkpoint(newest, self.bottom), False
+
+    def joined_min_id(self):
+        if self.min_id is None:
+            return self.bottom
+        return min(self.bottom, self.min_id)
+
+    def since_checkpoint(self):
+        if self.since_id is None:
+            # Nothing saved, so the range is just what this run fetched
+            return self.checkpoint(self.top, self.bottom)
+        if self.fetch_since_id > self.since_id:
+            # Tweets between the saved range and this run were never fetched
+            return None
+        return self.checkpoint(max(self.top, self.since_id), self.joined_min_id())
+
+    def finished(self):
+        "Checkpoint to save on reaching the end of the timeline, if any"
+        if self.top is None:
+            return None
+        if self.mode == "since":
+            # The API only returns tweets newer than since_id, so running out
+            # of tweets means this run has fetched everything down to it
+            return self.since_checkpoint()
+        if self.mode == "refresh":
+            # Never reached the saved range, e.g. it has aged out of the API
+            return self.checkpoint(self.top, self.bottom)
+        return None
+
+
+def tweets_from_pages(db, pages):
+    "Yield each tweet from (tweets, checkpoint) pages, saving the checkpoints"
+    for tweets, checkpoint in pages:
+        yield from tweets
+        save_checkpoint(db, checkpoint)
+
+
+def save_checkpoint(db, checkpoint):
+    if checkpoint is not None:
+        db["since_ids"].insert(checkpoint, replace=True)
+
+
+def pipeline(pages, queue_size=4):
+    """
+    Yield items from pages, which are fetched ahead on a background thread.
+
+    At most queue_size items wait in the queue, so a slow consumer holds the
+    fetcher back. Exceptions from the fetcher are re-raised here, and if the
+    consumer stops early the fetcher stops before fetching anything else.
+    """
+    return pipeline_many([pages], concurrency=1, queue_size=queue_size)
+
+
+def pipeline_many(generators, concurrency=4, queue_size=None):
+    """
+    Like pipeline(), but runs several generators on concurrency threads.
+
+    Items are yielded in the order they arrive, so items from different
+    generators are interleaved but each generator's own items stay in order.
+    generators is consumed by the worker threads, so anything that needs
+    the database should be done before they are created.
+    """
+    reader = ReadAhead(generators, concurrency, queue_size or 4 * concurrency)
+    try:
+        while True:
+            item = reader.get()
+            if item is ReadAhead.DONE:
+                break
+            yield item
+    finally:
+        reader.close(timeout=1)
+
+
+class ReadAhead:
+    """
+    Reads the items from sources, an iterable of iterables, on background
+    threads. At most queue_size items wait to be taken with get(), so a slow
+    consumer holds the readers back.
+
+    get() re-raises any error from a source, in order with the items, and
+    returns DONE once every source is finished. After close() the readers
+    stop without reading anything else.
+    """
+
+    DONE = object()
+
+    def __init__(self, sources, threads=1, queue_size=4):
+        self.items = queue.Queue(maxsize=queue_size)
+        self.stop = threading.Event()
+        self.sources = iter(sources)
+        self.lock = threading.Lock()
+        self.running = threads
+        self.threads = [
+            threading.Thread(target=self.read, daemon=True) for _ in range(threads)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, item):
+        while not self.stop.is_set():
+            try:
+                self.items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read(self):
+        try:
+            while True:
+                with self.lock:
+                    source = next(self.sources, None)
+                if source is None:
+                    break
+                for item in source:
+                    if not self.put((False, item)):
+                        return
+        except BaseException as e:
+            self.put((True, e))
+        else:
+            self.put((True, None))
+
+    def get(self, timeout=None):
+        "The next item or DONE, raising queue.Empty if nothing arrives in time"
+        while self.running:
+            done, value = self.items.get(timeout=timeout)
+            if not done:
+                return value
+            if value is not None:
+                raise value
+            self.running -= 1
+        return self.DONE
+
+    def close(self, timeout=None):
+        "Stop the readers, waiting up to timeout seconds for each to finish"
+        self.stop.set()
+        if timeout is not None:
+            for thread in self.threads:
+                thread.join(timeout=timeout)
 
 
 def fetch_user_timeline(
@@ -233,33 +978,64 @@ def fetch_user_timeline(
     stop_after=None,
     since_id=None,
     since=False,
+    backfill=False,
+):
+    yield from tweets_from_pages(
+        db,
+        fetch_user_timeline_pages(
+            session, db, user_id, screen_name, stop_after, since_id, since, backfill
+        ),
+    )
+
+
+def fetch_user_timeline_pages(
+    session,
+    db,
+    user_id=None,
+    screen_name=None,
+    stop_after=None,
+    since_id=None,
+    since=False,
+    backfill=False,
 ):
     args = user_args(user_id, screen_name)
-    yield from fetch_timeline(
+    return fetch_timeline_pages(
         session,
         "https://api.twitter.com/1.1/statuses/user_timeline.json",
         db,
         args,
-        sleep=1,
         stop_after=stop_after,
         since_id=since_id,
         since_type="user",
         since_key="id:{}".format(user_id) if user_id else screen_name,
         since=since,
+        backfill=backfill,
+    )
+
+
+def fetch_favorites(
+    session, db, user_id=None, screen_name=None, stop_after=None, backfill=False
+):
+    yield from tweets_from_pages(
+        db,
+        fetch_favorites_pages(session, db, user_id, screen_name, stop_after, backfill),
     )
 
 
-def fetch_favorites(session, db, user_id=None, screen_name=None, stop_after=None):
+def fetch_favorites_pages(
+    session, db, user_id=None, screen_name=None, stop_after=None, backfill=False
+):
     args = user_args(user_id, screen_name)
-    # Rate limit 75/15 mins = 5/minute = every 12 seconds
-    sleep = 12
-    yield from fetch_timeline(
+    since_key = "id:{}".format(user_id) if user_id else screen_name
+    return fetch_timeline_pages(
         session,
         "https://api.twitter.com/1.1/favorites/list.json",
         db,
         args,
-        sleep=sleep,
         stop_after=stop_after,
+        since_type="favorites" if since_key else None,
+        since_key=since_key,
+        backfill=backfill,
     )
 
 
@@ -273,6 +1049,36 @@ def user_args(user_id, screen_name):
 
 
 def expand_entities(s, entities):
+    "Replace t.co URLs in s with their expanded_url, in one pass using indices"
+    replacements = []
+    for ents in entities.values():
+        for ent in ents:
+            if "url" not in ent:
+                continue
+            indices = ent.get("indices")
+            if not indices or s[indices[0] : indices[1]] != ent["url"]:
+                # Missing or unreliable indices, fall back to search-and-replace
+                return _expand_entities_by_replace(s, entities)
+            replacements.append(
+                (indices[0], indices[1], ent["expanded_url"] or ent["url"])
+            )
+    if not replacements:
+        return s
+    replacements.sort()
+    parts = []
+    pos = 0
+    for start, end, replacement in replacements:
+        if start < pos:
+            # Same URL listed twice, e.g. multiple photos in one media entity
+            continue
+        parts.append(s[pos:start])
+        parts.append(replacement)
+        pos = end
+    parts.append(s[pos:])
+    return "".join(parts)
+
+
+def _expand_entities_by_replace(s, entities):
     for _, ents in entities.items():
         for ent in ents:
             if "url" in ent:
@@ -281,8 +1087,29 @@ def expand_entities(s, entities):
     return s
 
 
+@functools.lru_cache(maxsize=4096)
+def parse_datetime(s):
+    "Parse a Twitter created_at string, falling back to dateutil for other formats"
+    m = twitter_datetime_re.match(s)
+    if m is None:
+        return parser.parse(s)
+    month, day, hour, minute, second, sign, tz_hours, tz_minutes, year = m.groups()
+    offset = datetime.timedelta(hours=int(tz_hours), minutes=int(tz_minutes))
+    if sign == "-":
+        offset = -offset
+    return datetime.datetime(
+        int(year),
+        MONTHS[month],
+        int(day),
+        int(hour),
+        int(minute),
+        int(second),
+        tzinfo=datetime.timezone(offset),
+    )
+
+
 def transform_user(user):
-    user["created_at"] = parser.parse(user["created_at"])
+    user["created_at"] = parse_datetime(user["created_at"])
     if user["description"] and "description" in user.get("entities", {}):
         user["description"] = expand_entities(
             user["description"], user["entities"]["description"]
@@ -307,41 +1134,99 @@ def transform_tweet(tweet):
     for key in to_remove:
         if key in tweet:
             del tweet[key]
-    tweet["created_at"] = parser.parse(tweet["created_at"]).isoformat()
+    tweet["created_at"] = parse_datetime(tweet["created_at"]).isoformat()
+
+
+class SchemaState:
+    """
+    Cached view of the tables, columns and indexes in a database.
+
+    The cache is keyed on SQLite's schema_version, which changes whenever
+    anything alters the schema - so checking it is a single cheap pragma
+    rather than a scan of sqlite_master and table_info for every call.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.version = None
+        self.ensured_version = None
+        self._table_names = None
+        self._columns = {}
+        self._indexes = {}
+        self._fingerprints = {}
+
+    def refresh(self):
+        version = self.db.conn.execute("PRAGMA schema_version").fetchone()[0]
+        if version != self.version:
+            self.version = version
+            self._table_names = None
+            self._columns = {}
+            self._indexes = {}
+            self._fingerprints = {}
+        return self
+
+    def table_names(self):
+        self.refresh()
+        if self._table_names is None:
+            self._table_names = set(self.db.table_names())
+        return self._table_names
+
+    def column_names(self, table_name):
+        "Column names for table_name, in table order"
+        self.refresh()
+        if table_name not in self._columns:
+            names = list(self.db[table_name].columns_dict)
+            self._columns[table_name] = (names, {name.lower() for name in names})
+        return self._columns[table_name][0]
+
+    def columns(self, table_name):
+        "Lower-cased column names for table_name"
+        self.column_names(table_name)
+        return self._columns[table_name][1]
+
+    def fingerprints(self, table_name):
+        "Sets of row keys already known to fit the columns of table_name"
+        self.refresh()
+        return self._fingerprints.setdefault(table_name, set())
+
+    def indexes(self, table_name):
+        "Set of column tuples that have an index on table_name"
+        self.refresh()
+        if table_name not in self._indexes:
+            self._indexes[table_name] = {
+                tuple(index.columns) for index in self.db[table_name].indexes
+            }
+        return self._indexes[table_name]
+
+
+_schema_states = weakref.WeakKeyDictionary()
+
+
+def schema_state(db):
+    "Return the SchemaState registry for this Database"
+    state = _schema_states.get(db)
+    if state is None:
+        state = _schema_states[db] = SchemaState(db)
+    return state
 
 
 def ensure_tables(db):
-    table_names = set(db.table_names())
+    state = schema_state(db).refresh()
+    if state.ensured_version == state.version:
+        return
+    table_names = state.table_names()
     if "places" not in table_names:
-        db["places"].create({"id": str}, pk="id")
+        db["places"].create(PLACES_COLUMNS, pk="id")
     if "sources" not in table_names:
         db["sources"].create({"id": str, "name": str, "url": str}, pk="id")
     if "users" not in table_names:
-        db["users"].create(
-            {
-                "id": int,
-                "screen_name": str,
-                "name": str,
-                "description": str,
-                "location": str,
-            },
-            pk="id",
-        )
+        db["users"].create(USERS_COLUMNS, pk="id")
         db["users"].enable_fts(
             ["name", "screen_name", "description", "location"], create_triggers=True
         )
     if "tweets" not in table_names:
         db["tweets"].create(
-            {
-                "id": int,
-                "user": int,
-                "created_at": str,
-                "full_text": str,
-                "retweeted_status": int,
-                "quoted_status": int,
-                "place": str,
-                "source": str,
-            },
+            TWEETS_COLUMNS,
             pk="id",
             foreign_keys=(
                 ("user", "users", "id"),
@@ -352,6 +1237,14 @@ def ensure_tables(db):
         db["tweets"].enable_fts(["full_text"], create_triggers=True)
         db["tweets"].add_foreign_key("retweeted_status", "tweets")
         db["tweets"].add_foreign_key("quoted_status", "tweets")
+    if "media" not in table_names:
+        db["media"].create(MEDIA_COLUMNS, pk="id")
+    # Tables from older versions may be missing some of the canonical columns
+    for table_name, columns in CANONICAL_COLUMNS.items():
+        existing = state.columns(table_name)
+        missing = [name for name in columns if name.lower() not in existing]
+        for name in missing:
+            db[table_name].add_column(name, columns[name])
     if "following" not in table_names:
         db["following"].create(
             {"followed_id": int, "follower_id": int, "first_seen": str},
@@ -362,7 +1255,7 @@ def ensure_tables(db):
             ),
         )
     # Ensure following has indexes
-    following_indexes = {tuple(i.columns) for i in db["following"].indexes}
+    following_indexes = state.indexes("following")
     if ("followed_id",) not in following_indexes:
         db["following"].create_index(["followed_id"])
     if ("follower_id",) not in following_indexes:
@@ -381,11 +1274,34 @@ def ensure_tables(db):
             [{"id": id, "name": name} for name, id in SINCE_ID_TYPES.items()]
         )
         db["since_ids"].create(
-            {"type": int, "key": str, "since_id": int},
+            {"type": int, "key": str, "since_id": int, "min_id": int},
             pk=("type", "key"),
             foreign_keys=(("type", "since_id_types", "id"),),
         )
 
+    # Table for resuming cursor paginated fetches with --resume
+    if "cursor_checkpoints" not in table_names:
+        db["cursor_checkpoints"].create(
+            {"endpoint": str, "key": str, "cursor": int, "updated": str},
+            pk=("endpoint", "key"),
+        )
+
+    # Table recording when each user profile was last fetched
+    if "user_fetches" not in table_names:
+        db["user_fetches"].create(
+            {"user": int, "fetched": str},
+            pk="user",
+            foreign_keys=(("user", "users", "id"),),
+        )
+
+    # Table of referenced tweets that statuses/lookup did not return
+    if "tweet_tombstones" not in table_names:
+        db["tweet_tombstones"].create({"id": int, "checked": str}, pk="id")
+
+    # Table of referenced users that users/lookup did not return
+    if "user_tombstones" not in table_names:
+        db["user_tombstones"].create({"id": int, "checked": str}, pk="id")
+
     # Tables for recording history of user follower counts etc
     if "count_history" not in table_names:
         db["count_history_types"].create(
@@ -407,43 +1323,222 @@ def ensure_tables(db):
             ),
         )
 
+    state.ensured_version = state.refresh().version
 
-def save_tweets(db, tweets, favorited_by=None):
+
+def save_tweets(db, tweets, favorited_by=None, batch_size=100):
     ensure_tables(db)
+    written_media = set()
+    # tweets may be a generator wrapping API calls, so write as we go
+    for chunk in chunks(tweets, batch_size):
+        batches = tweet_batches(db, chunk, favorited_by, written_media)
+        save_tweet_batches(db, batches, written_media)
+
+
+def save_tweet_batches(db, batches, written_media=None, max_written_media=100000):
+    """
+    Write the output of tweet_batches() in a single transaction, adding the
+    IDs of the media rows to the written_media set, if one is passed
+    """
+    with db.conn:
+        write_batches(db, batches)
+    if written_media is not None:
+        if len(written_media) > max_written_media:
+            written_media.clear()
+        written_media.update(media["id"] for media in batches["media"])
+
+
+@contextlib.contextmanager
+def nullcontext():
+    "contextlib.nullcontext(), which needs Python 3.7"
+    yield
+
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def tweet_batches(db, tweets, favorited_by=None, written_media=None):
+    "Transform raw API tweets into {table_name: [rows]} batches, ready for writing"
+    return finish_tweet_batches(
+        db, collect_tweet_batches(tweets, favorited_by), written_media
+    )
+
+
+def collect_tweet_batches(tweets, favorited_by=None):
+    """
+    The part of tweet_batches() that does not need the database, so it can
+    run in another process.
+    """
+    batches = {table: [] for table, _, _ in BATCH_TABLES}
     for tweet in tweets:
-        transform_tweet(tweet)
-        user = tweet.pop("user")
-        transform_user(user)
-        tweet["user"] = user["id"]
-        tweet["source"] = extract_and_save_source(db, tweet["source"])
-        if tweet.get("place"):
-            db["places"].insert(tweet["place"], pk="id", alter=True, replace=True)
-            tweet["place"] = tweet["place"]["id"]
-        # extended_entities contains media
-        extended_entities = tweet.pop("extended_entities", None)
-        # Deal with nested retweeted_status / quoted_status
-        nested = []
-        for tweet_key in ("quoted_status", "retweeted_status"):
-            if tweet.get(tweet_key):
-                nested.append(tweet[tweet_key])
-                tweet[tweet_key] = tweet[tweet_key]["id"]
-        if nested:
-            save_tweets(db, nested)
-        db["users"].insert(user, pk="id", alter=True, replace=True)
-        save_user_counts(db, user)
-        table = db["tweets"].insert(tweet, pk="id", alter=True, replace=True)
-        if favorited_by is not None:
-            db["favorited_by"].insert(
-                {"tweet": tweet["id"], "user": favorited_by},
-                pk=("user", "tweet"),
-                foreign_keys=("tweet", "user"),
-                replace=True,
+        _collect_tweet(batches, tweet, favorited_by)
+    return batches
+
+
+def finish_tweet_batches(db, batches, written_media=None):
+    """
+    Add the rows to batches that depend on what is already in the database,
+    leaving out media rows whose IDs are in the written_media set
+    """
+    batches["count_history"] = user_count_rows(db, batches["users"])
+    batches["user_fetches"] = user_fetch_rows(batches["users"])
+    batches["media"] = _new_media(batches["media"], written_media or ())
+    batches["media_tweets"] = list(
+        {
+            (row["media_id"], row["tweets_id"]): row for row in batches["media_tweets"]
+        }.values()
+    )
+    return batches
+
+
+def _new_media(media_rows, written):
+    # The same photo shows up on a tweet and on every retweet of it, so only
+    # write the last copy of each one that has not been written yet
+    new_media = {}
+    for media in media_rows:
+        if media["id"] not in written:
+            new_media[media["id"]] = media
+    return list(new_media.values())
+
+
+def _collect_tweet(batches, tweet, favorited_by):
+    # Rows are appended in the same order the old row-by-row code inserted them,
+    # so that replace=True and alter=True produce exactly the same tables
+    transform_tweet(tweet)
+    user = tweet.pop("user")
+    transform_user(user)
+    tweet["user"] = user["id"]
+    tweet["source"] = _collect_source(batches, tweet["source"])
+    if tweet.get("place"):
+        batches["places"].append(tweet["place"])
+        tweet["place"] = tweet["place"]["id"]
+    # extended_entities contains media
+    extended_entities = tweet.pop("extended_entities", None)
+    # Deal with nested retweeted_status / quoted_status
+    nested = []
+    for tweet_key in ("quoted_status", "retweeted_status"):
+        if tweet.get(tweet_key):
+            nested.append(tweet[tweet_key])
+            tweet[tweet_key] = tweet[tweet_key]["id"]
+    for nested_tweet in nested:
+        _collect_tweet(batches, nested_tweet, None)
+    batches["users"].append(user)
+    batches["tweets"].append(tweet)
+    if favorited_by is not None:
+        batches["favorited_by"].append({"tweet": tweet["id"], "user": favorited_by})
+    if extended_entities and extended_entities.get("media"):
+        for media in extended_entities["media"]:
+            batches["media"].append(media)
+            batches["media_tweets"].append(
+                {"media_id": media["id"], "tweets_id": tweet["id"]}
             )
-        if extended_entities and extended_entities.get("media"):
-            for media in extended_entities["media"]:
-                # TODO: Remove this line when .m2m() grows alter=True
-                db["media"].insert(media, pk="id", alter=True, replace=True)
-                table.m2m("media", media, pk="id")
+
+
+def _collect_source(batches, source):
+    if not source:
+        return None
+    details = source_re.match(source).groupdict()
+    source_id = _hash_record(details)
+    batches["sources"].append(dict(details, id=source_id))
+    return source_id
+
+
+def _hash_record(record):
+    # Same hash that sqlite-utils uses for hash_id="id"
+    return hashlib.sha1(
+        json.dumps(record, separators=(",", ":"), sort_keys=True, default=repr).encode(
+            "utf8"
+        )
+    ).hexdigest()
+
+
+# (table, insert options, alter) in the order batches are written
+BATCH_TABLES = (
+    ("sources", {"pk": "id"}, False),
+    ("places", {"pk": "id"}, True),
+    ("users", {"pk": "id"}, True),
+    ("user_fetches", {"pk": "user"}, False),
+    ("count_history", {}, False),
+    ("tweets", {"pk": "id"}, True),
+    (
+        "favorited_by",
+        {"pk": ("user", "tweet"), "foreign_keys": ("tweet", "user")},
+        False,
+    ),
+    ("media", {"pk": "id"}, True),
+    (
+        "media_tweets",
+        {"pk": ("media_id", "tweets_id"), "foreign_keys": ("media_id", "tweets_id")},
+        False,
+    ),
+)
+
+
+def write_batches(db, batches):
+    for table_name, kwargs, alter in BATCH_TABLES:
+        rows = batches.get(table_name)
+        if rows:
+            write_rows(db, table_name, rows, alter=alter, **kwargs)
+
+
+def write_rows(db, table_name, rows, alter=False, **kwargs):
+    "Write rows with a single executemany(), replacing existing rows"
+    state = schema_state(db)
+    if table_name not in state.table_names():
+        # Create the table from the first row, like a single .insert() would
+        db[table_name].insert(
+            {key: sqlite_value(value) for key, value in rows[0].items()},
+            replace=True,
+            **kwargs
+        )
+        rows = rows[1:]
+    if alter:
+        add_missing_columns(db, table_name, rows)
+    columns = state.column_names(table_name)
+    # The SQL only changes when the columns do, so sqlite3 keeps reusing
+    # the same prepared statement
+    sql = "INSERT OR REPLACE INTO [{}] ({}) VALUES ({})".format(
+        table_name,
+        ", ".join("[{}]".format(column) for column in columns),
+        ", ".join("?" for column in columns),
+    )
+    db.conn.executemany(
+        sql,
+        ([sqlite_value(row.get(column)) for column in columns] for row in rows),
+    )
+
+
+def sqlite_value(value):
+    "Convert a row value for executemany() - datetimes become ISO strings"
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return jsonify_if_needed(value)
+
+
+def add_missing_columns(db, table_name, rows):
+    # Add columns one row at a time so types are picked from the first row
+    # that uses each column, matching what insert(..., alter=True) does
+    state = schema_state(db)
+    fingerprints = state.fingerprints(table_name)
+    known = None
+    for row in rows:
+        fingerprint = frozenset(row)
+        if fingerprint in fingerprints:
+            continue
+        if known is None:
+            known = set(state.columns(table_name))
+        if any(key.lower() not in known for key in row):
+            db[table_name].add_missing_columns([row])
+            known.update(key.lower() for key in row)
+        fingerprints.add(fingerprint)
 
 
 def save_users(db, users, followed_id=None, follower_id=None):
@@ -451,9 +1546,12 @@ def save_users(db, users, followed_id=None, follower_id=None):
     ensure_tables(db)
     for user in users:
         transform_user(user)
-    db["users"].insert_all(users, pk="id", alter=True, replace=True)
-    for user in users:
-        save_user_counts(db, user)
+    count_rows = user_count_rows(db, users)
+    with db.conn:
+        if users:
+            write_rows(db, "users", users, alter=True, pk="id")
+            write_rows(db, "user_fetches", user_fetch_rows(users), pk="user")
+        db["count_history"].insert_all(count_rows, replace=True)
     if followed_id or follower_id:
         first_seen = datetime.datetime.utcnow().isoformat()
         db["following"].insert_all(
@@ -469,46 +1567,170 @@ def save_users(db, users, followed_id=None, follower_id=None):
         )
 
 
-def fetch_user_batches(session, ids_or_screen_names, use_ids=False, sleep=1):
+def fetch_user_batches(session, ids_or_screen_names, use_ids=False, sleep=None):
     # Yields lists of up to 70 users (tried 100 but got this error:
     # # {'code': 18, 'message': 'Too many terms specified in query.'} )
-    batches = []
-    batch = []
-    for id in ids_or_screen_names:
-        batch.append(id)
-        if len(batch) == 70:
-            batches.append(batch)
-            batch = []
-    if batch:
-        batches.append(batch)
     url = "https://api.twitter.com/1.1/users/lookup.json"
-    for batch in batches:
+    for batch in chunks(ids_or_screen_names, 70):
         if use_ids:
             args = {"user_id": ",".join(map(str, batch))}
         else:
             args = {"screen_name": ",".join(batch)}
-        users = session.get(url, params=args).json()
+        users = response_json(api_get(session, url, params=args))
         yield users
-        time.sleep(sleep)
+        extra_sleep(sleep)
+
+
+# (table, column) pairs that reference users.id
+USER_REFERENCES = (
+    ("following", "followed_id"),
+    ("following", "follower_id"),
+    ("tweets", "user"),
+    ("list_members", "user"),
+    ("favorited_by", "user"),
+)
+
+
+def stale_user_ids(db, ttl=None):
+    """
+    IDs of users referenced from other tables that are missing from users
+    and have not already been recorded in user_tombstones.
+
+    If ttl is a timedelta, users whose profile was last fetched longer ago
+    than that, or who have no recorded fetch time, are included too, as are
+    tombstoned users last checked longer ago than that.
+    """
+    ensure_tables(db)
+    table_names = schema_state(db).table_names()
+    references = [
+        "select [{}] as id from [{}]".format(column, table)
+        for table, column in USER_REFERENCES
+        if table in table_names
+    ]
+    if ttl is None:
+        where = "users.id is null and user_tombstones.id is null"
+        params = {}
+    else:
+        where = """
+            (users.id is null and (
+                user_tombstones.id is null or user_tombstones.checked < :cutoff
+            ))
+            or (users.id is not null and (
+                user_fetches.fetched is null or user_fetches.fetched < :cutoff
+            ))
+        """
+        params = {"cutoff": utcnow_iso(datetime.datetime.utcnow() - ttl)}
+    sql = """
+        with referenced as ({})
+        select referenced.id from referenced
+        left join users on users.id = referenced.id
+        left join user_fetches on user_fetches.user = referenced.id
+        left join user_tombstones on user_tombstones.id = referenced.id
+        where referenced.id is not null and ({})
+        order by referenced.id
+    """.format(
+        " union ".join(references), where
+    )
+    return [r[0] for r in db.conn.execute(sql, params).fetchall()]
+
+
+def user_fetch_rows(users):
+    "user_fetches rows recording that these users were fetched just now"
+    fetched = utcnow_iso()
+    user_ids = dict.fromkeys(user["id"] for user in users)
+    return [{"user": id, "fetched": fetched} for id in user_ids]
+
+
+def utcnow_iso(now=None):
+    now = now or datetime.datetime.utcnow()
+    return now.isoformat().split(".")[0] + "+00:00"
+
+
+def dangling_tweet_ids(db):
+    """
+    IDs of tweets that stored tweets retweet, quote or reply to, which are
+    not in tweets and have not already been recorded in tweet_tombstones.
+    """
+    ensure_tables(db)
+    # Cast because databases created by older versions store these as TEXT
+    sql = """
+        with referenced as (
+            select cast(retweeted_status as integer) as id from tweets
+            union select cast(quoted_status as integer) from tweets
+            union select cast(in_reply_to_status_id as integer) from tweets
+        )
+        select referenced.id from referenced
+        left join tweets on tweets.id = referenced.id
+        left join tweet_tombstones on tweet_tombstones.id = referenced.id
+        where referenced.id is not null
+        and tweets.id is null and tweet_tombstones.id is null
+        order by referenced.id
+    """
+    return [int(r[0]) for r in db.conn.execute(sql).fetchall()]
+
+
+def missing_tweet_ids(db, tweet_ids, batch_size=10000):
+    """
+    The tweet_ids that are not already in tweets, in their original order.
+
+    tweet_ids are streamed into a temporary table and filtered with an
+    anti-join against the tweets primary key, so memory use depends on the
+    number of tweet_ids and not on the size of the tweets table.
+    """
+    ensure_tables(db)
+    db.conn.execute(
+        "create temp table if not exists lookup_ids "
+        "(position integer primary key, id integer)"
+    )
+    try:
+        for batch in chunks(tweet_ids, batch_size):
+            with db.conn:
+                db.conn.executemany(
+                    "insert into temp.lookup_ids (id) values (?)",
+                    ((int(id),) for id in batch),
+                )
+        sql = """
+            select id from temp.lookup_ids
+            where not exists (select 1 from tweets where tweets.id = lookup_ids.id)
+            order by position
+        """
+        return [r[0] for r in db.conn.execute(sql)]
+    finally:
+        db.conn.execute("drop table temp.lookup_ids")
+
+
+def save_tweet_tombstones(db, tweet_ids):
+    "Record tweets that could not be fetched, so they are not tried again"
+    checked = utcnow_iso()
+    with db.conn:
+        write_rows(
+            db,
+            "tweet_tombstones",
+            [{"id": id, "checked": checked} for id in tweet_ids],
+            pk="id",
+        )
+
+
+def save_user_tombstones(db, user_ids):
+    "Record users that could not be fetched, so they are not tried again"
+    checked = utcnow_iso()
+    with db.conn:
+        write_rows(
+            db,
+            "user_tombstones",
+            [{"id": id, "checked": checked} for id in user_ids],
+            pk="id",
+        )
 
 
-def fetch_status_batches(session, tweet_ids, sleep=1):
+def fetch_status_batches(session, tweet_ids, sleep=None):
     # Yields lists of up to 100 tweets
-    batches = []
-    batch = []
-    for id in tweet_ids:
-        batch.append(id)
-        if len(batch) == 100:
-            batches.append(batch)
-            batch = []
-    if batch:
-        batches.append(batch)
     url = "https://api.twitter.com/1.1/statuses/lookup.json"
-    for batch in batches:
+    for batch in chunks(tweet_ids, 100):
         args = {"id": ",".join(map(str, batch)), "tweet_mode": "extended"}
-        tweets = session.get(url, params=args).json()
+        tweets = response_json(api_get(session, url, params=args))
         yield tweets
-        time.sleep(sleep)
+        extra_sleep(sleep)
 
 
 def resolve_identifiers(db, identifiers, attach, sql):
@@ -531,7 +1753,7 @@ def resolve_identifiers(db, identifiers, attach, sql):
     return list(identifiers) + sql_identifiers
 
 
-def fetch_and_save_list(db, session, identifier, identifier_is_id=False):
+def fetch_and_save_list(db, session, identifier, identifier_is_id=False, resume=False):
     show_url = "https://api.twitter.com/1.1/lists/show.json"
     args = {}
     if identifier_is_id:
@@ -540,21 +1762,23 @@ def fetch_and_save_list(db, session, identifier, identifier_is_id=False):
         screen_name, slug = identifier.split("/")
         args.update({"owner_screen_name": screen_name, "slug": slug})
     # First fetch the list details
-    data = session.get(show_url, params=args).json()
+    data = response_json(api_get(session, show_url, params=args))
     list_id = data["id"]
     del data["id_str"]
     user = data.pop("user")
     save_users(db, [user])
     data["user"] = user["id"]
-    data["created_at"] = parser.parse(data["created_at"])
+    data["created_at"] = parse_datetime(data["created_at"])
     db["lists"].insert(data, pk="id", foreign_keys=("user",), replace=True)
     # Now fetch the members
     url = "https://api.twitter.com/1.1/lists/members.json"
+    args["count"] = 5000
     cursor = -1
-    while cursor:
-        args.update({"count": 5000, "cursor": cursor})
-        body = session.get(url, params=args).json()
-        users = body["users"]
+    if resume:
+        cursor = load_cursor_checkpoint(db, url, list_id)
+    for users, checkpoint in cursor_pages(
+        session, url, args, "users", checkpoint_key=list_id, cursor=cursor
+    ):
         save_users(db, users)
         db["list_members"].insert_all(
             ({"list": list_id, "user": user["id"]} for user in users),
@@ -562,28 +1786,71 @@ def fetch_and_save_list(db, session, identifier, identifier_is_id=False):
             foreign_keys=("list", "user"),
             replace=True,
         )
-        cursor = body["next_cursor"]
-        if not cursor:
-            break
-        time.sleep(1)  # Rate limit = 900 per 15 minutes
+        save_cursor_checkpoint(db, checkpoint)
 
 
 def cursor_paginate(session, url, args, key, page_size=200, sleep=None):
     "Execute cursor pagination, yelding 'key' for each page"
     args = dict(args)
     args["page_size"] = page_size
-    cursor = -1
+    for items, _ in cursor_pages(session, url, args, key, sleep=sleep):
+        yield items
+
+
+def cursor_pages(session, url, args, key, checkpoint_key=None, cursor=-1, sleep=None):
+    """
+    Yields (body[key], checkpoint) for each page of a cursor paginated API,
+    starting at cursor.
+
+    checkpoint is a cursor_checkpoints row recording the next cursor, to
+    save with save_cursor_checkpoint() once the page has been stored - or
+    None if there is no checkpoint_key. Like fetch_timeline_pages() this
+    does not touch the database, so it can be used with pipeline().
+    """
+    args = dict(args)
+    endpoint = RateLimiter.endpoint(url)
     while cursor:
         args["cursor"] = cursor
-        r = session.get(url, params=args)
+        r = api_get(session, url, params=args)
         raise_if_error(r)
-        body = r.json()
-        yield body[key]
+        body = response_json(r)
         cursor = body["next_cursor"]
-        if not cursor:
-            break
-        if sleep is not None:
-            time.sleep(sleep)
+        checkpoint = None
+        if checkpoint_key is not None:
+            checkpoint = {
+                "endpoint": endpoint,
+                "key": str(checkpoint_key),
+                "cursor": cursor,
+            }
+        yield body[key], checkpoint
+        if cursor:
+            extra_sleep(sleep)
+
+
+def load_cursor_checkpoint(db, url, checkpoint_key):
+    "Returns the saved cursor to resume from, or -1 to start at the beginning"
+    rows = db.conn.execute(
+        "select cursor from cursor_checkpoints where endpoint = ? and key = ?",
+        [RateLimiter.endpoint(url), str(checkpoint_key)],
+    ).fetchall()
+    return rows[0][0] if rows else -1
+
+
+def save_cursor_checkpoint(db, checkpoint):
+    if checkpoint is None:
+        return
+    if checkpoint["cursor"]:
+        db["cursor_checkpoints"].insert(
+            dict(checkpoint, updated=datetime.datetime.utcnow().isoformat()),
+            replace=True,
+        )
+    else:
+        # Finished, so the next run should start from the beginning again
+        with db.conn:
+            db.conn.execute(
+                "delete from cursor_checkpoints where endpoint = ? and key = ?",
+                [checkpoint["endpoint"], checkpoint["key"]],
+            )
 
 
 class TwitterApiError(Exception):
@@ -596,12 +1863,22 @@ class TwitterApiError(Exception):
 
 
 def raise_if_error(r):
-    if "errors" in r.json():
-        raise TwitterApiError(r.headers, r.json()["errors"])
+    body = response_json(r)
+    if "errors" in body:
+        raise TwitterApiError(r.headers, body["errors"])
+
+
+FILTER_STREAM_URL = "https://stream.twitter.com/1.1/statuses/filter.json"
 
 
 def stream_filter(session, track=None, follow=None, locations=None, language=None):
-    session.stream = True
+    return stream_tweets(filter_connection(session, track, follow, locations, language))
+
+
+def filter_connection(
+    session, track=None, follow=None, locations=None, language=None, **kwargs
+):
+    "A StreamConnection to statuses/filter for these filters"
     args = {"tweet_mode": "extended"}
     for key, value in (
         ("track", track),
@@ -614,23 +1891,160 @@ def stream_filter(session, track=None, follow=None, locations=None, language=Non
         if not isinstance(value, str):
             value = ",".join(map(str, value))
         args[key] = value
-    while True:
-        response = session.post(
-            "https://stream.twitter.com/1.1/statuses/filter.json", params=args
-        )
-        for line in response.iter_lines(chunk_size=10000):
-            if line.strip().startswith(b"{"):
-                tweet = json.loads(line)
-                # Only yield tweet if it has an 'id' and 'created_at'
-                # - otherwise it's probably a maintenance message, see
-                # https://developer.twitter.com/en/docs/tweets/filter-realtime/overview/statuses-filter
-                if "id" in tweet and "created_at" in tweet:
-                    # 'Fix' weird tweets from streaming API
-                    fix_streaming_tweet(tweet)
-                    yield tweet
-                else:
-                    print(tweet)
-        time.sleep(1)
+    return StreamConnection(session, FILTER_STREAM_URL, args, **kwargs)
+
+
+def stream_tweets(connection):
+    return decode_stream_lines(connection.lines())
+
+
+def decode_stream_lines(lines, on_invalid=None):
+    "Yields tweets from raw stream lines, passing undecodable ones to on_invalid"
+    for line in lines:
+        if line.strip().startswith(b"{"):
+            try:
+                tweet = json_loads(line)
+            except ValueError:
+                if on_invalid is None:
+                    raise
+                on_invalid(line)
+                continue
+            # Only yield tweet if it has an 'id' and 'created_at'
+            # - otherwise it's probably a maintenance message, see
+            # https://developer.twitter.com/en/docs/tweets/filter-realtime/overview/statuses-filter
+            if "id" in tweet and "created_at" in tweet:
+                # 'Fix' weird tweets from streaming API
+                fix_streaming_tweet(tweet)
+                yield tweet
+            else:
+                print(tweet)
+
+
+def parse_stream_lines(job):
+    """
+    Decode and transform an (oldest, lines) group of raw streamed lines into
+    tweet_batches() rows. Runs in the worker processes used by
+    save_streamed_lines().
+    """
+    oldest, lines = job
+    tweets = list(decode_stream_lines(lines))
+    return oldest, len(tweets), collect_tweet_batches(tweets)
+
+
+class StreamConnection:
+    """
+    A streaming API connection that reconnects whenever it drops.
+
+    Twitter sends a blank keep-alive line every 30 seconds, so if nothing
+    at all arrives for stall_timeout seconds the connection is treated as
+    stalled and replaced. Reconnects back off as Twitter's documentation
+    asks: linearly by 250ms up to 16 seconds after network errors and
+    stalls, exponentially from 5 seconds up to 320 seconds after HTTP
+    errors, and exponentially from 1 minute after 420 or 429 responses.
+    """
+
+    # Responses that will not be fixed by trying again
+    FATAL_STATUS_CODES = {401, 403, 404, 406, 413, 416}
+
+    def __init__(self, session, url, args, stall_timeout=90):
+        self.session = session
+        self.url = url
+        self.args = args
+        self.stall_timeout = stall_timeout
+        self.failures = 0
+        self.failure_kind = None
+        self.started = None
+        self.connected_seconds = 0
+        self.gap_seconds = 0
+        self.num_lines = 0
+        self.reconnects = 0
+        self.disconnects = collections.Counter()
+        self.lost_lines = 0
+
+    def lines(self):
+        "Yields every non-blank line, reconnecting for as long as it is used"
+        self.started = time.monotonic()
+        # The gap before the first connection is not counted as lost
+        gap_started = None
+        while True:
+            if self.failure_kind is not None:
+                time.sleep(self.backoff())
+                self.reconnects += 1
+            response = connected = None
+            try:
+                response = self.session.post(
+                    self.url, params=self.args, stream=True, timeout=self.stall_timeout
+                )
+                if response.status_code != 200:
+                    if response.status_code in self.FATAL_STATUS_CODES:
+                        raise TwitterApiError(response.headers, response.content)
+                    self.failed(
+                        "rate_limited" if response.status_code in (420, 429) else "http"
+                    )
+                    continue
+                connected = last_data = time.monotonic()
+                if gap_started is not None:
+                    self.record_gap(connected - gap_started)
+                self.failures = 0
+                self.failure_kind = None
+                for line in response.iter_lines(chunk_size=10000):
+                    last_data = time.monotonic()
+                    if line.strip():
+                        self.num_lines += 1
+                        yield line
+                # Twitter closed the stream
+                self.failed("network")
+            except requests.exceptions.RequestException as e:
+                self.failed("stall" if is_read_timeout(e) else "network")
+            finally:
+                if response is not None:
+                    response.close()
+                if connected is not None:
+                    self.connected_seconds += last_data - connected
+                    gap_started = last_data
+
+    def failed(self, kind):
+        self.disconnects[kind] += 1
+        # Stalls back off in the same way as network errors
+        kind = "network" if kind == "stall" else kind
+        if kind != self.failure_kind:
+            self.failures = 0
+        self.failures += 1
+        self.failure_kind = kind
+
+    def backoff(self):
+        "Seconds to wait before reconnecting after self.failures failures"
+        if self.failure_kind == "network":
+            return min(0.25 * self.failures, 16)
+        if self.failure_kind == "http":
+            return min(5 * 2 ** (self.failures - 1), 320)
+        return 60 * 2 ** (self.failures - 1)
+
+    def record_gap(self, seconds):
+        self.gap_seconds += seconds
+        # Estimate what was missed using the rate seen while connected
+        if self.connected_seconds:
+            self.lost_lines += seconds * self.num_lines / self.connected_seconds
+
+    def stats(self):
+        elapsed = time.monotonic() - self.started if self.started else 0
+        return {
+            "elapsed": elapsed,
+            "connected": self.connected_seconds,
+            "uptime": self.connected_seconds / elapsed if elapsed else None,
+            "reconnects": self.reconnects,
+            "disconnects": dict(self.disconnects),
+            "gap_seconds": self.gap_seconds,
+            "lines": self.num_lines,
+            "estimated_lost_lines": int(self.lost_lines),
+        }
+
+
+def is_read_timeout(e):
+    "Did this requests exception come from a read timing out?"
+    if isinstance(e, requests.exceptions.ReadTimeout):
+        return True
+    return bool(e.args) and isinstance(e.args[0], urllib3.exceptions.ReadTimeoutError)
 
 
 def fix_streaming_tweet(tweet):
@@ -644,6 +2058,420 @@ def fix_streaming_tweet(tweet):
         fix_streaming_tweet(tweet["quoted_status"])
 
 
+class GroupCommitWriter:
+    """
+    Buffers tweets and saves them in a single transaction once batch_size
+    have arrived, or max_delay seconds after the oldest buffered tweet
+    arrived, whichever comes first.
+
+    Records the size of each batch and its commit latency: the time from
+    the oldest tweet in the batch arriving to the batch being committed.
+    A batch that fails to save is kept and saved again by the next flush().
+    """
+
+    def __init__(self, db, batch_size=100, max_delay=0.5, max_samples=10000):
+        self.db = db
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.buffer = []
+        self.oldest = None
+        # (oldest, num_tweets, batches) that have not been saved yet
+        self.unsaved = []
+        # IDs of the media rows this writer has saved
+        self.written_media = set()
+        self.num_tweets = 0
+        self.num_batches = 0
+        self.largest_batch = 0
+        self.latencies = collections.deque(maxlen=max_samples)
+
+    def add(self, tweet):
+        if not self.buffer:
+            self.oldest = time.monotonic()
+        self.buffer.append(tweet)
+        # Checking the deadline here too means a backlog of tweets, which
+        # keeps the consumer from ever waiting, still flushes on time
+        if len(self.buffer) >= self.batch_size or self.time_left() == 0:
+            self.flush()
+
+    def time_left(self):
+        "Seconds until the buffer is due to be flushed, None if it is empty"
+        if not self.buffer:
+            return None
+        return max(0, self.oldest + self.max_delay - time.monotonic())
+
+    def flush(self):
+        if self.buffer:
+            # Transforming modifies the tweets, so keep the transformed rows
+            # rather than the tweets until they have been saved
+            batches = collect_tweet_batches(self.buffer)
+            self.unsaved.append((self.oldest, len(self.buffer), batches))
+            self.buffer = []
+        while self.unsaved:
+            self.save_collected(*self.unsaved[0])
+            self.unsaved.pop(0)
+
+    def add_collected(self, oldest, num_tweets, batches):
+        "Save collect_tweet_batches() rows now, keeping them if the save fails"
+        self.unsaved.append((oldest, num_tweets, batches))
+        self.flush()
+
+    def save_collected(self, oldest, num_tweets, batches):
+        "Save collect_tweet_batches() rows for tweets that started arriving at oldest"
+        if not num_tweets:
+            return
+        ensure_tables(self.db)
+        # A copy, as finish_tweet_batches() replaces some of the lists
+        batches = finish_tweet_batches(self.db, dict(batches), self.written_media)
+        save_tweet_batches(self.db, batches, self.written_media)
+        self.record(num_tweets, oldest)
+
+    def record(self, num_tweets, oldest):
+        self.latencies.append(time.monotonic() - oldest)
+        self.num_tweets += num_tweets
+        self.num_batches += 1
+        self.largest_batch = max(self.largest_batch, num_tweets)
+
+    def stats(self):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+        return {
+            "tweets": self.num_tweets,
+            "batches": self.num_batches,
+            "mean_batch_size": (
+                self.num_tweets / self.num_batches if self.num_batches else None
+            ),
+            "largest_batch": self.largest_batch,
+            "latency_p50": percentile(0.5),
+            "latency_p99": percentile(0.99),
+            "latency_max": latencies[-1] if latencies else None,
+        }
+
+
+def save_streamed_tweets(writer, tweets, on_tweet=None, queue_size=None):
+    """
+    Read tweets on a background thread and save them with writer, flushing
+    it when its max_delay expires even if no more tweets arrive.
+
+    At most queue_size tweets, by default four batches, wait to be saved,
+    so a slow database holds the reader back. Anything still buffered is
+    saved when tweets runs out, raises an error or the main thread is
+    interrupted.
+    """
+    reader = ReadAhead([tweets], queue_size=queue_size or 4 * writer.batch_size)
+    try:
+        while True:
+            try:
+                tweet = reader.get(timeout=writer.time_left())
+            except queue.Empty:
+                writer.flush()
+                continue
+            if tweet is ReadAhead.DONE:
+                break
+            if on_tweet is not None:
+                on_tweet(tweet)
+            writer.add(tweet)
+    finally:
+        reader.close()
+        writer.flush()
+
+
+def save_streamed_lines(writer, lines, processes, queue_size=None):
+    """
+    Like save_streamed_tweets(), but for raw lines from the stream, which
+    are decoded and transformed by a pool of worker processes.
+
+    Lines are read on a background thread and grouped using the writer's
+    batch_size and max_delay. Each group becomes one parse_stream_lines()
+    job, and the results are written here, in order, one transaction each.
+    At most queue_size lines, by default four batches, wait to be grouped,
+    and at most 2 * processes groups wait to be saved.
+    """
+    reader = ReadAhead([lines], queue_size=queue_size or 4 * writer.batch_size)
+    error = []
+
+    def groups():
+        # Yields None when there is no group yet, so that finished results
+        # are saved while the stream is quiet
+        group, oldest = [], None
+        while True:
+            timeout = 0.1
+            if group:
+                timeout = min(timeout, oldest + writer.max_delay - time.monotonic())
+            try:
+                line = reader.get(timeout=max(0, timeout))
+            except queue.Empty:
+                line = None
+            except Exception as e:
+                # Raised once the lines read before it have been saved
+                error.append(e)
+                break
+            if line is ReadAhead.DONE:
+                break
+            if line is not None:
+                if not group:
+                    oldest = time.monotonic()
+                group.append(line)
+            if group and (
+                len(group) >= writer.batch_size
+                or time.monotonic() >= oldest + writer.max_delay
+            ):
+                yield oldest, group
+                group = []
+            else:
+                yield None
+        if group:
+            yield oldest, group
+
+    # Submitted here rather than with Pool.imap(), which would read groups
+    # as fast as they arrive however far behind the database is
+    pending = collections.deque()
+
+    def save_ready(limit):
+        # In order, waiting for results while more than limit are pending
+        while pending and (len(pending) > limit or pending[0].ready()):
+            writer.add_collected(*pending.popleft().get())
+
+    with multiprocessing.Pool(processes, initializer=_ignore_sigint) as pool:
+        try:
+            for group in groups():
+                if group is not None:
+                    pending.append(pool.apply_async(parse_stream_lines, (group,)))
+                save_ready(2 * processes)
+            save_ready(0)
+        except (KeyboardInterrupt, SystemExit):
+            # Save the lines that have already been read before exiting,
+            # including a batch whose save was interrupted
+            reader.close()
+            writer.flush()
+            save_ready(0)
+            raise
+        finally:
+            reader.close()
+    if error:
+        raise error[0]
+
+
+def _ignore_sigint():
+    # Worker processes leave Ctrl+C to the process that started them
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class StreamJournal:
+    """
+    An append-only journal of raw stream lines, for one process at a time.
+
+    Lines are appended to numbered NNNNNNNNNNNN.jsonl segment files in
+    directory, starting a new segment once the current one reaches
+    segment_size bytes. The (segment, position) that has been saved to the
+    database is persisted in offset.json by commit(), which also deletes
+    segments that are no longer needed. Opening an existing journal carries
+    on reading from that offset, so nothing is lost if the process dies. A
+    line left half written by a crash is truncated away when it is opened.
+    """
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024):
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.segment_size = segment_size
+        self.condition = threading.Condition()
+        self.appended = 0
+        self.offset = self.load_offset()
+        segments = self.segments()
+        self.write_segment = max(segments + [self.offset[0]])
+        self.truncated = self.truncate_partial_line(self.path(self.write_segment))
+        self.write_file = open(self.path(self.write_segment), "ab")
+        self.read_segment, self.read_position = self.offset
+        self.read_file = None
+        # Lines that could not be decoded, counted by save_journaled_lines()
+        self.skipped = 0
+
+    def truncate_partial_line(self, path, block_size=64 * 1024):
+        "Truncate path after its last newline, returning the bytes removed"
+        try:
+            size = path.stat().st_size
+        except FileNotFoundError:
+            return 0
+        keep = 0
+        with open(path, "rb+") as fp:
+            end = size
+            while end > 0:
+                start = max(0, end - block_size)
+                fp.seek(start)
+                newline = fp.read(end - start).rfind(b"\n")
+                if newline != -1:
+                    keep = start + newline + 1
+                    break
+                end = start
+            if keep < size:
+                fp.truncate(keep)
+        return size - keep
+
+    def path(self, segment):
+        return self.directory / "{:012d}.jsonl".format(segment)
+
+    def segments(self):
+        return sorted(int(path.stem) for path in self.directory.glob("*.jsonl"))
+
+    def load_offset(self):
+        try:
+            offset = json.loads((self.directory / "offset.json").read_text())
+        except FileNotFoundError:
+            segments = self.segments()
+            return (segments[0] if segments else 0, 0)
+        return (offset["segment"], offset["position"])
+
+    def append(self, line):
+        with self.condition:
+            if self.write_file.tell() >= self.segment_size:
+                self.write_file.close()
+                self.write_segment += 1
+                self.write_file = open(self.path(self.write_segment), "ab")
+            self.write_file.write(line + b"\n")
+            # Flushed to the OS for every line, so it survives a crash
+            self.write_file.flush()
+            self.appended += 1
+            self.condition.notify_all()
+
+    def read(self, max_lines, max_delay, timeout=None):
+        """
+        Returns (lines, offset) for up to max_lines unread lines, waiting up
+        to max_delay seconds after the first one for more to arrive, and at
+        most timeout seconds for the first one. Pass offset to commit() once
+        the lines have been saved.
+        """
+        lines = []
+        started = time.monotonic()
+        deadline = None
+        while True:
+            with self.condition:
+                appended = self.appended
+                write_segment = self.write_segment
+            self._read_available(lines, max_lines, write_segment)
+            now = time.monotonic()
+            if lines and deadline is None:
+                deadline = now + max_delay
+            if len(lines) >= max_lines:
+                break
+            if lines:
+                wait_until = deadline
+            elif timeout is not None:
+                wait_until = started + timeout
+            else:
+                wait_until = None
+            if wait_until is not None and now >= wait_until:
+                break
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: self.appended != appended,
+                    None if wait_until is None else wait_until - now,
+                )
+        return lines, (self.read_segment, self.read_position)
+
+    def _read_available(self, lines, max_lines, write_segment):
+        while len(lines) < max_lines:
+            if self.read_file is None:
+                self.read_file = open(self.path(self.read_segment), "rb")
+                self.read_file.seek(self.read_position)
+            line = self.read_file.readline()
+            if line.endswith(b"\n"):
+                self.read_position += len(line)
+                lines.append(line[:-1])
+            elif self.read_segment < write_segment:
+                # Nothing more will be written to this segment
+                self.read_file.close()
+                self.read_file = None
+                self.read_segment += 1
+                self.read_position = 0
+            else:
+                # Caught up, possibly part way through a line being written
+                self.read_file.seek(self.read_position)
+                break
+
+    def commit(self, offset):
+        "Record that everything up to offset has been saved"
+        segment, position = offset
+        path = self.directory / "offset.json"
+        tmp_path = self.directory / "offset.json.tmp"
+        tmp_path.write_text(json.dumps({"segment": segment, "position": position}))
+        os.replace(tmp_path, path)
+        self.offset = offset
+        for old_segment in self.segments():
+            if old_segment >= segment:
+                break
+            self.path(old_segment).unlink()
+
+    def lag(self):
+        "How far the committed offset is behind the end of the journal"
+        with self.condition:
+            write_segment = self.write_segment
+            write_position = self.write_file.tell()
+        segment, position = self.offset
+        lag_bytes = write_position - position
+        for earlier in range(segment, write_segment):
+            lag_bytes += self.path(earlier).stat().st_size
+        return {"bytes": lag_bytes, "segments": write_segment - segment + 1}
+
+    def close(self):
+        self.write_file.close()
+        if self.read_file is not None:
+            self.read_file.close()
+
+
+def save_journaled_lines(
+    writer, journal, lines, on_tweet=None, on_lag=None, lag_interval=60
+):
+    """
+    Append raw stream lines to journal on a background thread, as fast as
+    they arrive, while decoding and saving them from the journal here at
+    whatever pace the database allows.
+
+    The journal offset is committed after each batch is saved, so lines
+    that were journaled but not saved are saved by the next run instead.
+    Lines that are not valid JSON are skipped and counted in journal.skipped.
+    on_lag is called with journal.lag() every lag_interval seconds.
+    """
+    done = threading.Event()
+    error = []
+
+    def count_skipped(line):
+        journal.skipped += 1
+
+    def read():
+        try:
+            for line in lines:
+                journal.append(line)
+        except BaseException as e:
+            error.append(e)
+        finally:
+            done.set()
+
+    threading.Thread(target=read, daemon=True).start()
+    next_lag = time.monotonic() + lag_interval
+    while True:
+        if on_lag is not None and time.monotonic() >= next_lag:
+            on_lag(journal.lag())
+            next_lag += lag_interval
+        # Checked first, so lines appended before it was set are still read
+        finished = done.is_set()
+        batch, offset = journal.read(writer.batch_size, writer.max_delay, timeout=0.1)
+        if batch:
+            for tweet in decode_stream_lines(batch, on_invalid=count_skipped):
+                if on_tweet is not None:
+                    on_tweet(tweet)
+                writer.add(tweet)
+            writer.flush()
+            journal.commit(offset)
+        elif finished:
+            break
+    if error:
+        raise error[0]
+
+
 def user_ids_for_screen_names(db, screen_names):
     sql = "select id from users where lower(screen_name) in ({})".format(
         ", ".join(["?"] * len(screen_names))
@@ -655,6 +2483,13 @@ def user_ids_for_screen_names(db, screen_names):
 
 def read_archive_js(filepath):
     "Open zip file, return (filename, content) for all .js"
+    for filename, fp in open_archive_js(filepath):
+        with fp:
+            yield filename, fp.read()
+
+
+def open_archive_js(filepath):
+    "Open zip file, return (filename, binary file object) for all .js"
     zf = zipfile.ZipFile(filepath)
     for zi in zf.filelist:
         # Ignore files in a assets dir -- these are for Twitter's archive
@@ -662,7 +2497,7 @@ def read_archive_js(filepath):
         # appear to put data in a data/ subdir, which can screw up the filename
         # -> importer mapping.
         if zi.filename.endswith(".js") and not zi.filename.startswith("assets/"):
-            yield pathlib.Path(zi.filename).name, zf.open(zi.filename).read()
+            yield pathlib.Path(zi.filename).name, zf.open(zi.filename)
 
 
 def extract_and_save_source(db, source):
@@ -674,28 +2509,48 @@ def extract_and_save_source(db, source):
 
 
 def save_user_counts(db, user):
-    for type_name, type_id in COUNT_HISTORY_TYPES.items():
-        previous_count = None
-        try:
-            previous_count = db.conn.execute(
-                """
-                select count from count_history
-                where type = ? and user = ?
-                order by datetime desc limit 1
-                """,
-                [type_id, user["id"]],
-            ).fetchall()[0][0]
-        except IndexError:
-            pass
-        current_count = user["{}_count".format(type_name)]
-        if current_count != previous_count:
-            db["count_history"].insert(
-                {
-                    "type": type_id,
-                    "user": user["id"],
-                    "datetime": datetime.datetime.utcnow().isoformat().split(".")[0]
-                    + "+00:00",
-                    "count": current_count,
-                },
-                replace=True,
-            )
+    db["count_history"].insert_all(user_count_rows(db, [user]), replace=True)
+
+
+def user_count_rows(db, users):
+    "count_history rows for any tracked counts that changed for these users"
+    latest_counts = latest_user_counts(db, {user["id"] for user in users})
+    now = utcnow_iso()
+    rows = []
+    for user in users:
+        for type_name, type_id in COUNT_HISTORY_TYPES.items():
+            key = (type_id, user["id"])
+            current_count = user["{}_count".format(type_name)]
+            if current_count != latest_counts.get(key):
+                rows.append(
+                    {
+                        "type": type_id,
+                        "user": user["id"],
+                        "datetime": now,
+                        "count": current_count,
+                    }
+                )
+            # Later appearances of the same user compare against this one
+            latest_counts[key] = current_count
+    return rows
+
+
+def latest_user_counts(db, user_ids, batch_size=500):
+    "Returns {(type_id, user_id): count} from the newest count_history rows"
+    user_ids = list(user_ids)
+    type_ids = list(COUNT_HISTORY_TYPES.values())
+    latest_counts = {}
+    for i in range(0, len(user_ids), batch_size):
+        batch = user_ids[i : i + batch_size]
+        # SQLite returns the bare count column from the max(datetime) row, and
+        # the (type, user, datetime) primary key index answers this directly
+        sql = """
+            select type, user, count, max(datetime) from count_history
+            where type in ({}) and user in ({})
+            group by type, user
+        """.format(
+            ", ".join("?" * len(type_ids)), ", ".join("?" * len(batch))
+        )
+        for type_id, user_id, count, _ in db.conn.execute(sql, type_ids + batch):
+            latest_counts[(type_id, user_id)] = count
+    return latest_counts